@@ -27,6 +27,7 @@ from source_types._statistics import task_statistics
 
 from source_types.sqlserver import task_calculate_signature
 from source_types.tabularfile import task_calculate_signature
+from source_types.tabularfile import task_materialize
 
 
 # # @worker.task(bind=True, name = "source_types.sqlserver.task_statistics")
@@ -34,6 +34,7 @@ class SystemConfig:
     REDIS_SCHEMA_INDEX_NAME: str = os.getenv("REDIS_SCHEMA_INDEX_NAME")
     REDIS_CONVERSATION_INDEX_NAME: str = os.getenv("REDIS_CONVERSATION_INDEX_NAME")
     REDIS_SOP_INDEX_NAME: str = os.getenv("REDIS_SOP_INDEX_NAME")
+    REDIS_VECTOR_BATCH_SIZE: int = int(os.getenv("REDIS_VECTOR_BATCH_SIZE", "500"))
     
     # S3
     S3_ENDPOINT: str = os.getenv("S3_ENDPOINT")
@@ -43,15 +44,54 @@ class SystemConfig:
     S3_Use_SSL: str = os.getenv("S3_Use_SSL").lower() == "true"
     S3_REGION_NAME: str = os.getenv("S3_REGION_NAME")
     S3_VERIFY: str | bool = False if os.getenv("S3_VERIFY").lower() == "false" else os.getenv("S3_VERIFY")
+    S3_CACHE_DIR: str = os.getenv("S3_CACHE_DIR", "./s3_cache")
+    S3_CACHE_MAX_MB: int = int(os.getenv("S3_CACHE_MAX_MB", "2048"))
+    S3_MULTIPART_CHUNK_MB: int = int(os.getenv("S3_MULTIPART_CHUNK_MB", "8"))
+    S3_MAX_POOL_CONNECTIONS: int = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "16"))
     
     # PondSQL
     PONDSQL_CONNECTION_STRING: str = os.getenv("PONDSQL_CONNECTION_STRING")
+    MATERIALIZE_CACHE_DIR: str = os.getenv("MATERIALIZE_CACHE_DIR", "./materialize_cache")
+    MATERIALIZE_CACHE_MAX_MB: int = int(os.getenv("MATERIALIZE_CACHE_MAX_MB", "10240"))
+    MATERIALIZE_CSV_READER: str = os.getenv("MATERIALIZE_CSV_READER", "duckdb").lower()
+    MATERIALIZE_CSV_TYPES: str = os.getenv("MATERIALIZE_CSV_TYPES", "pandas").lower()
+    MATERIALIZE_SAMPLE_ROWS: int = int(os.getenv("MATERIALIZE_SAMPLE_ROWS", "100"))
+    PREVIEW_CACHE_SIZE: int = int(os.getenv("PREVIEW_CACHE_SIZE", "256"))
+    PONDSQL_QUERY_WORKERS: int = int(os.getenv("PONDSQL_QUERY_WORKERS", "8"))
+    PONDSQL_SOURCE_CONCURRENCY: int = int(os.getenv("PONDSQL_SOURCE_CONCURRENCY", "4"))
+    PONDSQL_FAILED_LOAD_TTL: int = int(os.getenv("PONDSQL_FAILED_LOAD_TTL", "60"))
+    PONDSQL_MEMORY_BUDGET_MB: int = int(os.getenv("PONDSQL_MEMORY_BUDGET_MB", "4096"))
+    PONDSQL_EVICTION_POLICY: str = os.getenv("PONDSQL_EVICTION_POLICY", "lru").lower()
+    PONDSQL_EVICTION_INTERVAL: int = int(os.getenv("PONDSQL_EVICTION_INTERVAL", "30"))
+    PONDSQL_IDLE_TIMEOUT: int = int(os.getenv("PONDSQL_IDLE_TIMEOUT", "3600"))
+    PONDSQL_MAX_RESULT_ROWS: int = int(os.getenv("PONDSQL_MAX_RESULT_ROWS", "100000"))
+    PONDSQL_STREAM_CHUNK_ROWS: int = int(os.getenv("PONDSQL_STREAM_CHUNK_ROWS", "10000"))
+    PONDSQL_RESULT_CACHE_MB: int = int(os.getenv("PONDSQL_RESULT_CACHE_MB", "256"))
+    PONDSQL_RESULT_CACHE_TTL: int = int(os.getenv("PONDSQL_RESULT_CACHE_TTL", "3600"))
+    PONDSQL_RESULT_CACHE_REDIS: bool = os.getenv("PONDSQL_RESULT_CACHE_REDIS", "False").lower() == "true"
+    PONDSQL_QUERY_TIMEOUT: int = int(os.getenv("PONDSQL_QUERY_TIMEOUT", "60"))
+    PONDSQL_SOURCE_MEMORY_LIMIT: str = os.getenv("PONDSQL_SOURCE_MEMORY_LIMIT", "1GB")
+    PONDSQL_SOURCE_THREADS: int = int(os.getenv("PONDSQL_SOURCE_THREADS", "2"))
+    PONDSQL_PREWARM_TOP_K: int = int(os.getenv("PONDSQL_PREWARM_TOP_K", "20"))
+    PONDSQL_PREWARM_CONCURRENCY: int = int(os.getenv("PONDSQL_PREWARM_CONCURRENCY", "2"))
+    PONDSQL_PROFILE_SLOWEST: int = int(os.getenv("PONDSQL_PROFILE_SLOWEST", "0"))
+    PONDSQL_PROFILE_MIN_SECONDS: float = float(os.getenv("PONDSQL_PROFILE_MIN_SECONDS", "1"))
+    PONDSQL_LOCAL_WORKERS: int = int(os.getenv("PONDSQL_LOCAL_WORKERS", "2"))
+    PONDSQL_WORKERS: str = os.getenv("PONDSQL_WORKERS", "")
+    PONDSQL_HEALTH_INTERVAL: int = int(os.getenv("PONDSQL_HEALTH_INTERVAL", "10"))
     
     DB_ECHO = os.getenv("DB_ECHO", "False").lower() == "true"
     DB_LANG = os.getenv("DB_LANG", "en")
     SIGNATURE_THRESHOLD = float(os.getenv("SIGNATURE_THRESHOLD", "0.8"))
     NAME_TYPE_THRESHOLD = float(os.getenv("NAME_TYPE_THRESHOLD", "0.6"))
     MAX_ROWS_TO_SIGNATURE = int(os.getenv("MAX_ROWS_TO_SIGNATURE", "10000"))
+    SIGNATURE_WORKERS: int = int(os.getenv("SIGNATURE_WORKERS", "0"))
+    SIGNATURE_SAMPLING: str = os.getenv("SIGNATURE_SAMPLING", "top").lower()
+    SIGNATURE_FETCH_SIZE: int = int(os.getenv("SIGNATURE_FETCH_SIZE", "5000"))
+    SIGNATURE_TABLE_CONCURRENCY: int = int(os.getenv("SIGNATURE_TABLE_CONCURRENCY", "4"))
+    SQLSERVER_POOL_SIZE: int = int(os.getenv("SQLSERVER_POOL_SIZE", "5"))
+    SQLSERVER_ENGINE_IDLE_TIMEOUT: int = int(os.getenv("SQLSERVER_ENGINE_IDLE_TIMEOUT", "600"))
+    INCREMENTAL_DETECTION: bool = os.getenv("INCREMENTAL_DETECTION", "True").lower() == "true"
     SCHEMA_TOKEN_THRESHOLD = int(os.getenv("SCHEMA_TOKEN_THRESHOLD", "10000"))
     SMILARITY_THRESHOLD = float(os.getenv("SMILARITY_THRESHOLD", "0.5"))
     LLM_CONTEXT_SIZE = int(os.getenv("LLM_CONTEXT_SIZE", "128"))
@@ -59,6 +99,16 @@ class SystemConfig:
     DIFY_ACCOUNT_USER_EMAIL = os.getenv("DIFY_ACCOUNT_USER_EMAIL")
     DIFY_ACCOUNT_USER_PASSWORD = os.getenv("DIFY_ACCOUNT_USER_PASSWORD")
     DIFY_WORKFLOW_ENDPOINT = os.getenv("DIFY_WORKFLOW_ENDPOINT")
+    DIFY_MAX_CONCURRENCY: int = int(os.getenv("DIFY_MAX_CONCURRENCY", "32"))
+    DIFY_RETRIES: int = int(os.getenv("DIFY_RETRIES", "2"))
+    DIFY_RETRY_BACKOFF: float = float(os.getenv("DIFY_RETRY_BACKOFF", "0.5"))
+    EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", "1"))
+    EMBEDDING_CONCURRENCY: int = int(os.getenv("EMBEDDING_CONCURRENCY", "8"))
+    EMBEDDING_CHECKPOINT_TTL: int = int(os.getenv("EMBEDDING_CHECKPOINT_TTL", "86400"))
+    EMBEDDING_TASK_RETRIES: int = int(os.getenv("EMBEDDING_TASK_RETRIES", "3"))
+    EMBEDDING_CACHE: bool = os.getenv("EMBEDDING_CACHE", "True").lower() == "true"
+    EMBEDDING_CACHE_TTL: int = int(os.getenv("EMBEDDING_CACHE_TTL", "2592000"))
+    EMBEDDING_MODEL_ID: str = os.getenv("EMBEDDING_MODEL_ID", "")
     
     DIFY_TABLE_ANNOTATION_APP_KEY = os.getenv("DIFY_TABLE_ANNOTATION_APP_KEY")
     ANNOTATION_LANGUAGES = os.getenv("ANNOTATION_LANGUAGES")
@@ -1,8 +1,13 @@
-import requests
-from sseclient import SSEClient
+import httpx
+import threading
 import asyncio
 import json
+import time
+import weakref
 import logging
+from collections import namedtuple
+
+from config import config
 
 logger = logging.getLogger()
 
@@ -10,46 +15,26 @@ DEFAULT_USER = "newbakery"
 BLOCKING = "blocking"
 STREAMING = "streaming"
 
+# One SSE event of a streaming workflow run, .data is the JSON payload ( same attributes as sseclient's Event )
+SSEEvent = namedtuple("SSEEvent", ["event", "data", "id"])
 
-def call_dify(endpoint, api_key, **kwargs):
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    timeout = kwargs.get("timeout", 300)
+# Calls share pooled keep-alive connections to Dify : one httpx.Client for the threads ( celery workers, executors ),
+# one httpx.AsyncClient per event loop for the routers. At most DIFY_MAX_CONCURRENCY calls run at once on each,
+# and the calls failing before any response ( connection errors, 429, 5xx ) are retried DIFY_RETRIES times with backoff.
+_limits = httpx.Limits(max_connections=config.DIFY_MAX_CONCURRENCY, max_keepalive_connections=config.DIFY_MAX_CONCURRENCY)
+_client = httpx.Client(limits=_limits)
+_client_semaphore = threading.BoundedSemaphore(config.DIFY_MAX_CONCURRENCY)
+_async_states = weakref.WeakKeyDictionary()  # event loop -> (httpx.AsyncClient, asyncio.Semaphore)
+_async_states_lock = threading.Lock()
 
-    query = kwargs.get("query", "")
-    inputs = kwargs.get("inputs", {})
-    user = kwargs.get("user", DEFAULT_USER)
-    response_mode = BLOCKING  
-    conversation_id = kwargs.get("conversation_id", '')
-    auto_generate_name = kwargs.get("auto_generate_name", False)
-    streaming_callback = kwargs.get("streaming_callback", None)
-
-    data = {
-        "query": query,
-        "inputs": inputs,
-        "user": user,
-        "conversation_id": conversation_id if conversation_id else None,
-        "auto_generate_name": auto_generate_name,
-        "response_mode": response_mode,
-    }
-    
-    try:
-        response = requests.post(endpoint, headers=headers, json=data, timeout=timeout)
-        response.raise_for_status()  # 确保状态码 200
-        return response.json()
-
-    except requests.exceptions.HTTPError as http_err:
-        error_details = response.content.decode() if "response" in locals() and response.content else str(http_err)
-        raise Exception(f"HTTP error occurred: {error_details}") from http_err
-    except Exception as ex:
-        raise Exception(f"An error occurred: {str(ex)}") from ex
+_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 
 
+class DifyRetryableError(Exception):
+    pass
 
 
-def stream_dify(endpoint, api_key, **kwargs):
+def _request_args(api_key, response_mode, kwargs):
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
@@ -59,10 +44,8 @@ def stream_dify(endpoint, api_key, **kwargs):
     query = kwargs.get("query", "")
     inputs = kwargs.get("inputs", {})
     user = kwargs.get("user", DEFAULT_USER)
-    response_mode = STREAMING # 避免 None
     conversation_id = kwargs.get("conversation_id", '')
     auto_generate_name = kwargs.get("auto_generate_name", False)
-    streaming_callback = kwargs.get("streaming_callback", None)
 
     data = {
         "query": query,
@@ -72,32 +55,180 @@ def stream_dify(endpoint, api_key, **kwargs):
         "auto_generate_name": auto_generate_name,
         "response_mode": response_mode,
     }
-    
-    try:
-        response = requests.post(endpoint, headers=headers, json=data, timeout=timeout, stream=True)
-        response.raise_for_status()  # 确保状态码 200
+    return {"headers": headers, "json": data, "timeout": httpx.Timeout(timeout, connect=10)}
+
+
+def _backoff(attempt):
+    return config.DIFY_RETRY_BACKOFF * (2 ** attempt)
+
+
+def _check_response(response: httpx.Response, content: bytes):
+    if response.status_code in _RETRY_STATUS_CODES:
+        raise DifyRetryableError(f"HTTP error occurred: {response.status_code} {content.decode(errors='replace')}")
+    if response.is_error:
+        raise Exception(f"HTTP error occurred: {response.status_code} {content.decode(errors='replace')}")
+
+
+def _is_retryable(ex):
+    return isinstance(ex, (DifyRetryableError, httpx.TransportError)) and not isinstance(ex, httpx.ReadTimeout)
+
+
+def parse_sse(lines):
+    """
+    Parses the lines of a text/event-stream into SSEEvent
+    """
+    event, data, id = "message", [], None
+    for line in lines:
+        if not line:
+            if data:
+                yield SSEEvent(event, "\n".join(data), id)
+            event, data = "message", []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "data":
+            data.append(value)
+        elif field == "event":
+            event = value
+        elif field == "id":
+            id = value
+    if data:
+        yield SSEEvent(event, "\n".join(data), id)
+
+
+class _AsyncSSEParser:
+    def __init__(self):
+        self._lines = []
+
+    def feed(self, line):
+        # returns the events completed by the line
+        self._lines.append(line)
+        if line:
+            return []
+        lines, self._lines = self._lines, []
+        return list(parse_sse(lines))
+
+    def close(self):
+        lines, self._lines = self._lines, []
+        return list(parse_sse(lines))
 
-        client = SSEClient(response)
+
+def call_dify(endpoint, api_key, **kwargs):
+    args = _request_args(api_key, BLOCKING, kwargs)
+    for attempt in range(config.DIFY_RETRIES + 1):
         try:
-            context = {}
-            for event in client.events():
-                if streaming_callback:
-                    try:
-                        streaming_callback(event, context)
-                    except Exception as cb_err:
-                        logger.error(str(cb_err))
-                else:
-                    yield event
+            with _client_semaphore:
+                response = _client.post(endpoint, **args)
+            _check_response(response, response.content)
+            return response.json()
         except Exception as ex:
-            raise Exception(f"Error occurred while streaming SSE: {str(ex)}") from ex
+            if _is_retryable(ex) and attempt < config.DIFY_RETRIES:
+                logger.warning(f"dify call failed, retrying ({attempt + 1}/{config.DIFY_RETRIES}): {ex}")
+                time.sleep(_backoff(attempt))
+                continue
+            raise Exception(f"An error occurred: {str(ex)}") from ex
 
-    except requests.exceptions.HTTPError as http_err:
-        error_details = response.content.decode() if "response" in locals() and response.content else str(http_err)
-        raise Exception(f"HTTP error occurred: {error_details}") from http_err
-    except Exception as ex:
-        raise Exception(f"An error occurred: {str(ex)}") from ex
-    
-    
+
+def stream_dify(endpoint, api_key, **kwargs):
+    args = _request_args(api_key, STREAMING, kwargs)
+    streaming_callback = kwargs.get("streaming_callback", None)
+    for attempt in range(config.DIFY_RETRIES + 1):
+        started = False
+        try:
+            with _client_semaphore, _client.stream("POST", endpoint, **args) as response:
+                if response.is_error:
+                    _check_response(response, response.read())
+                context = {}
+                for event in parse_sse(response.iter_lines()):
+                    started = True
+                    if streaming_callback:
+                        try:
+                            streaming_callback(event, context)
+                        except Exception as cb_err:
+                            logger.error(str(cb_err))
+                    else:
+                        yield event
+            return
+        except GeneratorExit:
+            raise
+        except Exception as ex:
+            # once events were delivered the run can not be retried without duplicating them
+            if not started and _is_retryable(ex) and attempt < config.DIFY_RETRIES:
+                logger.warning(f"dify stream failed, retrying ({attempt + 1}/{config.DIFY_RETRIES}): {ex}")
+                time.sleep(_backoff(attempt))
+                continue
+            raise Exception(f"An error occurred: {str(ex)}") from ex
+
+
+def _get_async_state():
+    # the clients of the closed loops ( the loop of a finished celery task ... ) are dropped, their connections died with the loop
+    loop = asyncio.get_running_loop()
+    with _async_states_lock:
+        for closed_loop in [other for other in _async_states if other.is_closed()]:
+            del _async_states[closed_loop]
+        if loop not in _async_states:
+            _async_states[loop] = (httpx.AsyncClient(limits=_limits), asyncio.Semaphore(config.DIFY_MAX_CONCURRENCY))
+        return _async_states[loop]
+
+
+async def aclose():
+    # closes the client of the running loop
+    with _async_states_lock:
+        state = _async_states.pop(asyncio.get_running_loop(), None)
+    if state is not None:
+        await state[0].aclose()
+
+
+async def acall_dify(endpoint, api_key, **kwargs):
+    """
+    The non blocking call_dify, for the routers
+    """
+    args = _request_args(api_key, BLOCKING, kwargs)
+    client, semaphore = _get_async_state()
+    for attempt in range(config.DIFY_RETRIES + 1):
+        try:
+            async with semaphore:
+                response = await client.post(endpoint, **args)
+            _check_response(response, response.content)
+            return response.json()
+        except Exception as ex:
+            if _is_retryable(ex) and attempt < config.DIFY_RETRIES:
+                logger.warning(f"dify call failed, retrying ({attempt + 1}/{config.DIFY_RETRIES}): {ex}")
+                await asyncio.sleep(_backoff(attempt))
+                continue
+            raise Exception(f"An error occurred: {str(ex)}") from ex
+
+
+async def astream_dify(endpoint, api_key, **kwargs):
+    """
+    The non blocking stream_dify, for the routers : an async iterator of SSEEvent
+    """
+    args = _request_args(api_key, STREAMING, kwargs)
+    client, semaphore = _get_async_state()
+    for attempt in range(config.DIFY_RETRIES + 1):
+        started = False
+        try:
+            async with semaphore, client.stream("POST", endpoint, **args) as response:
+                if response.is_error:
+                    _check_response(response, await response.aread())
+                parser = _AsyncSSEParser()
+                async for line in response.aiter_lines():
+                    for event in parser.feed(line):
+                        started = True
+                        yield event
+                for event in parser.close():
+                    yield event
+            return
+        except (GeneratorExit, asyncio.CancelledError):
+            raise
+        except Exception as ex:
+            if not started and _is_retryable(ex) and attempt < config.DIFY_RETRIES:
+                logger.warning(f"dify stream failed, retrying ({attempt + 1}/{config.DIFY_RETRIES}): {ex}")
+                await asyncio.sleep(_backoff(attempt))
+                continue
+            raise Exception(f"An error occurred: {str(ex)}") from ex
 
 
 EVENT_WORKFLOW_STARTED = "workflow_started"
@@ -105,4 +236,3 @@ EVENT_WORKFLOW_FINISHED = "workflow_finished"
 EVENT_NODE_STARTED = "node_started"
 EVENT_NODE_FINISHED = "node_finished"
 
-
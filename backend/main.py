@@ -18,6 +18,7 @@ from routers.auth import router as auth_router
 from source_type_manager import setup_source_types
 from util.module_discover import ModuleContext, ModuleRegistry
 import database
+import dify
 
 setup_logging()
 
@@ -29,6 +30,7 @@ async def lifespan(app: FastAPI):
     await database.startup(app)
     yield
     await database.shutdown(app)
+    await dify.aclose()
     
 
 app = FastAPI(
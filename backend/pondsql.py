@@ -1,10 +1,10 @@
 import os
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
 import pymongo
 import duckdb
 import argparse
-from typing import List
+from typing import List, Optional
 import boto3
 from botocore.exceptions import NoCredentialsError
 from dotenv import load_dotenv
@@ -13,17 +13,31 @@ import pandas as pd
 import datetime
 import time
 import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import io
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from urllib.parse import unquote
 import json
 import traceback
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi.encoders import jsonable_encoder
+from contextlib import asynccontextmanager
+import hashlib
+import base64
+import re
+import uuid
+import heapq
+import redis
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from collections import OrderedDict
 from bson import ObjectId
 
 from config import config
 import s3_api
+from source_types._materialize import materialize_tables, quote_identifier, quote_literal, timed, touch_artifacts
+from util.source_access import add_access_counts, get_pinned_sources, pin_source, unpin_source, get_hot_sources
 
 def setup_logger():
     logger = logging.getLogger("default_logger")
@@ -57,43 +71,234 @@ _global_schema_mongodb_connection_string = config.MONGODB_CONNECTION_STRING
 _global_schema_mongodb_database = config.MONGODB_DATABASE_NAME
 _global_schema_mongodb_collection = config.SCHEMA_COLLECTION_NAME
 _global_pondsql_port = 8456
-_global_database_timeout = 3600
-_global_database_cache = {}
+_global_database_timeout = config.PONDSQL_IDLE_TIMEOUT
+_global_memory_budget = config.PONDSQL_MEMORY_BUDGET_MB * 1024 * 1024
+_global_eviction_policy = config.PONDSQL_EVICTION_POLICY
+_global_eviction_interval = config.PONDSQL_EVICTION_INTERVAL
+_global_database_cache = {}  # source_doc_id -> {"conn", "version", "loaded_at", "last_access", "hits", "size", "inflight"}
+_retired_connections = {}  # id(conn) -> cache entry of a replaced source version, closed by the last release()
+_schema_collection = None
 _cache_lock = threading.Lock()
+_global_query_workers = config.PONDSQL_QUERY_WORKERS
+_global_source_concurrency = config.PONDSQL_SOURCE_CONCURRENCY
+_query_executor = ThreadPoolExecutor(max_workers=_global_query_workers, thread_name_prefix="pondsql-query")
+_source_semaphores = {}  # source_doc_id -> asyncio.Semaphore, only touched from the event loop
+_query_stats = {}  # source_doc_id -> {"queued": n, "running": n, "executed": n}
+_query_stats_lock = threading.Lock()
+_global_max_result_rows = config.PONDSQL_MAX_RESULT_ROWS
+_global_stream_chunk_rows = config.PONDSQL_STREAM_CHUNK_ROWS
+_global_result_cache_bytes = config.PONDSQL_RESULT_CACHE_MB * 1024 * 1024
+_global_result_cache_ttl = config.PONDSQL_RESULT_CACHE_TTL
+_result_cache = OrderedDict()  # key -> {"source_doc_id", "body", "headers"}, least recently used first
+_result_cache_size = 0
+_result_cache_lock = threading.Lock()
+_result_cache_redis = redis.StrictRedis.from_url(config.REDIS_CONNECTION_STRING) if config.PONDSQL_RESULT_CACHE_REDIS else None
+_global_failed_load_ttl = config.PONDSQL_FAILED_LOAD_TTL
+_load_states = {}  # source_doc_id -> {"state": loading | ready | failed, "error": str, "updated_at": datetime}
+_loading_tasks = {}  # source_doc_id -> asyncio.Future of the in-progress load, only touched from the event loop
+_global_query_timeout = config.PONDSQL_QUERY_TIMEOUT
+_global_source_memory_limit = config.PONDSQL_SOURCE_MEMORY_LIMIT
+_global_source_threads = config.PONDSQL_SOURCE_THREADS
+_running_queries = {}  # query_id -> ticket of a queued or running query
+_running_queries_lock = threading.Lock()
+_global_prewarm_top_k = config.PONDSQL_PREWARM_TOP_K
+_global_prewarm_concurrency = config.PONDSQL_PREWARM_CONCURRENCY
+_global_prewarm_on_startup = True  # off for the workers of pondsql_router.py, the router pre-warms each worker with its own sources
+_access_counts = {}  # source_doc_id -> queries not yet added to the access counts in redis, guarded by _cache_lock
+_pinned_sources = set()  # synced from redis, pinned sources are never evicted, guarded by _cache_lock
+_redis = None
+_global_profile_slowest = config.PONDSQL_PROFILE_SLOWEST
+_global_profile_min_seconds = config.PONDSQL_PROFILE_MIN_SECONDS
+_slowest_queries = []  # min heap of (seconds, query_id, profile) of the PONDSQL_PROFILE_SLOWEST slowest queries
+_slowest_queries_lock = threading.Lock()
+
+_metric_load_seconds = Histogram("pondsql_load_seconds", "Seconds spent loading a source, per phase (s3, parse, register, total)", ["phase"],
+                                 buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+_metric_load_failures = Counter("pondsql_load_failures_total", "Sources that failed to load")
+_metric_cache_requests = Counter("pondsql_cache_requests_total", "Lookups of the database and result caches", ["cache", "outcome"])
+_metric_evictions = Counter("pondsql_evictions_total", "Sources unloaded from memory", ["reason"])
+_metric_source_memory = Gauge("pondsql_source_memory_bytes", "Memory held by a loaded source", ["source_doc_id"])
+_metric_memory_budget = Gauge("pondsql_memory_budget_bytes", "PONDSQL_MEMORY_BUDGET_MB in bytes")
+_metric_queries = Gauge("pondsql_queries", "Queries waiting for a slot (queued) and executing (running)", ["state"])
+_metric_query_seconds = Histogram("pondsql_query_seconds", "Wall clock seconds of a query, waiting for its slot included", ["source_doc_id", "status"],
+                                  buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+_metric_query_rows = Histogram("pondsql_query_rows", "Rows returned by a query", ["source_doc_id"],
+                               buckets=(0, 1, 10, 100, 1000, 10000, 100000, 1000000))
+_metric_memory_budget.set(_global_memory_budget)
 
 load_dotenv()
 app = FastAPI()
 
-def unload_inactive_databases():
-    global _global_database_cache
+def measure_database_size(conn):
+    # every source has its own in-memory duckdb database, so duckdb_memory() is the memory held by this source
+    cursor = conn.cursor()
+    try:
+        return cursor.execute("SELECT coalesce(sum(memory_usage_bytes), 0) FROM duckdb_memory()").fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def _eviction_order(item):
+    source, entry = item
+    if _global_eviction_policy == "lfu":
+        return (entry["hits"], entry["last_access"])
+    return entry["last_access"]
+
+
+def evict_databases():
+    """
+    Unload sources until the memory held by all sources fits PONDSQL_MEMORY_BUDGET_MB,
+    least recently (lru) or least frequently (lfu) used first, plus the sources idle longer than PONDSQL_IDLE_TIMEOUT.
+    Sources with queries in flight are never evicted, they are picked up by the next round.
+    """
+    with _cache_lock:
+        entries = list(_global_database_cache.items())
+    for source, entry in entries:
+        try:
+            entry["size"] = measure_database_size(entry["conn"])
+            _metric_source_memory.labels(source).set(entry["size"])
+        except Exception as e:
+            logger.error(f"failed to measure memory of database {source}: {e}")
+
+    current_time = datetime.datetime.now()
+    to_close = []
+    with _cache_lock:
+        candidates = sorted(((source, entry) for source, entry in _global_database_cache.items()
+                             if entry["inflight"] == 0 and source not in _pinned_sources), key=_eviction_order)
+        used = sum(entry["size"] for entry in _global_database_cache.values())
+        for source, entry in candidates:
+            idle = (current_time - entry["last_access"]).total_seconds()
+            if used > _global_memory_budget:
+                reason, metric_reason = f"memory budget ({used} > {_global_memory_budget} bytes)", "memory"
+            elif _global_database_timeout > 0 and idle > _global_database_timeout:
+                reason, metric_reason = f"idle for {int(idle)} seconds", "idle"
+            else:
+                continue
+            logger.info(f"unloading database {source} ({entry['size']} bytes) due to {reason}")
+            _metric_evictions.labels(metric_reason).inc()
+            forget_source_metrics(source)
+            used -= entry["size"]
+            del _global_database_cache[source]
+            _load_states.pop(source, None)
+            to_close.append((source, entry["conn"]))
+    for source, conn in to_close:
+        conn.close()
+        logger.info(f"unloaded database {source}")
+
+
+def forget_source_metrics(source_doc_id):
+    try:
+        _metric_source_memory.remove(source_doc_id)
+    except KeyError:
+        pass
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(config.REDIS_CONNECTION_STRING, decode_responses=True)
+    return _redis
+
+
+def sync_source_access():
+    # flush the local access counts to redis, and pick up the pins made through any PondSQL worker
+    with _cache_lock:
+        counts = dict(_access_counts)
+        _access_counts.clear()
+    try:
+        add_access_counts(get_redis(), counts)
+        pinned = get_pinned_sources(get_redis())
+    except Exception as e:
+        logger.error(f"failed to sync source access with redis: {e}")
+        with _cache_lock:
+            for source, count in counts.items():
+                _access_counts[source] = _access_counts.get(source, 0) + count
+        return
+    with _cache_lock:
+        _pinned_sources.clear()
+        _pinned_sources.update(pinned)
+
+
+def evict_databases_periodically():
     while True:
         try:
-            current_time = datetime.datetime.now()
-            to_remove = []
-            for source, (conn, last_access_time) in _global_database_cache.items():
-                if (current_time - last_access_time).total_seconds() > _global_database_timeout:
-                    logger.info(f"unloading database {source} due to timeout")
-                    to_remove.append(source)
-            for source in to_remove:
-                with _cache_lock:
-                    conn = _global_database_cache[source][0]
-                    conn.close() 
-                    del _global_database_cache[source]
-                    logger.info(f"unloaded database {source} due to timeout")
-            time.sleep(60*5) 
+            sync_source_access()
+            evict_databases()
+            # the views of the loaded sources scan their parquet artifacts, keep them in the materialize cache
+            with _cache_lock:
+                paths = [path for entry in _global_database_cache.values() for path in entry.get("paths", [])]
+            touch_artifacts(paths)
         except Exception as e:
             logger.error(f"Error in cleanup thread: {e}")
+        time.sleep(_global_eviction_interval)
 
-cleanup_thread = threading.Thread(target=unload_inactive_databases, daemon=True)
+cleanup_thread = threading.Thread(target=evict_databases_periodically, daemon=True)
 cleanup_thread.start()
 
+
+def interrupt_query(ticket, status):
+    """
+    Stops a queued or running query, status is "timeout", "cancelled" (the client went away) or "killed" (by an admin).
+    Returns False when the query already finished.
+    """
+    with _running_queries_lock:
+        if ticket["status"] not in ("queued", "running"):
+            return False
+        ticket["status"] = status
+        cursor = ticket["cursor"]
+    if cursor is not None:
+        try:
+            cursor.interrupt()
+        except Exception as e:  # the query finished in the meantime
+            logger.info(f"failed to interrupt query {ticket['query_id']}: {e}")
+    logger.info(f"query {ticket['query_id']} on {ticket['source_doc_id']} stopped : {status}")
+    return True
+
+
+def interrupt_expired_queries_periodically():
+    while True:
+        try:
+            now = time.monotonic()
+            with _running_queries_lock:
+                expired = [ticket for ticket in _running_queries.values()
+                           if ticket["deadline"] is not None and now > ticket["deadline"] and ticket["status"] in ("queued", "running")]
+            for ticket in expired:
+                interrupt_query(ticket, "timeout")
+        except Exception as e:
+            logger.error(f"Error in timeout thread: {e}")
+        time.sleep(0.5)
+
+timeout_thread = threading.Thread(target=interrupt_expired_queries_periodically, daemon=True)
+timeout_thread.start()
+
+
+def apply_limits(conn, limits):
+    # memory_limit and threads are settings of a duckdb database, and every source has its own database
+    if limits.get("memory_limit"):
+        conn.execute(f"SET memory_limit = {quote_literal(str(limits['memory_limit']))}")
+    if limits.get("threads"):
+        conn.execute(f"SET threads = {int(limits['threads'])}")
+
+def get_schema_collection():
+    global _schema_collection
+    if _schema_collection is None:
+        client = pymongo.MongoClient(_global_schema_mongodb_connection_string)  # thread safe, shared by every load
+        _schema_collection = client[_global_schema_mongodb_database][_global_schema_mongodb_collection]
+    return _schema_collection
+
+
+def get_source_version(source_doc_id):
+    # update_source gives the schema doc a new _version, so results and connections of the previous version are never served again
+    doc = get_schema_collection().find_one({"_id": ObjectId(source_doc_id)}, {"_version": 1})
+    if not doc:
+        raise Exception(f"database {source_doc_id} not found")
+    return doc.get("_version", "")
+
+
 def load_source(source_doc_id):
-    global _global_database_cache
     logger.info(f"loading database {source_doc_id} to memory")
 
-    client = pymongo.MongoClient(_global_schema_mongodb_connection_string)
-    db = client[_global_schema_mongodb_database]
-    collection = db[_global_schema_mongodb_collection]
+    collection = get_schema_collection()
 
     # database_schema = collection.find_one({DATABASE_NAME: source})
     database_schema = collection.find_one({"_id": ObjectId(source_doc_id)})  # Now we start to use source_doc_id
@@ -108,46 +313,277 @@ def load_source(source_doc_id):
     
     logger.info('creating duckdb connection')
     conn = duckdb.connect(":memory:")
-    
-    loaded_excel_file = {}
-    for table_schema in database_schema["tables"]:
-        table_name = table_schema["table_name"]
-        file_type = table_schema["file_type"]
-        original_file = table_schema["original_file"]
-        object_name = table_schema["object_name"]
-        sheet_name = table_schema["sheet_name"]
-        media_type = table_schema["media_type"]
-        
-        logger.info(f"table_name = {table_name}")
-        logger.info(f"file_type = {file_type}")
-        logger.info(f"original_file = {original_file}")
-        logger.info(f"object_name = {object_name}")
-        logger.info(f"sheet_name = {sheet_name}")
-        logger.info(f"media_type = {media_type}")
-
-        if object_name not in loaded_excel_file:
-            logger.info(f"downloading object : {object_name}")
-            downloaded = s3_api.download_fileobj(object_name, media_type)
-            loaded_excel_file[object_name] = downloaded
-        else:
-            logger.info(f"fetching cached object : {object_name}")
-            downloaded = loaded_excel_file[object_name]
-        
-        file_obj = downloaded["file_obj"]
-        file_obj.seek(0)
-        
-        logger.info('loading dataframes ...')
-        filename_safe = downloaded["filename_safe"].lower()
-        if filename_safe.endswith('.csv'):
-            df = pd.read_csv(file_obj)
-        elif filename_safe.endswith('.xlsx'):
-            df = pd.read_excel(file_obj, sheet_name = sheet_name, engine='openpyxl')
-        df = df.convert_dtypes() # try to detect data types
-        logger.info(f'registering table {table_name} {df.shape}')
-        conn.register(table_name, df)
-    
+    try:
+        # PONDSQL_SOURCE_MEMORY_LIMIT / PONDSQL_SOURCE_THREADS, overridden by the _limits of the schema doc
+        apply_limits(conn, {"memory_limit": _global_source_memory_limit, "threads": _global_source_threads, **database_schema.get("_limits", {})})
+        # Tables are scanned from their parquet artifacts ( see source_types/_materialize.py ),
+        # the Excel / CSV file is only parsed when a table was never materialized before.
+        timings = {}
+        paths = materialize_tables(database_schema["tables"], timings)
+        with timed(timings, "register"):
+            for table_schema in database_schema["tables"]:
+                table_name = table_schema["table_name"]
+                object_name = table_schema["object_name"]
+                sheet_name = table_schema["sheet_name"]
+                path = paths[(object_name, sheet_name)]
+                logger.info(f"registering table {table_name} from {object_name} [{sheet_name}] : {path}")
+                conn.execute(f"CREATE VIEW {quote_identifier(table_name)} AS SELECT * FROM read_parquet({quote_literal(path)})")
+    except Exception:
+        conn.close()
+        raise
+    for phase, seconds in timings.items():
+        _metric_load_seconds.labels(phase).observe(seconds)
+    logger.info(f"loaded database {source_doc_id} : " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()))
+    return conn, database_schema.get("_version", ""), list(paths.values())
+
+
+def _touch(source_doc_id):
+    # callers hold _cache_lock. The in-flight count keeps the connection away from eviction until release() is called
+    entry = _global_database_cache[source_doc_id]
+    entry["last_access"] = datetime.datetime.now()
+    entry["hits"] += 1
+    entry["inflight"] += 1
+    _access_counts[source_doc_id] = _access_counts.get(source_doc_id, 0) + 1
+    return entry["conn"]
+
+
+def _retire(source_doc_id):
+    # callers hold _cache_lock. Returns the connection to close, or None when queries are still running on it
+    entry = _global_database_cache.pop(source_doc_id)
+    _load_states.pop(source_doc_id, None)
+    _metric_evictions.labels("version").inc()
+    forget_source_metrics(source_doc_id)
+    if entry["inflight"] > 0:
+        _retired_connections[id(entry["conn"])] = entry
+        return None
+    return entry["conn"]
+
+
+def release(source_doc_id, conn):
+    to_close = None
     with _cache_lock:
-        _global_database_cache[source_doc_id] = (conn, datetime.datetime.now())
+        entry = _global_database_cache.get(source_doc_id)
+        if entry and entry["conn"] is conn:
+            entry["inflight"] -= 1
+        elif id(conn) in _retired_connections:
+            entry = _retired_connections[id(conn)]
+            entry["inflight"] -= 1
+            if entry["inflight"] == 0:
+                del _retired_connections[id(conn)]
+                to_close = conn
+    if to_close is not None:
+        to_close.close()
+        logger.info(f"closed the connection of a previous version of {source_doc_id}")
+
+
+def _set_load_state(source_doc_id, state, error=None):
+    with _cache_lock:
+        _load_states[source_doc_id] = {"state": state, "error": error, "updated_at": datetime.datetime.now()}
+
+
+async def get_connection(source_doc_id, version = None, attempts = 2):
+    """
+    Returns the connection of a source, loading it when it is not in memory or loaded from another version of the schema doc.
+    Call release() when done with it.
+    Concurrent callers of the same source share ONE load (single flight), and a source that failed to load
+    is not retried until PONDSQL_FAILED_LOAD_TTL seconds passed, the callers get the last error instead.
+    """
+    for attempt in range(attempts):
+        to_close = None
+        with _cache_lock:
+            if source_doc_id in _global_database_cache:
+                if version is None or _global_database_cache[source_doc_id]["version"] == version:
+                    if attempt == 0:
+                        _metric_cache_requests.labels("database", "hit").inc()
+                    return _touch(source_doc_id)
+                logger.info(f"database {source_doc_id} changed, unloading the previous version")
+                to_close = _retire(source_doc_id)
+            state = _load_states.get(source_doc_id)
+        if to_close is not None:
+            to_close.close()
+        result_cache_purge(source_doc_id)
+        if attempt == 0:
+            _metric_cache_requests.labels("database", "miss").inc()
+        if state and state["state"] == "failed" and source_doc_id not in _loading_tasks:
+            if (datetime.datetime.now() - state["updated_at"]).total_seconds() < _global_failed_load_ttl:
+                raise Exception(f"database {source_doc_id} failed to load recently: {state['error']}")
+
+        is_loader = source_doc_id not in _loading_tasks
+        if is_loader:
+            logger.info(f"loading {source_doc_id} since its not in memory")
+            _set_load_state(source_doc_id, "loading")
+            _loading_tasks[source_doc_id] = asyncio.ensure_future(_load(source_doc_id))
+        else:
+            logger.info(f"waiting for the in-progress loading of {source_doc_id}")
+        # shield : a cancelled caller (client disconnected) must not cancel the load other callers are waiting for
+        await asyncio.shield(_loading_tasks[source_doc_id])
+        with _cache_lock:
+            conn = _touch(source_doc_id) if source_doc_id in _global_database_cache else None
+        if conn is not None:
+            if is_loader:
+                # make room for the new source, it is protected by our in-flight reference
+                asyncio.get_running_loop().run_in_executor(_query_executor, evict_databases)
+            return conn
+        # evicted before we got it (memory pressure), try again
+    raise Exception(f"database {source_doc_id} could not be kept in memory")
+
+
+async def _load(source_doc_id):
+    try:
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        conn, version, paths = await loop.run_in_executor(_query_executor, load_source, source_doc_id)
+        size = await loop.run_in_executor(_query_executor, measure_database_size, conn)
+        _metric_load_seconds.labels("total").observe(time.perf_counter() - started)
+        _metric_source_memory.labels(source_doc_id).set(size)
+        now = datetime.datetime.now()
+        with _cache_lock:
+            _global_database_cache[source_doc_id] = {"conn": conn, "version": version, "loaded_at": now, "last_access": now, "hits": 0, "size": size, "inflight": 0, "paths": paths}
+        _set_load_state(source_doc_id, "ready")
+    except Exception as e:
+        logger.error(f"Error loading {source_doc_id}: {e}")
+        logger.error(traceback.format_exc())
+        _set_load_state(source_doc_id, "failed", str(e))
+        _metric_load_failures.inc()
+        raise
+    finally:
+        _loading_tasks.pop(source_doc_id, None)
+
+
+_NON_DETERMINISTIC = re.compile(r"\b(random|uuid|gen_random_uuid|now|today|current_date|current_time|current_timestamp)\b", re.IGNORECASE)
+
+
+_QUERY_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|--[^\n]*|/\*.*?\*/)""", re.S)
+
+
+def normalize_query(query):
+    # drop the comments, collapse whitespace outside of string literals and quoted identifiers, and drop trailing semicolons.
+    # The comments go first : a -- comment ends at the newline the collapsing removes
+    parts = _QUERY_TOKENS.split(query)
+    for i in range(1, len(parts), 2):
+        if parts[i].startswith(("--", "/*")):
+            parts[i] = " "
+    parts = _QUERY_TOKENS.split("".join(parts))
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\s+", " ", parts[i])
+    return "".join(parts).strip().rstrip(';').strip()
+
+
+def is_cacheable(query):
+    query = normalize_query(query)
+    return query.lower().startswith(_SELECT_PREFIXES) and not _NON_DETERMINISTIC.search(query)
+
+
+def result_cache_key(source_doc_id, version, query, offset, limit):
+    digest = hashlib.sha1(f"{version}\n{offset}\n{limit}\n{normalize_query(query)}".encode('utf8')).hexdigest()
+    return f"pondsql:result:{source_doc_id}:{digest}"
+
+
+def result_cache_get(key):
+    if _global_result_cache_bytes <= 0:
+        return None
+    with _result_cache_lock:
+        if key in _result_cache:
+            _result_cache.move_to_end(key)
+            return _result_cache[key]
+    if _result_cache_redis is not None:
+        try:
+            data = _result_cache_redis.get(key)
+        except Exception as e:
+            logger.error(f"failed to read result cache from redis: {e}")
+            data = None
+        if data:
+            cached = json.loads(data)
+            entry = {"source_doc_id": cached["source_doc_id"], "body": cached["body"].encode('utf8'), "headers": cached["headers"]}
+            _result_cache_put_local(key, entry)
+            return entry
+    return None
+
+
+def _result_cache_put_local(key, entry):
+    global _result_cache_size
+    size = len(entry["body"])
+    if size > _global_result_cache_bytes // 10:  # one result may take at most 10% of the cache
+        return False
+    with _result_cache_lock:
+        if key in _result_cache:
+            _result_cache_size -= len(_result_cache.pop(key)["body"])
+        _result_cache[key] = entry
+        _result_cache_size += size
+        while _result_cache_size > _global_result_cache_bytes:
+            _, evicted = _result_cache.popitem(last=False)
+            _result_cache_size -= len(evicted["body"])
+    return True
+
+
+def result_cache_put(key, entry):
+    if _global_result_cache_bytes <= 0:
+        return
+    if not _result_cache_put_local(key, entry):
+        return
+    if _result_cache_redis is not None:
+        try:
+            data = json.dumps({"source_doc_id": entry["source_doc_id"], "body": entry["body"].decode('utf8'), "headers": entry["headers"]})
+            _result_cache_redis.setex(key, _global_result_cache_ttl, data)
+        except Exception as e:
+            logger.error(f"failed to write result cache to redis: {e}")
+
+
+def result_cache_purge(source_doc_id):
+    # results of other versions can never be hit again (the version is part of the key), free their memory now
+    global _result_cache_size
+    with _result_cache_lock:
+        for key in [key for key, entry in _result_cache.items() if entry["source_doc_id"] == source_doc_id]:
+            _result_cache_size -= len(_result_cache.pop(key)["body"])
+
+
+async def prewarm(source_doc_ids):
+    """
+    Load the sources in the background, PONDSQL_PREWARM_CONCURRENCY at a time, so their first queries do not pay for the load.
+    Sources that are not pinned are skipped once the memory budget is used up, instead of evicting hotter ones.
+    """
+    semaphore = asyncio.Semaphore(_global_prewarm_concurrency)
+
+    async def warm(source_doc_id):
+        async with semaphore:
+            with _cache_lock:
+                if source_doc_id in _global_database_cache:
+                    return
+                used = sum(entry["size"] for entry in _global_database_cache.values())
+                pinned = source_doc_id in _pinned_sources
+            if used >= _global_memory_budget and not pinned:
+                logger.info(f"skip pre-warming {source_doc_id}, memory budget used up")
+                return
+            try:
+                conn = await get_connection(source_doc_id)
+                with _cache_lock:
+                    _access_counts.pop(source_doc_id, None)  # a pre-warm is not an access
+                    if source_doc_id in _global_database_cache:
+                        _global_database_cache[source_doc_id]["hits"] -= 1
+                release(source_doc_id, conn)
+                logger.info(f"pre-warmed {source_doc_id}")
+            except Exception as e:
+                logger.error(f"failed to pre-warm {source_doc_id}: {e}")
+
+    await asyncio.gather(*[warm(source_doc_id) for source_doc_id in source_doc_ids])
+
+
+async def prewarm_hot_sources():
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(_query_executor, sync_source_access)
+        source_doc_ids = await loop.run_in_executor(_query_executor, get_hot_sources, get_redis(), _global_prewarm_top_k)
+    except Exception as e:
+        logger.error(f"failed to get the sources to pre-warm: {e}")
+        return
+    logger.info(f"pre-warming {len(source_doc_ids)} sources")
+    await prewarm(source_doc_ids)
+
+
+@app.on_event("startup")
+async def startup():
+    if _global_prewarm_on_startup:
+        asyncio.ensure_future(prewarm_hot_sources())
 
 
 # This is to ensure the error message is returned to the client (e.g. LLM, so that it can react to the error)
@@ -168,35 +604,580 @@ async def global_exception_handler(request, exc):
 class QueryRequest(BaseModel):
     source_doc_id: str
     query: str
+    format: str = "json"  # json : one JSON array | ndjson : one JSON object per line | arrow : Arrow IPC stream
+    max_rows: Optional[int] = None  # page size, never more than PONDSQL_MAX_RESULT_ROWS
+    page_token: Optional[str] = None  # next_page_token of the previous page
+    timeout: Optional[float] = None  # seconds, never more than PONDSQL_QUERY_TIMEOUT
+
+
+_SELECT_PREFIXES = ("select", "with", "from", "values", "(")
+
+
+def paginate_query(query, offset, limit):
+    """
+    Wraps SELECT statements so that DuckDB only produces the requested page plus one row (to know if there are more),
+    other statements (SHOW, DESCRIBE, PRAGMA ...) run as they are and the rows before the page are skipped while fetching.
+    Returns (sql, rows_to_skip)
+    """
+    query = query.strip().rstrip(';').strip()
+    if query.lower().startswith(_SELECT_PREFIXES):
+        # the newline ends a trailing -- comment, which would comment out the closing parenthesis
+        return f"SELECT * FROM ({query}\n) AS _pondsql_page LIMIT {limit + 1} OFFSET {offset}", 0
+    return query, offset
+
+
+def _query_fingerprint(query):
+    return hashlib.sha1(query.strip().rstrip(';').strip().encode('utf8')).hexdigest()[:16]
+
+
+def encode_page_token(query, offset):
+    token = json.dumps({"q": _query_fingerprint(query), "o": offset})
+    return base64.urlsafe_b64encode(token.encode('utf8')).decode('utf8')
+
+
+def decode_page_token(query, page_token):
+    try:
+        token = json.loads(base64.urlsafe_b64decode(page_token.encode('utf8')))
+        offset = int(token["o"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid page_token")
+    if token.get("q") != _query_fingerprint(query):
+        raise HTTPException(status_code=400, detail="page_token does not belong to this query")
+    return offset
+
+
+def page_info(query, offset, rows, truncated):
+    return {
+        "rows": rows,
+        "truncated": truncated,
+        "next_page_token": encode_page_token(query, offset + rows) if truncated else None,
+    }
+
+
+def _update_query_stats(source_doc_id, **deltas):
+    with _query_stats_lock:
+        stats = _query_stats.setdefault(source_doc_id, {"queued": 0, "running": 0, "executed": 0})
+        for key, delta in deltas.items():
+            stats[key] += delta
+
+
+def _dequeue(source_doc_id, ticket, **deltas):
+    # a queued query leaves the queue exactly once : either picked up by a worker, or abandoned by its caller
+    with _query_stats_lock:
+        if ticket["dequeued"]:
+            return False
+        ticket["dequeued"] = True
+        stats = _query_stats[source_doc_id]
+        stats["queued"] -= 1
+        for key, delta in deltas.items():
+            stats[key] += delta
+        return True
+
+
+def new_ticket(source_doc_id, query, timeout, kind="query"):
+    return {
+        "query_id": uuid.uuid4().hex,
+        "kind": kind,  # query | profile ( the EXPLAIN ANALYZE of a slow query, not counted in the query metrics )
+        "created": time.monotonic(),
+        "rows": 0,
+        "source_doc_id": source_doc_id,
+        "query": query,
+        "timeout": timeout,
+        "deadline": time.monotonic() + timeout if timeout else None,  # wall clock, the time waiting for a slot included
+        "status": "queued",  # queued | running | done | timeout | cancelled | killed
+        "queued_at": datetime.datetime.now(),
+        "started_at": None,
+        "cursor": None,
+        "dequeued": False,
+    }
+
+
+_INTERRUPTED_ERRORS = {
+    "timeout": (408, "Query exceeded its timeout of {timeout} seconds"),
+    "cancelled": (499, "Query cancelled, the client closed the request"),
+    "killed": (409, "Query killed by an administrator"),
+}
+
+
+def query_interrupted(ticket):
+    status_code, detail = _INTERRUPTED_ERRORS.get(ticket["status"], (500, "Query interrupted"))
+    return HTTPException(status_code=status_code, detail=detail.format(timeout=ticket["timeout"]))
+
+
+def _interruptible(ticket, fn, *args):
+    try:
+        return fn(*args)
+    except duckdb.InterruptException:
+        raise query_interrupted(ticket)
+
+
+@asynccontextmanager
+async def query_slot(ticket):
+    """
+    Waits until the source has a free query slot ( PONDSQL_SOURCE_CONCURRENCY ), the ticket is listed in /admin/queries/ meanwhile
+    """
+    source_doc_id = ticket["source_doc_id"]
+    if source_doc_id not in _source_semaphores:
+        _source_semaphores[source_doc_id] = asyncio.Semaphore(_global_source_concurrency)
+    with _running_queries_lock:
+        _running_queries[ticket["query_id"]] = ticket
+    _update_query_stats(source_doc_id, queued=1)
+    failed = False
+    try:
+        async with _source_semaphores[source_doc_id]:
+            yield ticket
+    except asyncio.CancelledError:
+        # a streaming response is cancelled when its client disconnects, the worker thread must not keep scanning
+        interrupt_query(ticket, "cancelled")
+        raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        with _running_queries_lock:
+            _running_queries.pop(ticket["query_id"], None)
+        if not _dequeue(source_doc_id, ticket):
+            _update_query_stats(source_doc_id, running=-1, executed=1)
+        record_query(ticket, failed)
+
+
+def record_query(ticket, failed):
+    if ticket["kind"] != "query":
+        return
+    status = ticket["status"] if ticket["status"] in ("timeout", "cancelled", "killed") else ("error" if failed else "done")
+    seconds = time.monotonic() - ticket["created"]
+    _metric_query_seconds.labels(ticket["source_doc_id"], status).observe(seconds)
+    if status == "done":
+        _metric_query_rows.labels(ticket["source_doc_id"]).observe(ticket["rows"])
+        if is_profile_candidate(seconds):
+            asyncio.ensure_future(profile_query(ticket, seconds))
+
+
+def is_profile_candidate(seconds):
+    if _global_profile_slowest <= 0 or seconds < _global_profile_min_seconds:
+        return False
+    with _slowest_queries_lock:
+        return len(_slowest_queries) < _global_profile_slowest or seconds > _slowest_queries[0][0]
+
+
+def explain_analyze(conn, ticket):
+    open_cursor(conn, ticket, 0, 0)
+    try:
+        rows = _interruptible(ticket, ticket["cursor"].fetchall)
+        return "\n".join(str(row[-1]) for row in rows)
+    finally:
+        close_cursor(ticket)
+
+
+async def profile_query(ticket, seconds):
+    """
+    Keep the EXPLAIN ANALYZE plan of one of the PONDSQL_PROFILE_SLOWEST slowest queries.
+    The query runs a second time for it, which is why profiling is opt-in and limited to read only statements.
+    """
+    if not normalize_query(ticket["query"]).lower().startswith(_SELECT_PREFIXES):
+        return
+    # the query as it ran : its comments are kept, the newline ends a trailing -- comment
+    query = ticket["query"].strip().rstrip(';').strip()
+    source_doc_id = ticket["source_doc_id"]
+    profile_ticket = new_ticket(source_doc_id, f"EXPLAIN ANALYZE {query}\n", ticket["timeout"], kind="profile")
+    try:
+        conn = await get_connection(source_doc_id)
+    except Exception as e:
+        logger.error(f"failed to profile query {ticket['query_id']}: {e}")
+        return
+    try:
+        async with query_slot(profile_ticket):
+            plan = await asyncio.get_running_loop().run_in_executor(_query_executor, explain_analyze, conn, profile_ticket)
+    except Exception as e:
+        logger.error(f"failed to profile query {ticket['query_id']}: {e}")
+        return
+    finally:
+        release(source_doc_id, conn)
+    profile = {
+        "query_id": ticket["query_id"],
+        "source_doc_id": source_doc_id,
+        "query": ticket["query"],
+        "seconds": seconds,
+        "rows": ticket["rows"],
+        "finished_at": datetime.datetime.now().isoformat(),
+        "plan": plan,
+    }
+    with _slowest_queries_lock:
+        if len(_slowest_queries) < _global_profile_slowest:
+            heapq.heappush(_slowest_queries, (seconds, ticket["query_id"], profile))
+        elif seconds > _slowest_queries[0][0]:
+            heapq.heapreplace(_slowest_queries, (seconds, ticket["query_id"], profile))
+    logger.info(f"profiled slow query {ticket['query_id']} ({seconds:.2f}s)")
+
+
+def open_cursor(conn, ticket, offset, limit):
+    # runs on the query worker pool, every query gets its own cursor so that queries of the same source do not share state,
+    # and one query can be interrupted without touching the others
+    if not _dequeue(ticket["source_doc_id"], ticket, running=1):
+        raise Exception("query cancelled before it started")
+    sql, skip = paginate_query(ticket["query"], offset, limit)
+    cursor = conn.cursor()
+    with _running_queries_lock:
+        started = ticket["status"] == "queued"
+        if started:
+            ticket["status"] = "running"
+            ticket["started_at"] = datetime.datetime.now()
+            ticket["cursor"] = cursor
+    if not started:  # stopped while waiting for its slot
+        cursor.close()
+        raise query_interrupted(ticket)
+    try:
+        logger.info(f'executing query {ticket["query_id"]} : {sql}')
+        _interruptible(ticket, cursor.execute, sql)
+        while skip > 0:
+            skipped = _interruptible(ticket, cursor.fetchmany, min(skip, _global_stream_chunk_rows))
+            if not skipped:
+                break
+            skip -= len(skipped)
+        return cursor
+    except Exception:
+        close_cursor(ticket)
+        raise
+
+
+def close_cursor(ticket):
+    with _running_queries_lock:
+        if ticket["status"] == "running":
+            ticket["status"] = "done"
+        cursor = ticket["cursor"]
+        ticket["cursor"] = None
+    if cursor is not None:
+        cursor.close()
+
+
+def _columns(cursor):
+    return [desc[0] for desc in cursor.description] if cursor.description else []
+
+
+def fetch_page(conn, ticket, offset, limit):
+    cursor = open_cursor(conn, ticket, offset, limit)
+    try:
+        columns = _columns(cursor)
+        rows = _interruptible(ticket, cursor.fetchmany, limit + 1)
+        ticket["rows"] = min(len(rows), limit)
+        return [dict(zip(columns, row)) for row in rows[:limit]], len(rows) > limit
+    finally:
+        close_cursor(ticket)
+
+
+async def run_query(conn, ticket, offset, limit):
+    async with query_slot(ticket):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_query_executor, fetch_page, conn, ticket, offset, limit)
+
+
+async def cancel_on_disconnect(http_request, ticket):
+    # a plain (not streaming) request handler is not cancelled when its client goes away, so watch for it here
+    while ticket["status"] in ("queued", "running"):
+        if await http_request.is_disconnected():
+            interrupt_query(ticket, "cancelled")
+            return
+        await asyncio.sleep(0.5)
+
+
+async def stream_ndjson(request, version, ticket, offset, limit):
+    loop = asyncio.get_running_loop()
+    conn = None
+    try:
+        # held from here only : a generator Starlette never starts ( the client went away ) must not keep the source in use
+        conn = await get_connection(request.source_doc_id, version)
+        async with query_slot(ticket):
+            cursor = await loop.run_in_executor(_query_executor, open_cursor, conn, ticket, offset, limit)
+            try:
+                columns = _columns(cursor)
+                sent = 0
+                truncated = False
+                while not truncated:
+                    rows = await loop.run_in_executor(_query_executor, _interruptible, ticket, cursor.fetchmany, _global_stream_chunk_rows)
+                    if not rows:
+                        break
+                    if sent + len(rows) > limit:
+                        rows = rows[:limit - sent]
+                        truncated = True
+                    sent += len(rows)
+                    records = jsonable_encoder([dict(zip(columns, row)) for row in rows])
+                    yield "".join(json.dumps(record) + "\n" for record in records)
+                ticket["rows"] = sent
+                logger.info(f'streamed result of {sent} rows')
+                yield json.dumps({"_pondsql": page_info(request.query, offset, sent, truncated)}) + "\n"
+            finally:
+                close_cursor(ticket)
+    except Exception as e:
+        # the response has already started, so the error can only be reported in the stream itself
+        logger.error(f'error streaming query {request.query}: {e}')
+        yield json.dumps({"_pondsql": {"error": str(e)}}) + "\n"
+    finally:
+        if conn is not None:
+            release(request.source_doc_id, conn)
+
+
+def _next_batch(reader):
+    try:
+        return reader.read_next_batch()
+    except StopIteration:
+        return None
+
+
+async def stream_arrow(request, version, ticket, offset, limit):
+    import pyarrow as pa
+    loop = asyncio.get_running_loop()
+    sink = io.BytesIO()
+    writer = None
+    schema = None
+    closed = False
+    def drain():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate(0)
+        return data
+    conn = None
+    try:
+        # held from here only, as in stream_ndjson
+        conn = await get_connection(request.source_doc_id, version)
+        async with query_slot(ticket):
+            cursor = await loop.run_in_executor(_query_executor, open_cursor, conn, ticket, offset, limit)
+            try:
+                reader = await loop.run_in_executor(_query_executor, _interruptible, ticket, cursor.fetch_record_batch, _global_stream_chunk_rows)
+                schema = reader.schema
+                writer = pa.ipc.new_stream(sink, schema)
+                sent = 0
+                truncated = False
+                while not truncated:
+                    batch = await loop.run_in_executor(_query_executor, _interruptible, ticket, _next_batch, reader)
+                    if batch is None:
+                        break
+                    if sent + batch.num_rows > limit:
+                        batch = batch.slice(0, limit - sent)
+                        truncated = True
+                    sent += batch.num_rows
+                    writer.write_batch(batch)
+                    yield drain()
+                # the last (empty) batch carries the page info, read it with read_next_batch_with_custom_metadata()
+                info = page_info(request.query, offset, sent, truncated)
+                empty = pa.record_batch([pa.array([], type=field.type) for field in schema], schema=schema)
+                writer.write_batch(empty, custom_metadata={"pondsql": json.dumps(info)})
+                writer.close()
+                closed = True
+                ticket["rows"] = sent
+                logger.info(f'streamed result of {sent} rows')
+                yield drain()
+            finally:
+                close_cursor(ticket)
+    except Exception as e:
+        # as stream_ndjson : the response has already started, the error is the metadata of the last (empty) batch,
+        # in a stream without columns when the query failed before its schema was known
+        logger.error(f'error streaming query {request.query}: {e}')
+        if closed:
+            return
+        if writer is None:
+            schema = pa.schema([])
+            writer = pa.ipc.new_stream(sink, schema)
+        empty = pa.record_batch([pa.array([], type=field.type) for field in schema], schema=schema)
+        writer.write_batch(empty, custom_metadata={"pondsql": json.dumps({"error": str(e)})})
+        writer.close()
+        yield drain()
+    finally:
+        if conn is not None:
+            release(request.source_doc_id, conn)
+
 
 @app.post("/query/")
-async def query(request: QueryRequest):
-    global _global_database_cache
-    if request.source_doc_id not in _global_database_cache:
-        try:
-            logger.info(f"loading {request.source_doc_id} since its not in memory")
-            load_source(request.source_doc_id)
-        except Exception as e:
-            logger.error(f"Error loading {request.source_doc_id}: {e}")
-            logger.error(traceback.format_exc())
-            raise HTTPException(status_code=404, detail="Database not found or failed to load")
-    try:
-        logger.info('updating latest access time')
-        conn = _global_database_cache[request.source_doc_id][0]
-        _global_database_cache[request.source_doc_id] = (conn, datetime.datetime.now())
-        logger.info(f'executing query {request.query}')
-        result = conn.execute(request.query).fetchall()
-        columns = [desc[0] for desc in conn.description]
-        result = [dict(zip(columns, row)) for row in result]
+async def query(request: QueryRequest, http_request: Request):
+    if request.format not in ["json", "ndjson", "arrow"]:
+        raise HTTPException(status_code=400, detail=f"Unsupported format {request.format}")
+    if request.max_rows is not None and request.max_rows <= 0:
+        raise HTTPException(status_code=400, detail="max_rows must be positive")
+    if request.timeout is not None and request.timeout <= 0:
+        raise HTTPException(status_code=400, detail="timeout must be positive")
+    limit = min(request.max_rows or _global_max_result_rows, _global_max_result_rows)
+    timeout = min([t for t in (request.timeout, _global_query_timeout) if t], default=None)
+    offset = decode_page_token(request.query, request.page_token) if request.page_token else 0
+    loop = asyncio.get_running_loop()
+    try:
+        version = await loop.run_in_executor(_query_executor, get_source_version, request.source_doc_id)
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"Database not found or failed to load: {e}")
+    cache_key = None
+    if request.format == "json" and is_cacheable(request.query):
+        cache_key = result_cache_key(request.source_doc_id, version, request.query, offset, limit)
+        cached = result_cache_get(cache_key)
+        _metric_cache_requests.labels("result", "hit" if cached else "miss").inc()
+        if cached:
+            logger.info(f'returning cached result of {request.query}')
+            return Response(content=cached["body"], media_type="application/json", headers=cached["headers"])
+    try:
+        conn = await get_connection(request.source_doc_id, version)
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"Database not found or failed to load: {e}")
+    ticket = new_ticket(request.source_doc_id, request.query, timeout)
+    query_headers = {"X-PondSQL-Query-Id": ticket["query_id"]}  # for DELETE /admin/queries/{query_id}
+    if request.format in ("ndjson", "arrow"):
+        # the source is loaded, the stream acquires it again ( a cache hit ) for as long as it runs
+        release(request.source_doc_id, conn)
+        if request.format == "ndjson":
+            return StreamingResponse(stream_ndjson(request, version, ticket, offset, limit), media_type="application/x-ndjson", headers=query_headers)
+        return StreamingResponse(stream_arrow(request, version, ticket, offset, limit), media_type="application/vnd.apache.arrow.stream", headers=query_headers)
+    watcher = asyncio.ensure_future(cancel_on_disconnect(http_request, ticket))
+    try:
+        result, truncated = await run_query(conn, ticket, offset, limit)
         logger.info(f'returning result of {len(result)} rows')
-        return result
+        info = page_info(request.query, offset, len(result), truncated)
+        # the body stays a plain JSON array of rows, the page info goes to the headers
+        headers = {"X-PondSQL-Truncated": str(truncated).lower()}
+        if info["next_page_token"]:
+            headers["X-PondSQL-Next-Page-Token"] = info["next_page_token"]
+        response = JSONResponse(content=jsonable_encoder(result), headers=headers)
+        if cache_key:
+            result_cache_put(cache_key, {"source_doc_id": request.source_doc_id, "body": response.body, "headers": headers})
+        response.headers.update(query_headers)
+        return response
+    except HTTPException as e:
+        logger.error(f'query {ticket["query_id"]} stopped : {e.detail}')
+        raise e
     except Exception as e:
         logger.error(f'error executing query {request.query}: {e}')
         logger.error(traceback.format_exc())
         raise e
+    finally:
+        watcher.cancel()
+        release(request.source_doc_id, conn)
+
+
+class WarmRequest(BaseModel):
+    source_doc_ids: Optional[List[str]] = None  # the pinned and most accessed sources when not given
+
+
+@app.post("/admin/warm/")
+async def warm_sources(request: WarmRequest):
+    if request.source_doc_ids is None:
+        asyncio.ensure_future(prewarm_hot_sources())
+    else:
+        asyncio.ensure_future(prewarm(request.source_doc_ids))
+    return {"warming": request.source_doc_ids}
+
+
+@app.get("/admin/pins/")
+async def list_pins():
+    with _cache_lock:
+        return sorted(_pinned_sources)
+
+
+@app.put("/admin/pins/{source_doc_id}")
+async def pin(source_doc_id: str):
+    await asyncio.get_running_loop().run_in_executor(_query_executor, pin_source, get_redis(), source_doc_id)
+    with _cache_lock:
+        _pinned_sources.add(source_doc_id)
+    asyncio.ensure_future(prewarm([source_doc_id]))
+    return {"source_doc_id": source_doc_id, "pinned": True}
+
+
+@app.delete("/admin/pins/{source_doc_id}")
+async def unpin(source_doc_id: str):
+    await asyncio.get_running_loop().run_in_executor(_query_executor, unpin_source, get_redis(), source_doc_id)
+    with _cache_lock:
+        _pinned_sources.discard(source_doc_id)
+    return {"source_doc_id": source_doc_id, "pinned": False}
+
+
+@app.get("/metrics")
+async def metrics():
+    with _query_stats_lock:
+        _metric_queries.labels("queued").set(sum(stats["queued"] for stats in _query_stats.values()))
+        _metric_queries.labels("running").set(sum(stats["running"] for stats in _query_stats.values()))
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/admin/profiles/")
+async def slowest_queries():
+    with _slowest_queries_lock:
+        return [profile for _, _, profile in sorted(_slowest_queries, key=lambda item: item[0], reverse=True)]
+
+
+@app.get("/admin/sources/")
+async def source_states():
+    with _cache_lock:
+        return {source: {"state": state["state"], "error": state["error"], "updated_at": state["updated_at"].isoformat()}
+                for source, state in _load_states.items()}
+
+
+@app.get("/admin/cache/")
+async def cache_stats():
+    with _cache_lock:
+        sources = {source: {"size": entry["size"],
+                            "hits": entry["hits"],
+                            "inflight": entry["inflight"],
+                            "pinned": source in _pinned_sources,
+                            "loaded_at": entry["loaded_at"].isoformat(),
+                            "last_access": entry["last_access"].isoformat()}
+                   for source, entry in _global_database_cache.items()}
+    return {
+        "policy": _global_eviction_policy,
+        "memory_budget": _global_memory_budget,
+        "memory_used": sum(entry["size"] for entry in sources.values()),
+        "idle_timeout": _global_database_timeout,
+        "sources": sources,
+    }
+
+
+@app.get("/admin/executor/")
+async def executor_stats():
+    with _query_stats_lock:
+        sources = {source: dict(stats) for source, stats in _query_stats.items()}
+    return {
+        "workers": _global_query_workers,
+        "source_concurrency": _global_source_concurrency,
+        "queue_depth": sum(stats["queued"] for stats in sources.values()),
+        "running": sum(stats["running"] for stats in sources.values()),
+        "sources": sources,
+    }
+
+@app.get("/admin/queries/")
+async def list_queries():
+    now = time.monotonic()
+    with _running_queries_lock:
+        return [
+            {
+                "query_id": ticket["query_id"],
+                "source_doc_id": ticket["source_doc_id"],
+                "query": ticket["query"],
+                "status": ticket["status"],
+                "timeout": ticket["timeout"],
+                "remaining": max(ticket["deadline"] - now, 0) if ticket["deadline"] is not None else None,
+                "queued_at": ticket["queued_at"].isoformat(),
+                "started_at": ticket["started_at"].isoformat() if ticket["started_at"] else None,
+            }
+            for ticket in _running_queries.values()
+        ]
+
+
+@app.delete("/admin/queries/{query_id}")
+async def kill_query(query_id: str):
+    with _running_queries_lock:
+        ticket = _running_queries.get(query_id)
+    if ticket is None or not interrupt_query(ticket, "killed"):
+        raise HTTPException(status_code=404, detail=f"Query {query_id} is not running")
+    return {"query_id": query_id, "status": "killed"}
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description="PondSQL")
+    parser.add_argument("--port", type=int, default=_global_pondsql_port)
+    parser.add_argument("--host", default="127.0.0.1", help="localhost by default. A PondSQL worker on a remote node listens on the address the router reaches it with, "
+                                                            "on a private network only : /query/ and /admin/ are not authenticated")
+    parser.add_argument("--no-prewarm", action="store_true", help="do not pre-warm the hot sources at startup, for the workers of pondsql_router.py")
+    parser.add_argument("--memory-budget-mb", type=int, default=None, help="overrides PONDSQL_MEMORY_BUDGET_MB, the router gives each local worker its share")
+    args = parser.parse_args()
+    _global_pondsql_port = args.port
+    _global_prewarm_on_startup = not args.no_prewarm
+    if args.memory_budget_mb is not None:
+        _global_memory_budget = args.memory_budget_mb * 1024 * 1024
+        _metric_memory_budget.set(_global_memory_budget)
+
     from art import text2art
     print(text2art('PondSQL', font='broadway'))
 
@@ -205,5 +1186,10 @@ if __name__ == '__main__':
     logger.info(f"using mongodb database {_global_schema_mongodb_database}")
     logger.info(f"using mongodb collection {_global_schema_mongodb_collection}")
     logger.info(f"using database timeout {_global_database_timeout}")
+    logger.info(f"using memory budget {_global_memory_budget} bytes, {_global_eviction_policy} eviction")
+    logger.info(f"using {_global_query_workers} query workers, {_global_source_concurrency} concurrent queries per source")
+    logger.info(f"using query timeout {_global_query_timeout}, per source memory limit {_global_source_memory_limit} and {_global_source_threads} threads")
 
-    uvicorn.run(app, host="127.0.0.1", port=_global_pondsql_port) # ONLY listen to localhost, and use NGINX to explose to the outside world ( HTTPS Reverse Proxy)
+    if args.host not in ("127.0.0.1", "localhost", "::1"):
+        logger.warning(f"pondsql listens on {args.host} : /query/ and /admin/ are not authenticated, only bind to a private network the router reaches this worker on")
+    uvicorn.run(app, host=args.host, port=_global_pondsql_port) # localhost unless --host ( a remote worker of pondsql_router.py ), never expose PondSQL to the outside world
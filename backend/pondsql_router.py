@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+import logging
+from logging.handlers import TimedRotatingFileHandler
+from contextlib import asynccontextmanager
+from typing import Optional
+import httpx
+import redis
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+from config import config
+from util.consistent_hash import ConsistentHashRing
+from util.source_access import get_hot_sources
+
+# The PondSQL router listens where a single PondSQL instance would ( PONDSQL_CONNECTION_STRING does not change ),
+# and forwards every /query/ to the PondSQL worker owning the source on a consistent hash ring of source_doc_id.
+# Each worker keeps its own database and result caches, so the memory of all workers adds up.
+# When a worker joins or leaves, only the sources it owns move; a moved source is loaded by its new owner on first query,
+# and the stale copy on the previous owner is evicted by its idle timeout.
+
+def setup_logger():
+    logger = logging.getLogger("default_logger")
+    logger.setLevel(logging.INFO)
+
+    log_dir = "logs"
+    log_file_path = os.path.join(log_dir, "pondsql_router.log")
+    os.makedirs(log_dir, exist_ok=True)
+
+    handler = TimedRotatingFileHandler(
+        log_file_path, when="midnight", interval=1, backupCount=10, encoding="utf-8"
+    )
+    handler.suffix = "%Y-%m-%d"
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    )
+    handler.setFormatter(formatter)
+
+    console_handler = logging.StreamHandler()
+
+    logger.addHandler(handler)
+    logger.addHandler(console_handler)
+
+    return logger
+
+logger = setup_logger()
+
+
+
+_global_router_port = 8456
+_global_local_workers = config.PONDSQL_LOCAL_WORKERS
+# the local workers share the memory budget of the node
+_global_worker_memory_budget_mb = max(config.PONDSQL_MEMORY_BUDGET_MB // max(_global_local_workers, 1), 1)
+_global_remote_workers = [url.strip().rstrip('/') for url in config.PONDSQL_WORKERS.split(',') if url.strip()]
+_global_health_interval = config.PONDSQL_HEALTH_INTERVAL
+_global_max_health_failures = 3
+_global_prewarm_top_k = config.PONDSQL_PREWARM_TOP_K
+_workers = {}  # url -> {"url", "process", "port", "healthy", "failures", "joined_at"}
+_ring = ConsistentHashRing()
+_client: Optional[httpx.AsyncClient] = None
+
+_FORWARDED_HEADERS = ("content-type",)
+
+
+def spawn_local_worker(port):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "pondsql.py"), "--port", str(port), "--no-prewarm",
+               "--memory-budget-mb", str(_global_worker_memory_budget_mb)]
+    logger.info(f"spawning local pondsql worker on port {port}")
+    return subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def join_worker(url, process=None, port=None):
+    if url not in _workers:
+        _workers[url] = {"url": url, "process": process, "port": port, "healthy": False, "failures": 0, "joined_at": time.time()}
+        logger.info(f"worker {url} joined")
+
+
+def leave_worker(url):
+    worker = _workers.pop(url, None)
+    if worker is None:
+        return False
+    _ring.remove_node(url)
+    if worker["process"] is not None:
+        worker["process"].terminate()
+    logger.info(f"worker {url} left, {len(_ring)} workers on the ring")
+    return True
+
+
+def mark_healthy(url):
+    worker = _workers.get(url)
+    if worker is None:
+        return
+    worker["failures"] = 0
+    if not worker["healthy"]:
+        worker["healthy"] = True
+        _ring.add_node(url)
+        logger.info(f"worker {url} is healthy, {len(_ring)} workers on the ring")
+
+
+def mark_unhealthy(url, immediately=False):
+    worker = _workers.get(url)
+    if worker is None:
+        return
+    worker["failures"] += 1
+    if worker["healthy"] and (immediately or worker["failures"] >= _global_max_health_failures):
+        worker["healthy"] = False
+        _ring.remove_node(url)
+        logger.warning(f"worker {url} is unhealthy, {len(_ring)} workers on the ring")
+
+
+async def check_worker(url):
+    worker = _workers.get(url)
+    if worker is None:
+        return
+    process = worker["process"]
+    if process is not None and process.poll() is not None:
+        logger.error(f"local worker {url} exited with code {process.returncode}, restarting")
+        mark_unhealthy(url, immediately=True)
+        worker["process"] = spawn_local_worker(worker["port"])
+        return
+    try:
+        response = await _client.get(f"{url}/admin/executor/", timeout=5)
+        response.raise_for_status()
+        mark_healthy(url)
+    except Exception as e:
+        logger.warning(f"health check of worker {url} failed: {e}")
+        mark_unhealthy(url)
+
+
+async def prewarm_workers():
+    """
+    Ask every worker to pre-warm the hot sources it owns, once the workers passed their first health checks
+    """
+    for _ in range(60):
+        if _workers and len(_ring) == len(_workers):
+            break
+        await asyncio.sleep(1)
+    try:
+        redis_client = redis.StrictRedis.from_url(config.REDIS_CONNECTION_STRING, decode_responses=True)
+        source_doc_ids = await asyncio.get_running_loop().run_in_executor(None, get_hot_sources, redis_client, _global_prewarm_top_k)
+    except Exception as e:
+        logger.error(f"failed to get the sources to pre-warm: {e}")
+        return
+    owned = {}
+    for source_doc_id in source_doc_ids:
+        url = _ring.get_node(source_doc_id)
+        if url is not None:
+            owned.setdefault(url, []).append(source_doc_id)
+    for url, source_doc_ids in owned.items():
+        try:
+            await _client.post(f"{url}/admin/warm/", json={"source_doc_ids": source_doc_ids}, timeout=10)
+            logger.info(f"worker {url} pre-warming {len(source_doc_ids)} sources")
+        except Exception as e:
+            logger.error(f"failed to pre-warm worker {url}: {e}")
+
+
+async def check_workers_periodically():
+    while True:
+        await asyncio.gather(*[check_worker(url) for url in list(_workers)])
+        await asyncio.sleep(_global_health_interval)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _client
+    _client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5))
+    for i in range(_global_local_workers):
+        port = _global_router_port + 1 + i
+        join_worker(f"http://127.0.0.1:{port}", spawn_local_worker(port), port)
+    for url in _global_remote_workers:
+        join_worker(url)
+    health_task = asyncio.create_task(check_workers_periodically())
+    asyncio.create_task(prewarm_workers())
+    try:
+        yield
+    finally:
+        health_task.cancel()
+        for url in list(_workers):
+            leave_worker(url)
+        await _client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.post("/query/")
+async def query(request: Request):
+    body = await request.body()
+    try:
+        source_doc_id = json.loads(body)["source_doc_id"]
+    except Exception:
+        raise HTTPException(status_code=400, detail="source_doc_id is required")
+
+    # a worker that can not be reached leaves the ring at once, and the query goes to the next owner of the source
+    for _ in range(max(len(_ring), 1)):
+        url = _ring.get_node(str(source_doc_id))
+        if url is None:
+            raise HTTPException(status_code=503, detail="No PondSQL worker available")
+        upstream_request = _client.build_request("POST", f"{url}/query/", content=body, headers={"content-type": "application/json"})
+        try:
+            upstream = await _client.send(upstream_request, stream=True)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            logger.warning(f"failed to reach worker {url}: {e}")
+            mark_unhealthy(url, immediately=True)
+            continue
+        headers = {key: value for key, value in upstream.headers.items() if key.lower() in _FORWARDED_HEADERS or key.lower().startswith("x-pondsql-")}
+        headers["X-PondSQL-Worker"] = url
+        return StreamingResponse(upstream.aiter_bytes(), status_code=upstream.status_code, headers=headers, background=BackgroundTask(upstream.aclose))
+    raise HTTPException(status_code=503, detail="No PondSQL worker available")
+
+
+class WorkerRequest(BaseModel):
+    url: str
+
+
+@app.get("/admin/workers/")
+async def list_workers():
+    return [
+        {
+            "url": worker["url"],
+            "healthy": worker["healthy"],
+            "on_ring": worker["url"] in _ring,
+            "local": worker["process"] is not None,
+            "pid": worker["process"].pid if worker["process"] is not None else None,
+            "failures": worker["failures"],
+            "joined_at": worker["joined_at"],
+        }
+        for worker in _workers.values()
+    ]
+
+
+@app.post("/admin/workers/")
+async def add_worker(request: WorkerRequest):
+    url = request.url.strip().rstrip('/')
+    join_worker(url)
+    await check_worker(url)
+    return {"url": url, "healthy": _workers[url]["healthy"]}
+
+
+@app.delete("/admin/workers/")
+async def remove_worker(url: str):
+    if not leave_worker(url.strip().rstrip('/')):
+        raise HTTPException(status_code=404, detail=f"Worker {url} not found")
+    return {"url": url, "removed": True}
+
+
+@app.get("/admin/route/{source_doc_id}")
+async def route(source_doc_id: str):
+    return {"source_doc_id": source_doc_id, "worker": _ring.get_node(source_doc_id)}
+
+
+@app.put("/admin/pins/{source_doc_id}")
+async def pin(source_doc_id: str):
+    # pins are shared by all workers through redis, the owner also loads the source right away
+    url = _ring.get_node(source_doc_id)
+    if url is None:
+        raise HTTPException(status_code=503, detail="No PondSQL worker available")
+    response = await _client.put(f"{url}/admin/pins/{source_doc_id}", timeout=10)
+    return response.json()
+
+
+@app.delete("/admin/pins/{source_doc_id}")
+async def unpin(source_doc_id: str):
+    url = _ring.get_node(source_doc_id)
+    if url is None:
+        raise HTTPException(status_code=503, detail="No PondSQL worker available")
+    response = await _client.delete(f"{url}/admin/pins/{source_doc_id}", timeout=10)
+    return response.json()
+
+
+@app.delete("/admin/queries/{query_id}")
+async def kill_query(query_id: str):
+    # the router does not track queries, ask every worker
+    for url in _ring.nodes:
+        try:
+            response = await _client.delete(f"{url}/admin/queries/{query_id}", timeout=10)
+        except Exception as e:
+            logger.warning(f"failed to reach worker {url}: {e}")
+            continue
+        if response.status_code == 200:
+            return response.json()
+    raise HTTPException(status_code=404, detail=f"Query {query_id} is not running")
+
+
+@app.get("/admin/{name}/")
+async def worker_admin(name: str):
+    # sources / cache / executor ... of every healthy worker
+    async def fetch(url):
+        try:
+            response = await _client.get(f"{url}/admin/{name}/", timeout=10)
+            response.raise_for_status()
+            return url, response.json()
+        except Exception as e:
+            return url, {"error": str(e)}
+    return dict(await asyncio.gather(*[fetch(url) for url in _ring.nodes]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="PondSQL router")
+    parser.add_argument("--port", type=int, default=_global_router_port)
+    args = parser.parse_args()
+    _global_router_port = args.port
+
+    logger.info(f"starting pondsql router on port {_global_router_port}")
+    logger.info(f"using {_global_local_workers} local workers ( {_global_worker_memory_budget_mb} MB memory budget each ), remote workers {_global_remote_workers}")
+
+    uvicorn.run(app, host="127.0.0.1", port=_global_router_port) # ONLY listen to localhost, and use NGINX to explose to the outside world ( HTTPS Reverse Proxy)
@@ -37,11 +37,11 @@ ID = 'id'
 
 
 
-def embedding_text(text: str) -> list[float]:
+async def embedding_text(text: str) -> list[float]:
     inputs = {
         "text": text
     }
-    res = dify.call_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_EMBEDDING_APP_KEY, inputs = inputs)
+    res = await dify.acall_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_EMBEDDING_APP_KEY, inputs = inputs)
     data = res.get('data', {})
     status = data.get('status', '') 
     if status == 'succeeded':
@@ -24,7 +24,9 @@ from schemas.user import UserResponse
 from config import config
 from util.json_encoder import copy_without_control_keys
 from .addto_conversation import addto_conversation
+from .task_dag import run_task_dag, TaskFailed, TASK_SUCCEEDED
 import s3_api
+import s3_api_async
 
 import dify
 
@@ -290,8 +292,8 @@ async def chat_response2(chat_id: str,  pgdb: AsyncSession = Depends(get_pgdb),
                 "role": "user", "markdowns": [current_request]
             }
             await addto_conversation(mgdb, conversation_id, user_request_message)
-            events = dify.stream_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_PLANNER2_APP_KEY, inputs = inputs)
-            for event in events:
+            events = dify.astream_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_PLANNER2_APP_KEY, inputs = inputs)
+            async for event in events:
                 data = json.loads(event.data)
                 event = data.get("event")
                 title = data.get("data", {}).get("title", "")
@@ -310,134 +312,89 @@ async def chat_response2(chat_id: str,  pgdb: AsyncSession = Depends(get_pgdb),
                         yield "data: " + json.dumps(ChatSSEResponse.model_dump(result)) + "\n\n"
             if tasks:
                 dependent_data = {}
-                for task in tasks:
-                    logger.info(f"starting task: {task}")
+                task_agents = {
+                    "sql-agent": (config.DIFY_SQL_AGENT_APP_KEY, sqlagent_event_handlers),
+                    "chat-agent": (config.DIFY_CHAT_AGENT_APP_KEY, chatagent_event_handlers),
+                    "python-data-agent": (config.DIFY_PYTHON_DATA_AGENT_APP_KEY, python_data_agent_event_handlers),
+                    "plotly-agent": (config.DIFY_PLOTLY_AGENT_APP_KEY, plotly_agent_event_handlers),
+                }
+
+                async def run_task(task):
                     task_id = task.get("task_id")
                     dependent_task_ids = task.get("dependent_task_ids", [])
                     instruction = task.get("instruction")
                     task_type = task.get("task_type")
                     source_id = task.get("source_id")
-                    dependent_input_data = []
-                    for dependent_task_id in dependent_task_ids:
-                        dependent_input_data.append(dependent_data.get(dependent_task_id, {}))
-                    if task_type == "sql-agent":
+                    if task_type not in task_agents:
+                        raise TaskFailed(f"Unknown task type: {task_type}")
+                    app_key, event_handlers = task_agents[task_type]
+                    if task_type in ("sql-agent", "chat-agent"):
                         inputs = {
                             "conversation_id": conversation_id,
                             "current_request": instruction,
-                            "source_doc_id" : source_id,
                         }
-                        events = dify.stream_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_SQL_AGENT_APP_KEY, inputs = inputs)
-                        for event in events:
-                            data = json.loads(event.data)
-                            event = data.get("event")
-                            title = data.get("data", {}).get("title", "")
-                            handler_key = str.lower(f"{event}>{title}")
-                            if event == dify.EVENT_WORKFLOW_FINISHED:
-                                status = data.get("data", {}).get('status', '')
-                                if status == "succeeded":
-                                    outputs = data.get("data", {}).get('outputs', {})
-                                    await addto_conversation(mgdb, conversation_id, outputs)
-                                    logger.info(f"sql-agent outputs: {outputs}")
-                                    dependent_data[task_id] = outputs["jsons"] # Save Data for dependent tasks
-                                else:
-                                    error = data.get("data", {}).get('error', '')
-                                    yield "data: " + json.dumps(ChatSSEResponse.model_dump(AsError(error, chat_id))) + "\n\n"
-                            if handler_key in sqlagent_event_handlers:
-                                result = sqlagent_event_handlers[handler_key](data, ctx)
-                                if result:
-                                    result.chat_id = chat_id
-                                    yield "data: " + json.dumps(ChatSSEResponse.model_dump(result)) + "\n\n"
-                    elif task_type == "chat-agent":
-                        inputs = {
-                            "conversation_id": conversation_id,
-                            "current_request": instruction,
-                        }
-                        events = dify.stream_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_CHAT_AGENT_APP_KEY, inputs = inputs)
-                        for event in events:
-                            data = json.loads(event.data)
-                            event = data.get("event")
-                            title = data.get("data", {}).get("title", "")
-                            handler_key = str.lower(f"{event}>{title}")
-                            if event == dify.EVENT_WORKFLOW_FINISHED:
-                                status = data.get("data", {}).get('status', '')
-                                if status == "succeeded":
-                                    outputs = data.get("data", {}).get('outputs', {})
-                                    await addto_conversation(mgdb, conversation_id, outputs)
-                                    logger.info(f"chat-agent outputs: {outputs}")
-                                else:
-                                    error = data.get("data", {}).get('error', '')
-                                    yield "data: " + json.dumps(ChatSSEResponse.model_dump(AsError(error, chat_id))) + "\n\n"
-                            if handler_key in chatagent_event_handlers:
-                                result = chatagent_event_handlers[handler_key](data, ctx)
-                                if result:
-                                    result.chat_id = chat_id
-                                    yield "data: " + json.dumps(ChatSSEResponse.model_dump(result)) + "\n\n"
-                    elif task_type == "python-data-agent":
-                        inputs = {
-                            "data": json.dumps(dependent_input_data),
-                            "instruction": instruction,
-                        }
-                        events = dify.stream_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_PYTHON_DATA_AGENT_APP_KEY, inputs = inputs)
-                        for event in events:
-                            data = json.loads(event.data)
-                            event = data.get("event")
-                            title = data.get("data", {}).get("title", "")
-                            handler_key = str.lower(f"{event}>{title}")
-                            if event == dify.EVENT_WORKFLOW_FINISHED:
-                                status = data.get("data", {}).get('status', '')
-                                if status == "succeeded":
-                                    outputs = data.get("data", {}).get('outputs', {})
-                                    await addto_conversation(mgdb, conversation_id, outputs)
-                                    logger.info(f"python-data-agent outputs: {outputs}")
-                                    dependent_data[task_id] = outputs["jsons"] # Save Data for dependent tasks
-                                else:
-                                    error = data.get("data", {}).get('error', '')
-                                    yield "data: " + json.dumps(ChatSSEResponse.model_dump(AsError(error, chat_id))) + "\n\n"
-                            if handler_key in python_data_agent_event_handlers:
-                                result = python_data_agent_event_handlers[handler_key](data, ctx)
-                                if result:
-                                    result.chat_id = chat_id
-                                    yield "data: " + json.dumps(ChatSSEResponse.model_dump(result)) + "\n\n"
-                    elif task_type == "plotly-agent":
+                        if task_type == "sql-agent":
+                            inputs["source_doc_id"] = source_id
+                    else:
+                        # the tasks this one depends on all succeeded ( see run_task_dag )
+                        dependent_input_data = [dependent_data.get(dependent_task_id, {}) for dependent_task_id in dependent_task_ids]
                         inputs = {
                             "data": json.dumps(dependent_input_data),
                             "instruction": instruction,
                         }
-                        events = dify.stream_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_PLOTLY_AGENT_APP_KEY, inputs = inputs)
-                        for event in events:
-                            data = json.loads(event.data)
-                            event = data.get("event")
-                            title = data.get("data", {}).get("title", "")
-                            handler_key = str.lower(f"{event}>{title}")
-                            if event == dify.EVENT_WORKFLOW_FINISHED:
-                                status = data.get("data", {}).get('status', '')
-                                if status == "succeeded":
-                                    outputs = data.get("data", {}).get('outputs', {})
+                    task_ctx = {}
+                    status = None  # the status of the workflow, the task fails unless it is "succeeded"
+                    error = None
+                    events = dify.astream_dify(config.DIFY_WORKFLOW_ENDPOINT, app_key, inputs = inputs)
+                    async for event in events:
+                        data = json.loads(event.data)
+                        event = data.get("event")
+                        title = data.get("data", {}).get("title", "")
+                        handler_key = str.lower(f"{event}>{title}")
+                        if event == dify.EVENT_WORKFLOW_FINISHED:
+                            status = data.get("data", {}).get('status', '')
+                            if status == "succeeded":
+                                outputs = data.get("data", {}).get('outputs', {})
+                                if task_type == "plotly-agent":
                                     thought_process = outputs.get('thought_process', [])
                                     if thought_process and len(thought_process) > 0:
                                         html_encoded = thought_process[0]
                                         compressed_data = base64.b64decode(html_encoded)
                                         input_bytes = zlib.decompress(compressed_data)
                                         restored = input_bytes.decode('utf-8')
-                                        
+
                                         file_obj = io.BytesIO(restored.encode("utf-8"))
-                                        r = s3_api.upload_fileobj("plotly", f"{chat_id}_{task_id}.html", file_obj, current_user, "text/html")
+                                        r = await s3_api_async.upload_fileobj("plotly", f"{chat_id}_{task_id}.html", file_obj, current_user, "text/html")
                                         object_name = r.get("object_name", "")
                                         object_name = object_name.split('/')[-1]
                                         outputs["thought_process"] = [object_name, restored]
-                                        yield "data: " + json.dumps(ChatSSEResponse.model_dump(AsPlot(restored, object_name , chat_id))) + "\n\n"
-                                    await addto_conversation(mgdb, conversation_id, outputs)
-                                    logger.info(f"plotly-agent outputs: {outputs}")
-                                else:
-                                    error = data.get("data", {}).get('error', '')
-                                    yield "data: " + json.dumps(ChatSSEResponse.model_dump(AsError(error, chat_id))) + "\n\n"
-                            if handler_key in plotly_agent_event_handlers:
-                                result = plotly_agent_event_handlers[handler_key](data, ctx)
-                                if result:
-                                    result.chat_id = chat_id
-                                    yield "data: " + json.dumps(ChatSSEResponse.model_dump(result)) + "\n\n"
+                                        yield AsPlot(restored, object_name , chat_id)
+                                await addto_conversation(mgdb, conversation_id, outputs)
+                                logger.info(f"{task_type} outputs: {outputs}")
+                                if task_type in ("sql-agent", "python-data-agent"):
+                                    dependent_data[task_id] = outputs["jsons"] # Save Data for dependent tasks
+                            else:
+                                error = data.get("data", {}).get('error')
+                        if handler_key in event_handlers:
+                            result = event_handlers[handler_key](data, task_ctx)
+                            if result:
+                                yield result
+                    if status is None:
+                        raise TaskFailed(f"{task_type} ended without finishing")
+                    if status != "succeeded":
+                        raise TaskFailed(error or f"{task_type} {status or 'failed'}")
+
+                # independent tasks run concurrently, their events are merged into this stream and tagged by task_id
+                async for task_id, task_status, payload in run_task_dag(tasks, run_task):
+                    if task_status is None:
+                        result = payload
+                    elif task_status == TASK_SUCCEEDED:
+                        continue
                     else:
-                        yield "data: " + json.dumps(ChatSSEResponse.model_dump(AsError(f"Unknown task type: {task_type}", chat_id))) + "\n\n"
+                        result = AsError(payload, chat_id)
+                    result.chat_id = chat_id
+                    result.task_id = task_id
+                    yield "data: " + json.dumps(ChatSSEResponse.model_dump(result)) + "\n\n"
             yield "data: " + json.dumps(ChatSSEResponse.model_dump(DoneSignal(chat_id))) + "\n\n"
         except asyncio.CancelledError:
             logger.error("Event stream was cancelled.")
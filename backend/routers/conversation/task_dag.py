@@ -0,0 +1,94 @@
+import asyncio
+import logging
+
+
+logger = logging.getLogger()
+
+TASK_SUCCEEDED = "succeeded"
+TASK_FAILED = "failed"
+TASK_SKIPPED = "skipped"
+
+
+class TaskFailed(Exception):
+    pass
+
+
+def get_task_id(task: dict, index: int) -> str:
+    task_id = task.get("task_id")
+    return str(task_id) if task_id is not None and task_id != "" else str(index)
+
+
+async def run_task_dag(tasks: list[dict], run_task):
+    """
+    Runs the tasks of a plan as a DAG of their dependent_task_ids : a task starts as soon as all the tasks it depends on succeeded,
+    so independent tasks run concurrently and a plan takes the time of its critical path instead of the sum of its tasks.
+
+    run_task(task) is an async generator of the events of the task, it raises to fail the task ( TaskFailed for an expected failure ).
+    Yields (task_id, None, event) for every event, in the order they are produced ( the events of a task keep their order ),
+    then (task_id, status, error) once per task, status being TASK_SUCCEEDED, TASK_FAILED or TASK_SKIPPED.
+    A task is skipped when a task it depends on failed or was skipped, or when its dependencies form a cycle.
+    """
+    pending = {}  # task_id -> task, in the order of the plan
+    dependencies = {}
+    for index, task in enumerate(tasks):
+        task_id = get_task_id(task, index)
+        if task_id in pending:
+            logger.warning(f"duplicated task {task_id} in plan, ignored")
+            continue
+        pending[task_id] = task
+    for task_id, task in pending.items():
+        # an unknown dependency can not be waited for, the task runs without its data ( as the sequential execution did )
+        unknown = [str(d) for d in task.get("dependent_task_ids", []) or [] if str(d) not in pending]
+        if unknown:
+            logger.warning(f"task {task_id} depends on unknown tasks {unknown}")
+        dependencies[task_id] = [str(d) for d in task.get("dependent_task_ids", []) or [] if str(d) in pending and str(d) != task_id]
+
+    statuses = {}
+    running = {}
+    queue = asyncio.Queue()
+
+    async def run(task_id, task):
+        try:
+            async for event in run_task(task):
+                await queue.put((task_id, None, event))
+            await queue.put((task_id, TASK_SUCCEEDED, None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"task {task_id} failed: {e}")
+            await queue.put((task_id, TASK_FAILED, e))
+
+    try:
+        while pending or running:
+            # skipping a task may skip its own dependents, so schedule until nothing changes
+            changed = True
+            while changed:
+                changed = False
+                for task_id in list(pending):
+                    not_succeeded = [d for d in dependencies[task_id] if statuses.get(d) in (TASK_FAILED, TASK_SKIPPED)]
+                    if not_succeeded:
+                        del pending[task_id]
+                        statuses[task_id] = TASK_SKIPPED
+                        changed = True
+                        yield task_id, TASK_SKIPPED, TaskFailed(f"Task {task_id} skipped, the task {not_succeeded[0]} it depends on did not succeed")
+                    elif all(statuses.get(d) == TASK_SUCCEEDED for d in dependencies[task_id]):
+                        logger.info(f"starting task: {pending[task_id]}")
+                        running[task_id] = asyncio.create_task(run(task_id, pending.pop(task_id)))
+
+            if not running:
+                # nothing runs and nothing can start : the remaining tasks wait on each other
+                for task_id in list(pending):
+                    del pending[task_id]
+                    statuses[task_id] = TASK_SKIPPED
+                    yield task_id, TASK_SKIPPED, TaskFailed(f"Task {task_id} skipped, its dependencies form a cycle")
+                break
+
+            task_id, status, payload = await queue.get()
+            if status is not None:
+                statuses[task_id] = status
+                running.pop(task_id, None)
+            yield task_id, status, payload
+    finally:
+        # the client went away or the consumer failed : stop the tasks still running
+        for running_task in running.values():
+            running_task.cancel()
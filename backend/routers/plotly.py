@@ -1,4 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Body, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.future import select
 from passlib.context import CryptContext
@@ -14,7 +15,7 @@ from .auth import get_current_user
 from .admin.users import get_current_admin
 import util.tokenizer as tokenizer
 from celery_app import worker as celery_app
-import s3_api
+import s3_api_async
 from s3_api import BotoCoreError, NoCredentialsError, EndpointConnectionError, ClientError
 
    
@@ -25,12 +26,11 @@ async def view(object_name: str, current_user: User = Depends(get_current_user))
     try:
         current_user_id = current_user.id
         object_name = f"plotly/{current_user_id}/{object_name}"
-        result = s3_api.download_fileobj(object_name, "text/html")
-        file_obj = result["file_obj"]
-        media_type = result["media_type"]
+        result = await s3_api_async.stream_object(object_name)
+        media_type = result["media_type"] or "text/html"
         filename_safe = result["filename_safe"]
-        return Response(content=file_obj.getvalue(), media_type = media_type,
-                         headers={"Content-Disposition": f"inline; filename={filename_safe}"})
+        return StreamingResponse(result["chunks"], media_type = media_type,
+                         headers={"Content-Disposition": f"inline; filename={filename_safe}", "Content-Length": str(result["size"])})
     except EndpointConnectionError:
         raise HTTPException(status_code=503, detail="S3 service is unavailable. Check the endpoint.")
     except NoCredentialsError:
@@ -58,7 +58,7 @@ async def create_sop(sop: SOP, current_user: User = Depends(get_current_user), p
     doc = await sop_collection.find_one({"_id": ObjectId(doc_id)})
     if doc:
         sop = SOP.model_validate({**doc, "id": str(doc["_id"])})
-        embedding_sops([sop])
+        await embedding_sops([sop])
     return SuccessOrErrorResponse(success=True, data=doc_id)
 
 
@@ -71,7 +71,7 @@ async def update_sop(sop_doc_id: str, sop: SOP, current_user: User = Depends(get
     doc = await sop_collection.find_one({"_id": ObjectId(sop_doc_id)})
     if doc:
         sop = SOP.model_validate({**doc, "id": str(doc["_id"])})
-        embedding_sops([sop])
+        await embedding_sops([sop])
     return SuccessOrErrorResponse(success=True, data=sop_doc_id)
 
 
@@ -5,8 +5,9 @@ import numpy as np
 from redis.commands.search.query import Query
 
 from schemas.sop import SOP
-import dify
 from config import config
+from util.embedding import embed_texts
+from util.redis_vectors import get_redis, write_vectors, replace_vectors
 
 
 # 定义构建索引时的搜索宽度。
@@ -60,22 +61,20 @@ def create_redis_index(redis_client, index_name: str, vector_dim: int, index_typ
             )
         ])
         
-def add_vector_to_redis(redis_client, index_name: str, id: str, embedding: list[float], metadata: dict):
+def vector_mapping(id: str, embedding: list[float], metadata: dict) -> dict:
     binary_vector = struct.pack(f"{len(embedding)}f", *embedding)
-    key = f"{index_name}:{id}"
-    if redis_client.exists(key):
-        redis_client.delete(key)
-    redis_client.hset(
-        key,
-        mapping={
+    return {
             "id": id,
             "sop_doc_id": metadata.get("sop_doc_id", ""),
             "category" : metadata.get("category", ""),
             "is_disabled": str(metadata.get("is_disabled", False)).lower(),
             "embedding_sop": binary_vector,
             "metadata": json.dumps(metadata)
-        }
-    )
+    }
+
+
+def add_vector_to_redis(redis_client, index_name: str, id: str, embedding: list[float], metadata: dict):
+    write_vectors(redis_client, index_name, {id: vector_mapping(id, embedding, metadata)})
     
     
 def get_embedding_candidates(sops : list[SOP]) -> list[dict]:
@@ -104,51 +103,21 @@ def get_embedding_candidates(sops : list[SOP]) -> list[dict]:
             
     return candidates
 
-def embedding_candidates(candidates: list[dict]):
-    cnt = 0
-    results = []
-    for candidate in candidates:
-        cnt += 1
-        id = candidate['id']
-        sop_doc_id = candidate['sop_doc_id']
-        category = candidate['category']
-        is_disabled = candidate['is_disabled']
-        text = candidate['text']
-        logger.info(f'{cnt}/{len(candidates)} - embedding [{sop_doc_id}]: {text}')
-        inputs = {
-            "text": text
-        }
-        res = dify.call_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_EMBEDDING_APP_KEY, inputs = inputs)
-        data = res.get('data', {})
-        status = data.get('status', '') 
-        if status == 'succeeded':
-            result = data['outputs']['result'][0]
-            model = result['model']
-            dimension = result['dimension']
-            embedding = result['embedding']
-            results.append((id, sop_doc_id, category, is_disabled, candidate, text, embedding))
-        else:
-            error_message = f"dify api error {data.get('error', 'unkonwn error')}"
-            logger.error(error_message)
-            raise Exception(error_message)
-    return results
-
-
-def embedding_sops(sops: list[SOP]):
-
-    redis_client = redis.StrictRedis.from_url(config.REDIS_CONNECTION_STRING, decode_responses=False)
-    create_redis_index(redis_client, config.REDIS_SOP_INDEX_NAME, 1024, HNSW, COSINE)
+async def embedding_candidates(candidates: list[dict]):
+    logger.info(f'embedding {len(candidates)} sop texts')
+    embeddings = await embed_texts([candidate['text'] for candidate in candidates])
+    return [(candidate['id'], candidate['sop_doc_id'], candidate['category'], candidate['is_disabled'], candidate, candidate['text'], embedding) for candidate, embedding in zip(candidates, embeddings)]
 
-    for sop in sops:
-        sop_doc_id = sop.id
-        result = redis_client.ft(config.REDIS_SOP_INDEX_NAME).search(f'@sop_doc_id:{{{sop_doc_id}}}')
-        if result.docs:
-            doc_ids = [doc.id for doc in result.docs]
-            redis_client.delete(*doc_ids)
+
+async def embedding_sops(sops: list[SOP]):
+
+    redis_client = get_redis()
+    create_redis_index(redis_client, config.REDIS_SOP_INDEX_NAME, 1024, HNSW, COSINE)
 
     candidates = get_embedding_candidates(sops)
-    results = embedding_candidates(candidates)
+    results = await embedding_candidates(candidates)
     
+    vectors = {sop.id: {} for sop in sops}  # sop_doc_id -> vectors
     for id, sop_doc_id, category, is_disabled, candidate, text, vector in results:
         metadata={
             "sop_doc_id" : sop_doc_id,
@@ -156,18 +125,17 @@ def embedding_sops(sops: list[SOP]):
             "is_disabled": is_disabled,
             "text": text
         }
-        add_vector_to_redis(redis_client, config.REDIS_SOP_INDEX_NAME, id, vector, metadata)
+        vectors[sop_doc_id][id] = vector_mapping(id, vector, metadata)
+    # the previous vectors of each SOP stay searchable until the new ones are written
+    for sop_doc_id, sop_vectors in vectors.items():
+        replace_vectors(redis_client, config.REDIS_SOP_INDEX_NAME, sop_vectors, "sop_doc_id", sop_doc_id)
 
         
 def remove_redis(sop_doc_id):
-    def delete_vector_from_redis(redis_client, index_name: str, id: str):
-        key = f"{index_name}:{id}"
-        if redis_client.exists(key):
-            redis_client.delete(key)  # 删除整个键
-
-    redis_client = redis.StrictRedis.from_url(config.REDIS_CONNECTION_STRING, decode_responses=False)
+    # the vectors of a SOP are keyed {index_name}:{sop_doc_id}_{i}..., find them by their sop_doc_id tag
+    redis_client = get_redis()
     index_name = config.REDIS_SOP_INDEX_NAME
-    delete_vector_from_redis(redis_client, index_name, sop_doc_id)
+    replace_vectors(redis_client, index_name, {}, "sop_doc_id", sop_doc_id)
     
 
 
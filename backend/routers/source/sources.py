@@ -1,5 +1,5 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Body, File, UploadFile, Form
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from typing import List
 from sqlalchemy import func
 from sqlalchemy.future import select
@@ -8,6 +8,8 @@ import json
 import io
 import os
 import datetime
+import asyncio
+import logging
 from urllib.parse import quote
 import uuid
 
@@ -22,12 +24,14 @@ import source_type_manager as st_mgr
 from util.json_encoder import copy_without_control_keys, get_json
 from util.json_diff import apply_changes
 from source_types._relationships import DetectApproach
+from source_types._materialize import materialize_object
 import dify
-from s3_api import s3_client, upload_fileobj, download_fileobj
+import s3_api_async
 from s3_api import BotoCoreError, NoCredentialsError, EndpointConnectionError, ClientError
 
 
 router = APIRouter()
+logger = logging.getLogger()
 
 @router.get("", response_model=List[SourceResponse])
 async def get_sources(current_user: User = Depends(get_current_user), pgdb: AsyncSession = Depends(get_pgdb), mgdb = Depends(get_mgdb)):
@@ -289,7 +293,7 @@ async def table_annotate(target: SourceAnnotationRequest, current_user: User = D
                 "primary_keys": ",".join(target.entity.primary_keys),
                 "foreign_keys": json.dumps(target_json['entity']['foreign_keys']),
     }
-    res = dify.call_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_TABLE_ANNOTATION_APP_KEY, inputs = inputs)
+    res = await dify.acall_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_TABLE_ANNOTATION_APP_KEY, inputs = inputs)
     annotation = {}
     if res['data']['status'] == 'succeeded':
         answer = res['data']['outputs']['description']
@@ -333,17 +337,24 @@ async def upload_file(file: UploadFile = File(...), media_type: str = Form(defau
     try:
         if not file:
             raise HTTPException(status_code=400, detail="No file uploaded")
-        file_data = await file.read()
-        if not file_data:
+        # the file stays in the spool of the UploadFile and is streamed to S3, not read into memory
+        file.file.seek(0, os.SEEK_END)
+        if file.file.tell() == 0:
             raise HTTPException(status_code=400, detail="Uploaded file is empty")
+        file.file.seek(0)
         
         # Check file extension (must be .csv or .xlsx)
         base_name, ext = os.path.splitext(file.filename)
         if ext and ext.strip().lower() not in [".csv", ".xlsx"]:
             raise HTTPException(status_code=401, detail="Only CSV and XLSX are allowed.")
 
-        file_obj = io.BytesIO(file_data)
-        result = upload_fileobj("sources", file.filename, file_obj, current_user, file.content_type)
+        result = await s3_api_async.upload_fileobj("sources", file.filename, file.file, current_user, file.content_type)
+        # parse the file ONCE into parquet + manifest, every later consumer reads those ( see source_types/_materialize.py )
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, materialize_object, result["object_name"], result["media_type"])
+        except Exception as e:
+            # the consumers materialize it on demand and report the error there
+            logger.error(f"failed to materialize {result['object_name']}: {e}")
         return result
     except EndpointConnectionError:
         raise HTTPException(status_code=503, detail="S3 service is unavailable. Check the endpoint.")
@@ -362,12 +373,11 @@ async def upload_file(file: UploadFile = File(...), media_type: str = Form(defau
 @router.post("/download")
 async def download_file(object_name: str = Form(...), default_media_type: str = Form(default="application/octet-stream"), current_user: User = Depends(get_current_user)):
     try:
-        result = download_fileobj(object_name, default_media_type)
-        file_obj = result["file_obj"]
-        media_type = result["media_type"]
+        result = await s3_api_async.stream_object(object_name)
+        media_type = result["media_type"] or default_media_type
         filename_safe = result["filename_safe"]
-        return Response(content=file_obj.getvalue(), media_type = media_type,
-                         headers={"Content-Disposition": f"attachment; filename={filename_safe}"})
+        return StreamingResponse(result["chunks"], media_type = media_type,
+                         headers={"Content-Disposition": f"attachment; filename={filename_safe}", "Content-Length": str(result["size"])})
     except EndpointConnectionError:
         raise HTTPException(status_code=503, detail="S3 service is unavailable. Check the endpoint.")
     except NoCredentialsError:
@@ -1,8 +1,16 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
 import uuid
 import io
 import os
+import re
+import json
+import shutil
+import hashlib
 import datetime
+import logging
+import threading
 from botocore.exceptions import BotoCoreError, NoCredentialsError, EndpointConnectionError, ClientError
 from urllib.parse import quote
 
@@ -16,7 +24,135 @@ s3_client = boto3.client('s3',
                         aws_secret_access_key = config.S3_SECRET_KEY,
                         region_name = config.S3_REGION_NAME,
                         use_ssl = config.S3_Use_SSL,
-                        verify = config.S3_VERIFY) 
+                        verify = config.S3_VERIFY,
+                        config = BotoConfig(max_pool_connections = config.S3_MAX_POOL_CONNECTIONS)) 
+
+# multipart : large files are uploaded / downloaded in S3_MULTIPART_CHUNK_MB parts, streamed from / to the file objects
+transfer_config = TransferConfig(multipart_threshold=config.S3_MULTIPART_CHUNK_MB * 1024 * 1024,
+                                 multipart_chunksize=config.S3_MULTIPART_CHUNK_MB * 1024 * 1024)
+
+logger = logging.getLogger()
+
+# Local disk cache of downloaded objects, shared by the API, the celery workers and PondSQL on the same node.
+# blobs/<etag> holds the content ( content addressed : objects with the same content share one blob ),
+# objects/<sha1 of object name>.json the metadata of the last version seen of an object.
+# A cached object is revalidated with a conditional GET ( If-None-Match ), the least recently used blobs are
+# removed once the cache is larger than S3_CACHE_MAX_MB.
+# Another process may evict a blob at any time, so a blob is only read through open_cached_file : the open file keeps
+# its content readable after the eviction, and a blob evicted before it was opened is fetched again.
+_cache_dir = config.S3_CACHE_DIR
+_cache_max_bytes = config.S3_CACHE_MAX_MB * 1024 * 1024
+_cache_lock = threading.Lock()
+
+
+def _cache_enabled() -> bool:
+    return _cache_max_bytes > 0
+
+
+def _blob_path(etag: str) -> str:
+    return os.path.join(_cache_dir, "blobs", re.sub(r"[^0-9A-Za-z-]", "_", etag))
+
+
+def _object_meta_path(object_name: str) -> str:
+    return os.path.join(_cache_dir, "objects", hashlib.sha1(object_name.encode('utf8')).hexdigest() + ".json")
+
+
+def _read_object_meta(object_name: str) -> dict | None:
+    path = _object_meta_path(object_name)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return meta if os.path.exists(_blob_path(meta["etag"])) else None
+
+
+def _write_atomic(path: str, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _cache_object(object_name: str, meta: dict, write_blob):
+    blob_path = _blob_path(meta["etag"])
+    if not os.path.exists(blob_path):
+        _write_atomic(blob_path, write_blob)
+    _write_atomic(_object_meta_path(object_name), lambda f: f.write(json.dumps(meta).encode('utf8')))
+    _evict_cache()
+
+
+def _evict_cache():
+    with _cache_lock:
+        blobs_dir = os.path.join(_cache_dir, "blobs")
+        blobs = []
+        for entry in os.scandir(blobs_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                blobs.append((stat.st_mtime, stat.st_size, entry.path))
+        used = sum(size for _, size, _ in blobs)
+        for _, size, path in sorted(blobs):
+            if used <= _cache_max_bytes:
+                break
+            try:
+                os.remove(path)  # readers holding the file open keep reading it
+                used -= size
+            except FileNotFoundError:
+                pass
+
+
+def _meta_from_response(response: dict, object_name: str) -> dict:
+    metadata = response.get("Metadata", {})
+    return {
+        "etag": response.get("ETag", "").strip('"'),
+        "size": response.get("ContentLength", 0),
+        "media_type": response.get("ContentType", "application/octet-stream"),
+        "original_filename": metadata.get("original_filename", object_name),
+    }
+
+
+def get_cached_file(object_name: str) -> dict:
+    """
+    Makes sure the current version of the object is in the local disk cache, with ONE request :
+    a conditional GET answered by 304 when the cached copy is still valid, otherwise the object streamed to disk.
+    Returns { path, etag, size, media_type, original_filename }
+    """
+    meta = _read_object_meta(object_name)
+    kwargs = {"IfNoneMatch": f'"{meta["etag"]}"'} if meta else {}
+    try:
+        response = s3_client.get_object(Bucket=config.S3_BUCKET_NAME, Key=object_name, **kwargs)
+    except ClientError as e:
+        if meta and e.response["Error"]["Code"] in ["304", "NotModified"]:
+            os.utime(_blob_path(meta["etag"]))  # LRU
+            return {"path": _blob_path(meta["etag"]), **meta}
+        raise
+    meta = _meta_from_response(response, object_name)
+    body = response["Body"]
+    try:
+        _cache_object(object_name, meta, lambda f: shutil.copyfileobj(body, f, 1024 * 1024))
+    finally:
+        body.close()
+    return {"path": _blob_path(meta["etag"]), **meta}
+
+
+def open_cached_file(object_name: str, attempts: int = 3):
+    """
+    get_cached_file, with the blob opened ( binary ) before another process can evict it.
+    Returns (file, { path, etag, size, media_type, original_filename })
+    """
+    for attempt in range(attempts):
+        try:
+            cached = get_cached_file(object_name)
+            return open(cached["path"], "rb"), cached
+        except FileNotFoundError:
+            if attempt == attempts - 1:
+                raise
+            logger.warning(f"cached object {object_name} was evicted before it was opened, fetching it again")
 
 
 def upload_fileobj(category: str, filename: str, file_obj: io.BytesIO, current_user: User, media_type: str = None) -> dict:
@@ -27,24 +163,89 @@ def upload_fileobj(category: str, filename: str, file_obj: io.BytesIO, current_u
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
     # s3_object_name = f"{category}/{str(current_user.id)}/{base_name}_{timestamp}{ext}"
     s3_object_name = f"{category}/{str(current_user.id)}/{unique_id}_{timestamp}"
+    # file_obj may be the spooled file of an UploadFile, it is streamed in multipart chunks, never read into memory at once
     s3_client.upload_fileobj(file_obj, config.S3_BUCKET_NAME, s3_object_name, 
                                 ExtraArgs={"ContentType": media_type,
-                                        "Metadata" : { "original_filename": filename}} )
+                                        "Metadata" : { "original_filename": filename}},
+                                Config=transfer_config)
+    if _cache_enabled() and hasattr(file_obj, "seek"):
+        # the uploaded file is usually read again right away ( materialization ), keep it in the disk cache
+        try:
+            meta = get_object_info(s3_object_name)
+            file_obj.seek(0)
+            _cache_object(s3_object_name, meta, lambda f: shutil.copyfileobj(file_obj, f, 1024 * 1024))
+        except Exception as e:
+            logger.error(f"failed to cache uploaded object {s3_object_name}: {e}")
     return {"object_name": s3_object_name, "media_type": media_type, "original_filename": filename}
 
 
 def download_fileobj(object_name: str, media_type: str = None) -> dict:
     if not media_type:
         media_type = "application/octet-stream"
-    file_obj = io.BytesIO()
-    s3_client.download_fileobj(config.S3_BUCKET_NAME, object_name, file_obj)
-    file_obj.seek(0)
+    if _cache_enabled():
+        f, cached = open_cached_file(object_name)
+        with f:
+            file_obj = io.BytesIO(f.read())
+        return {"file_obj": file_obj, "media_type": cached["media_type"] or media_type, "filename_safe": quote(cached["original_filename"])}
+    # one GET brings the content and the metadata, no separate HEAD
+    response = s3_client.get_object(Bucket=config.S3_BUCKET_NAME, Key=object_name)
+    file_obj = io.BytesIO(response["Body"].read())
+    meta = _meta_from_response(response, object_name)
+    return {"file_obj": file_obj, "media_type": meta["media_type"] or media_type, "filename_safe": quote(meta["original_filename"])}
+
+
+def download_range(object_name: str, start: int, end: int) -> bytes:
+    """
+    Bytes [start, end] ( inclusive, like the HTTP Range header ) of the object
+    """
+    response = s3_client.get_object(Bucket=config.S3_BUCKET_NAME, Key=object_name, Range=f"bytes={start}-{end}")
+    return response["Body"].read()
+
+
+def stream_object(object_name: str, chunk_size: int = 1024 * 1024) -> dict:
+    """
+    Returns the metadata of the object and an iterator over its content in chunks, without buffering the whole object.
+    Returns { chunks, etag, size, media_type, original_filename, filename_safe }
+    """
+    if _cache_enabled():
+        # opened here, not in the generator : a failure must happen before the response headers are sent
+        f, cached = open_cached_file(object_name)
+        def chunks():
+            with f:
+                while data := f.read(chunk_size):
+                    yield data
+        return {"chunks": chunks(), **cached, "filename_safe": quote(cached["original_filename"])}
+    response = s3_client.get_object(Bucket=config.S3_BUCKET_NAME, Key=object_name)
+    meta = _meta_from_response(response, object_name)
+    def chunks():
+        try:
+            yield from response["Body"].iter_chunks(chunk_size)
+        finally:
+            response["Body"].close()
+    return {"chunks": chunks(), **meta, "filename_safe": quote(meta["original_filename"])}
+
+
+def upload_file_as(object_name: str, file_path: str, media_type: str = None) -> dict:
+    if not media_type:
+        media_type = "application/octet-stream"
+    s3_client.upload_file(file_path, config.S3_BUCKET_NAME, object_name, ExtraArgs={"ContentType": media_type}, Config=transfer_config)
+    return {"object_name": object_name, "media_type": media_type}
+
+
+def download_file_to(object_name: str, file_path: str, cache: bool = True) -> str:
+    # cache=False for objects that have their own cache ( the parquet artifacts of _materialize )
+    if cache and _cache_enabled():
+        f, _ = open_cached_file(object_name)
+        with f, open(file_path, "wb") as dst:
+            shutil.copyfileobj(f, dst, 1024 * 1024)
+        return file_path
+    s3_client.download_file(config.S3_BUCKET_NAME, object_name, file_path, Config=transfer_config)
+    return file_path
+
+
+def get_object_info(object_name: str) -> dict:
     response = s3_client.head_object(Bucket=config.S3_BUCKET_NAME, Key=object_name)
-    media_type = response.get("ContentType", media_type)
-    metadata = response.get("Metadata", {})
-    original_filename = metadata.get("original_filename", object_name)
-    filename_safe = quote(original_filename)
-    return {"file_obj": file_obj, "media_type": media_type, "filename_safe": filename_safe}
+    return _meta_from_response(response, object_name)
 
 
 def check_exists(object_name: str) -> bool:
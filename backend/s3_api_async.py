@@ -0,0 +1,65 @@
+import asyncio
+import functools
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+from models.user import User
+from config import config
+import s3_api
+from s3_api import BotoCoreError, NoCredentialsError, EndpointConnectionError, ClientError
+
+# The async twin of s3_api for the FastAPI routers : the same functions, run on a bounded thread pool so that
+# an S3 transfer never blocks the event loop ( and the SSE chat streams sharing it ).
+# The pool is as large as the connection pool of the boto3 client ( S3_MAX_POOL_CONNECTIONS ).
+_executor = ThreadPoolExecutor(max_workers=config.S3_MAX_POOL_CONNECTIONS, thread_name_prefix="s3")
+
+
+async def _run(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def upload_fileobj(category: str, filename: str, file_obj, current_user: User, media_type: str = None) -> dict:
+    return await _run(s3_api.upload_fileobj, category, filename, file_obj, current_user, media_type)
+
+
+async def download_fileobj(object_name: str, media_type: str = None) -> dict:
+    return await _run(s3_api.download_fileobj, object_name, media_type)
+
+
+async def check_exists(object_name: str) -> bool:
+    return await _run(s3_api.check_exists, object_name)
+
+
+async def get_object_info(object_name: str) -> dict:
+    return await _run(s3_api.get_object_info, object_name)
+
+
+def _close_chunks(chunks, pending):
+    if pending is not None and not pending.cancel():  # not started, or wait for it to finish
+        concurrent.futures.wait([pending])
+    chunks.close()
+
+
+async def stream_object(object_name: str, chunk_size: int = 1024 * 1024) -> dict:
+    """
+    Like s3_api.stream_object, chunks is an async iterator, ready for a StreamingResponse
+    """
+    result = await _run(s3_api.stream_object, object_name, chunk_size)
+    chunks = result["chunks"]
+
+    pending = None  # the next() running on the pool
+
+    async def async_chunks():
+        nonlocal pending
+        try:
+            while True:
+                pending = _executor.submit(next, chunks, None)
+                data = await asyncio.wrap_future(pending)
+                if data is None:
+                    break
+                yield data
+        finally:
+            # cancelled while next() runs : the generator can only be closed once it returns ( closes the S3 body )
+            await asyncio.shield(_run(_close_chunks, chunks, pending))
+
+    return {**result, "chunks": async_chunks()}
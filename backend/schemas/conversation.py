@@ -46,6 +46,7 @@ class ChatSSEResponse(BaseModel):
     content_type : Optional[str] = ""  # signal , message, thought_process/code/sql, data, chart
     content : Optional[Any] = "" 
     thought_process : Optional[Any] = ""
+    task_id : Optional[str] = ""  # the task of the plan the response belongs to, empty for the planner itself
     
 
     
\ No newline at end of file
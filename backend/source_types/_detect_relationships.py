@@ -8,6 +8,7 @@ from celery.exceptions import MaxRetriesExceededError
 import asyncio
 
 from source_types._relationships import DetectApproach,  calculate_relationships, encode_minhash, minhash_signature
+from source_types._relationships import detection_fingerprint, get_changed_tables, merge_relationships, strip_relationships
 from ._shared import update_source_status
 from database import get_pgdb, get_mgdb
 from config import config
@@ -44,15 +45,23 @@ async def run_task_detect_relationships(source_id : int, approach: str):
         if approach in [DetectApproach.SIGNATURE_BASED, DetectApproach.NAME_AND_SIGNATURE_BASED]:
             if db_source.status.get("calculate_signatures", "") != "done": # NOTICE, we used status here !
                 raise Exception("signatures are not calculated")
-        logger.info(f'calculating relationships with by approach {approach.value}')
-        relationships = calculate_relationships(table_schemas, approach, config.SIGNATURE_THRESHOLD, config.NAME_TYPE_THRESHOLD)
-        relationships.sort(key=lambda x: x["primary_table"])
+        # incremental : only the pairs involving a table whose data ( _fingerprint ) or columns changed since the previous
+        # detection are compared again, the relationships of the other pairs are kept
+        detected_with = f"{approach.value}|{config.SIGNATURE_THRESHOLD}|{config.NAME_TYPE_THRESHOLD}"
+        if config.INCREMENTAL_DETECTION:
+            changed_tables = get_changed_tables(table_schemas, detected_with, doc.get("_detected_with"))
+        else:
+            changed_tables = {table_schema["table_name"] for table_schema in table_schemas}
+        logger.info(f'calculating relationships with by approach {approach.value} for {len(changed_tables)}/{len(table_schemas)} changed tables')
+        strip_relationships(table_schemas, changed_tables)
+        relationships = []
+        if changed_tables:
+            relationships = calculate_relationships(table_schemas, approach, config.SIGNATURE_THRESHOLD, config.NAME_TYPE_THRESHOLD, changed_tables)
         # TODO: we need check if the foreign key data are set to primary table ? Or should be foreign table ?
-        grouped_relationships = {k: list(v) for k, v in groupby(relationships, key=lambda x: x["primary_table"])}
+        merge_relationships(table_schemas, relationships, changed_tables)
         for table_schema in table_schemas:
-            if "foreign_keys" not in table_schema:
-                table_schema["foreign_keys"] = []
-            table_schema["foreign_keys"].extend(grouped_relationships.get(table_schema["table_name"], []))
+            table_schema["_detected_fingerprint"] = detection_fingerprint(table_schema)
+        doc["_detected_with"] = detected_with
         logger.info('building graph')
         await build_graph(doc)
         async for mgdb in get_mgdb():
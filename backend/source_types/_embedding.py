@@ -9,8 +9,9 @@ from celery.exceptions import MaxRetriesExceededError
 import asyncio
 from bson import ObjectId
 
-import dify
 from config import config
+from util.embedding import embed_texts
+from util.redis_vectors import get_redis, write_vectors, replace_vectors
 from celery_app import worker
 from ._shared import update_source_status
 from database import get_pgdb, get_mgdb
@@ -65,14 +66,9 @@ def create_redis_index(redis_client, index_name: str, vector_dim: int, index_typ
             )
         ])
 
-def add_vector_to_redis(redis_client, index_name: str, id: str, embedding: list[float], metadata: dict):
+def vector_mapping(id: str, embedding: list[float], metadata: dict) -> dict:
     binary_vector = struct.pack(f"{len(embedding)}f", *embedding)
-    key = f"{index_name}:{id}"
-    if redis_client.exists(key):
-        redis_client.delete(key)
-    redis_client.hset(
-        key,
-        mapping={
+    return {
             "id": id,
             "source_doc_id": metadata.get("source_doc_id", ""),
             "source_name": metadata.get("source_name", ""),
@@ -81,8 +77,11 @@ def add_vector_to_redis(redis_client, index_name: str, id: str, embedding: list[
             "table_name": metadata.get("table_name", ""),
             "embedding_schema": binary_vector,
             "metadata": json.dumps(metadata)
-        }
-    )
+    }
+
+
+def add_vector_to_redis(redis_client, index_name: str, id: str, embedding: list[float], metadata: dict):
+    write_vectors(redis_client, index_name, {id: vector_mapping(id, embedding, metadata)})
     
     
 def get_embedding_candidates(database_schema: dict) -> list[dict]:
@@ -108,34 +107,11 @@ def get_embedding_candidates(database_schema: dict) -> list[dict]:
 
 
 
-def embedding_candidates(candidates : list[tuple]):
+async def embedding_candidates(candidates : list[tuple], checkpoint_id: str = None):
     # We do NOT embedding Database Descriptions. It will be used directly into LLM as context, since it's too highlevel.
-    cnt = 0
-    results = []
-    for table_schema, target_schema, candidate in candidates:
-        cnt += 1
-        table_name = table_schema["table_name"]
-        target_name = table_name
-        column_name = ''
-        if "column_name" in target_schema:
-            column_name = target_schema["column_name"]
-            target_name = f"{table_name}.{column_name}"
-        text = candidate['text'] # Python 3.10 对嵌套f-string表达式不支持
-        logger.info(f'{cnt}/{len(candidates)} - embedding [{target_name}]: {text}')
-        res = dify.call_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_EMBEDDING_APP_KEY, inputs = candidate)
-        data = res.get('data', {})
-        status = data.get('status', '') 
-        if status == 'succeeded':
-            result = data['outputs']['result'][0]
-            model = result['model']
-            dimension = result['dimension']
-            embedding = result['embedding']
-            results.append((table_schema, target_schema, candidate, result))
-        else:
-            error_message = f"dify api error {data.get('error', 'unkonwn error')}"
-            logger.error(error_message)
-            raise Exception(error_message)
-    return results
+    logger.info(f'embedding {len(candidates)} tables and columns')
+    embeddings = await embed_texts([candidate['text'] for _, _, candidate in candidates], checkpoint_id)
+    return [(table_schema, target_schema, candidate, {"embedding": embedding}) for (table_schema, target_schema, candidate), embedding in zip(candidates, embeddings)]
     
 
 
@@ -148,14 +124,15 @@ async def embedding(source_id: int):
     
 
 
-@shared_task(bind=True)
+@shared_task(bind=True, max_retries=config.EMBEDDING_TASK_RETRIES)
 def task_embedding(self, source_id: int):
     loop = asyncio.get_event_loop()
     try:
         return loop.run_until_complete(run_task_embedding(source_id))
     except Exception as ex:
         logger.error(ex)
-        raise
+        # the retry resumes from the embedding checkpoint of the source
+        raise self.retry(exc=ex, countdown=30 * (2 ** self.request.retries))
     
 
 async def run_task_embedding(source_id: int):
@@ -172,10 +149,11 @@ async def run_task_embedding(source_id: int):
         source_doc_id = doc_id
         source_name = doc['source_name']
         candidates = get_embedding_candidates(doc)
-        results = embedding_candidates(candidates)
+        results = await embedding_candidates(candidates, f"source:{source_doc_id}")
         
-        redis_client = redis.StrictRedis.from_url(config.REDIS_CONNECTION_STRING, decode_responses=False)
+        redis_client = get_redis()
         create_redis_index(redis_client, config.REDIS_SCHEMA_INDEX_NAME, 1024, HNSW, COSINE)
+        vectors = {}
         for table_schema, target_schema, candidate, result in results:
             table_name = table_schema['table_name']
             domains = table_schema['domains']
@@ -192,9 +170,9 @@ async def run_task_embedding(source_id: int):
                 "tags": ','.join(tags),
                 "is_disabled": False,
             }
-            embedding = result['embedding']
-            logger.info(f'sending vector to redis for {id}')
-            add_vector_to_redis(redis_client, config.REDIS_SCHEMA_INDEX_NAME, id, embedding, metadata)
+            vectors[id] = vector_mapping(id, result['embedding'], metadata)
+        # the vectors of the tables / columns removed from the source are dropped
+        replace_vectors(redis_client, config.REDIS_SCHEMA_INDEX_NAME, vectors, "source_doc_id", source_doc_id)
         await update_source_status(source_id, {"embedding": {"status": "done"}})
     except Exception as ex:
         await update_source_status(source_id, {"embedding": {"status": "failed", "error": str(ex)}})
@@ -0,0 +1,432 @@
+import os
+import time
+import json
+import uuid
+import base64
+import hashlib
+import fcntl
+import logging
+import datetime
+from decimal import Decimal
+from contextlib import contextmanager
+from uuid import UUID
+import duckdb
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+from config import config
+from source_types._relationships import encode_minhash, minhash_signature, minhash_signatures
+import s3_api
+
+logger = logging.getLogger()
+
+# Tabular files are converted into one parquet file per table (sheet), so that PondSQL can scan them directly
+# instead of downloading and re-parsing the original Excel / CSV files on every cold load.
+# The artifacts are stored in S3 (shared by every PondSQL instance) and in a local disk cache.
+# Both are keyed by the original object name + its ETag, so a replaced object never serves a stale artifact.
+# Next to the parquet files, a manifest of every object records the shape, data types, MinHash signatures and sample rows
+# of its tables, so list_entities, test_connectivity, signatures and preview never parse the file again.
+# Files are materialized right after the upload, the other consumers materialize them on demand when that failed.
+MATERIALIZED_CATEGORY = "materialized"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+MANIFEST_MEDIA_TYPE = "application/json"
+
+
+def _is_csv(filename: str) -> bool:
+    return filename.lower().endswith(".csv")
+
+
+def _sheet_key(filename: str, sheet_name: str) -> str:
+    # CSV only has one table, its "sheet_name" is the file name, which is not stable enough for a key
+    return "" if _is_csv(filename) else (sheet_name or "")
+
+
+def _artifact_key(object_name: str, etag: str, sheet_key: str) -> str:
+    return hashlib.sha1(f"{object_name}\n{etag}\n{sheet_key}".encode('utf8')).hexdigest()
+
+
+def get_artifact_object_name(object_name: str, etag: str, sheet_key: str) -> str:
+    return f"{MATERIALIZED_CATEGORY}/{_artifact_key(object_name, etag, sheet_key)}.parquet"
+
+
+def get_local_artifact_path(object_name: str, etag: str, sheet_key: str) -> str:
+    return os.path.join(config.MATERIALIZE_CACHE_DIR, f"{_artifact_key(object_name, etag, sheet_key)}.parquet")
+
+
+def _manifest_key(object_name: str, etag: str) -> str:
+    return hashlib.sha1(f"{object_name}\n{etag}\nmanifest".encode('utf8')).hexdigest()
+
+
+def get_manifest_object_name(object_name: str, etag: str) -> str:
+    return f"{MATERIALIZED_CATEGORY}/{_manifest_key(object_name, etag)}.json"
+
+
+def get_local_manifest_path(object_name: str, etag: str) -> str:
+    return os.path.join(config.MATERIALIZE_CACHE_DIR, f"{_manifest_key(object_name, etag)}.json")
+
+
+# The local cache is bounded by MATERIALIZE_CACHE_MAX_MB, the least recently used artifacts are removed first
+# ( an artifact is used when it is read, see touch_artifacts ). The parquet files are scanned by the views of the sources
+# loaded in PondSQL, which touches them every PONDSQL_EVICTION_INTERVAL : the artifacts used in the last
+# _ARTIFACT_IN_USE_SECONDS are never removed. One process evicts at a time ( a lock file, the cache is shared by processes )
+_ARTIFACT_IN_USE_SECONDS = 3600
+
+
+def touch_artifacts(paths):
+    now = time.time()
+    for path in paths:
+        try:
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            pass
+
+
+def evict_artifacts():
+    max_bytes = config.MATERIALIZE_CACHE_MAX_MB * 1024 * 1024
+    if max_bytes <= 0 or not os.path.isdir(config.MATERIALIZE_CACHE_DIR):
+        return
+    with open(os.path.join(config.MATERIALIZE_CACHE_DIR, ".evict.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # another process is evicting
+        artifacts = []
+        for entry in os.scandir(config.MATERIALIZE_CACHE_DIR):
+            if entry.is_file() and entry.name.endswith((".parquet", ".json")):
+                stat = entry.stat()
+                artifacts.append((stat.st_mtime, stat.st_size, entry.path))
+        used = sum(size for _, size, _ in artifacts)
+        in_use_since = time.time() - _ARTIFACT_IN_USE_SECONDS
+        for mtime, size, path in sorted(artifacts):
+            if used <= max_bytes or mtime >= in_use_since:
+                break
+            try:
+                os.remove(path)
+                used -= size
+            except FileNotFoundError:
+                pass
+        if used > max_bytes:
+            logger.warning(f"materialize cache is {used} bytes, over MATERIALIZE_CACHE_MAX_MB with the artifacts in use only")
+
+
+@contextmanager
+def timed(timings: dict | None, phase: str):
+    # adds the seconds spent in the block to timings[phase], used for the load phase metrics of PondSQL
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0) + time.perf_counter() - started
+
+
+def quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def quote_identifier(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+
+def json_safe(value):
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('utf-8')
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):  # pd.Timestamp is a datetime
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if value is None or (not isinstance(value, (list, dict, np.ndarray)) and pd.isna(value)):  # NaN / NA / NaT -> null
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def json_safe_records(df: pd.DataFrame) -> list[dict]:
+    """
+    Rows of a DataFrame as JSON friendly dicts, the format of preview_data
+    """
+    return [{str(key).strip('"'): json_safe(value) for key, value in row.items()} for row in df.to_dict(orient='records')]
+
+
+def table_manifest_from_frame(sheet_key: str, sheet_name: str, df: pd.DataFrame) -> dict:
+    signatures = minhash_signatures([df[col].values.tolist() for col in df.columns])
+    return {
+        "sheet_key": sheet_key,
+        "sheet_name": sheet_name,
+        "shape": list(df.shape),
+        "columns": [{"column_name": str(col),  # the headers of a sheet may be dates, numbers ...
+                     "type": str(df[col].dtype),
+                     "_signature": encode_minhash(signature)}
+                    for col, signature in zip(df.columns, signatures)],
+        "sample_rows": json_safe_records(df.head(config.MATERIALIZE_SAMPLE_ROWS)),
+    }
+
+
+# the pandas dtypes of convert_dtypes for the column types of a CSV read by DuckDB
+_PANDAS_DTYPES = {"BIGINT": "Int64", "DOUBLE": "Float64", "BOOLEAN": "boolean", "VARCHAR": "string", "TIMESTAMP": "datetime64[ns]"}
+
+
+def table_manifest_from_parquet(sheet_key: str, sheet_name: str, path: str) -> dict:
+    conn = duckdb.connect(":memory:")
+    try:
+        relation = f"read_parquet({quote_literal(path)})"
+        columns = [(name, column_type) for name, column_type, *_ in conn.execute(f"DESCRIBE SELECT * FROM {relation}").fetchall()]
+        rows = conn.execute(f"SELECT count(*) FROM {relation}").fetchone()[0]
+        manifest_columns = []
+        for name, column_type in columns:
+            # NULL is pd.NA in the convert_dtypes frames the signatures of the pandas path are computed from
+            values = [pd.NA if value is None else value for value, in conn.execute(f"SELECT DISTINCT {quote_identifier(name)} FROM {relation}").fetchall()]
+            manifest_columns.append({"column_name": name,
+                                     "type": _PANDAS_DTYPES.get(column_type, column_type.lower()),
+                                     "_signature": encode_minhash(minhash_signature(values))})
+        sample = conn.execute(f"SELECT * FROM {relation} LIMIT {int(config.MATERIALIZE_SAMPLE_ROWS)}").df()
+    finally:
+        conn.close()
+    return {
+        "sheet_key": sheet_key,
+        "sheet_name": sheet_name,
+        "shape": [rows, len(columns)],
+        "columns": manifest_columns,
+        "sample_rows": json_safe_records(sample),
+    }
+
+
+def write_manifest(manifest: dict, file_path: str):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def read_tabular_file(file_obj, filename: str) -> dict:
+    """
+    Parse a CSV / XLSX file object into { sheet_key: DataFrame }, with data types detected the same way as list_entities
+    """
+    file_obj.seek(0)
+    if _is_csv(filename):
+        frames = {"": pd.read_csv(file_obj)}
+    elif filename.lower().endswith(".xlsx"):
+        frames = pd.read_excel(file_obj, sheet_name=None, engine='openpyxl')
+    else:
+        raise Exception(f"Unsupported tabular file : {filename}")
+    return {sheet_key: df.convert_dtypes() for sheet_key, df in frames.items()}
+
+
+def write_parquet(df: pd.DataFrame, file_path: str):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"  # write aside, then rename, so readers never see a partial file
+    conn = duckdb.connect(":memory:")
+    try:
+        conn.register("_materialize_df", df)
+        conn.execute(f"COPY _materialize_df TO {quote_literal(tmp_path)} (FORMAT PARQUET)")
+        os.replace(tmp_path, file_path)
+    finally:
+        conn.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# pandas : BOOLEAN / BIGINT / DOUBLE / VARCHAR only, and integral DOUBLE columns as BIGINT,
+# the same types read_csv + convert_dtypes gives the schemas recorded by list_entities
+_PANDAS_TYPE_CANDIDATES = "['BOOLEAN', 'BIGINT', 'DOUBLE', 'VARCHAR']"
+# the default na_values of pandas read_csv, DuckDB only reads the empty fields as NULL
+_PANDAS_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                     '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+
+def _integral_double_columns(conn, relation: str) -> set:
+    columns = [name for name, column_type, *_ in conn.execute(f"DESCRIBE SELECT * FROM {relation}").fetchall() if column_type == "DOUBLE"]
+    if not columns:
+        return set()
+    checks = ", ".join(f"coalesce(bool_and({quote_identifier(c)} = trunc({quote_identifier(c)}) AND abs({quote_identifier(c)}) < 9.2e18), true)" for c in columns)
+    integral = conn.execute(f"SELECT {checks} FROM {relation}").fetchone()
+    return {c for c, is_integral in zip(columns, integral) if is_integral}
+
+
+def _csv_relation(csv_path: str, type_mode: str) -> str:
+    # the column names and the dialect of pandas read_csv, the names the schemas of the existing sources were recorded with :
+    # DuckDB names duplicated headers a_1 ( pandas a.1 ), blank ones column2 ( pandas Unnamed: 2 ), trims them, and sniffs the delimiter
+    names = [str(name) for name in pd.read_csv(csv_path, nrows=0).columns]
+    options = f"header = true, names = [{', '.join(quote_literal(name) for name in names)}], delim = ',', quote = '\"', escape = '\"'"
+    if type_mode == "pandas":
+        # pandas infers the types from the whole file, so does the sniffer here
+        options += f", sample_size = -1, auto_type_candidates = {_PANDAS_TYPE_CANDIDATES}, " \
+                   f"nullstr = [{', '.join(quote_literal(v) for v in _PANDAS_NA_VALUES)}]"
+    return f"read_csv({quote_literal(csv_path)}, {options})"
+
+
+def write_csv_parquet(csv_path: str, file_path: str, type_mode: str):
+    """
+    Convert a CSV file to parquet with DuckDB's parallel CSV reader, the rows never go through pandas
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    conn = duckdb.connect(":memory:")
+    try:
+        relation = _csv_relation(csv_path, type_mode)
+        if type_mode == "pandas":
+            integral = _integral_double_columns(conn, relation)
+            columns = [name for name, *_ in conn.execute(f"DESCRIBE SELECT * FROM {relation}").fetchall()]
+            select = ", ".join(f"CAST({quote_identifier(c)} AS BIGINT) AS {quote_identifier(c)}" if c in integral else quote_identifier(c) for c in columns)
+        else:
+            select = "*"
+        conn.execute(f"COPY (SELECT {select} FROM {relation}) TO {quote_literal(tmp_path)} (FORMAT PARQUET)")
+        os.replace(tmp_path, file_path)
+    finally:
+        conn.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def materialize_csv(object_name: str, etag: str, timings: dict = None) -> list[dict]:
+    local_path = get_local_artifact_path(object_name, etag, "")
+    os.makedirs(config.MATERIALIZE_CACHE_DIR, exist_ok=True)
+    csv_path = os.path.join(config.MATERIALIZE_CACHE_DIR, f"{uuid.uuid4().hex}.csv.tmp")
+    try:
+        with timed(timings, "s3"):
+            s3_api.download_file_to(object_name, csv_path)
+        with timed(timings, "parse"):
+            write_csv_parquet(csv_path, local_path, config.MATERIALIZE_CSV_TYPES)
+    finally:
+        if os.path.exists(csv_path):
+            os.remove(csv_path)
+    with timed(timings, "s3"):
+        s3_api.upload_file_as(get_artifact_object_name(object_name, etag, ""), local_path, PARQUET_MEDIA_TYPE)
+    with timed(timings, "parse"):
+        table_manifest = table_manifest_from_parquet("", "", local_path)
+    logger.info(f"materialized {object_name} with the duckdb csv reader ({config.MATERIALIZE_CSV_TYPES} types) {table_manifest['shape']}")
+    return [table_manifest]
+
+
+def materialize_object(object_name: str, media_type: str = None, etag: str = None, timings: dict = None) -> dict:
+    """
+    Parse the object ONCE, store every table of it as parquet, and its manifest. Returns the manifest :
+    { object_name, etag, original_filename, media_type, file_type, tables: [{ sheet_key, sheet_name, shape, columns, sample_rows }] }
+    """
+    info = s3_api.get_object_info(object_name)
+    etag = etag or info["etag"]
+    filename = info["original_filename"]
+    logger.info(f"materializing object {object_name} ({filename}, etag={etag})")
+    if _is_csv(filename) and config.MATERIALIZE_CSV_READER == "duckdb":
+        tables = materialize_csv(object_name, etag, timings)
+    else:
+        with timed(timings, "s3"):
+            downloaded = s3_api.download_fileobj(object_name, media_type)
+        with timed(timings, "parse"):
+            frames = read_tabular_file(downloaded["file_obj"], filename)
+        tables = []
+        for sheet_key, df in frames.items():
+            local_path = get_local_artifact_path(object_name, etag, sheet_key)
+            with timed(timings, "parse"):
+                write_parquet(df, local_path)
+                tables.append(table_manifest_from_frame(sheet_key, sheet_key, df))
+            with timed(timings, "s3"):
+                s3_api.upload_file_as(get_artifact_object_name(object_name, etag, sheet_key), local_path, PARQUET_MEDIA_TYPE)
+            logger.info(f"materialized {object_name} [{sheet_key}] {df.shape}")
+    manifest = {
+        "object_name": object_name,
+        "etag": etag,
+        "original_filename": filename,
+        "media_type": info["media_type"],
+        "file_type": "csv" if _is_csv(filename) else "xlsx",
+        "tables": tables,
+    }
+    local_path = get_local_manifest_path(object_name, etag)
+    write_manifest(manifest, local_path)
+    with timed(timings, "s3"):
+        s3_api.upload_file_as(get_manifest_object_name(object_name, etag), local_path, MANIFEST_MEDIA_TYPE)
+    evict_artifacts()
+    return manifest
+
+
+def _fetch_artifact(artifact_object_name: str, local_path: str, timings: dict = None) -> str | None:
+    # the local disk cache first, then S3. None when the artifact does not exist
+    if os.path.exists(local_path):
+        touch_artifacts([local_path])  # LRU
+        return local_path
+    os.makedirs(config.MATERIALIZE_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{local_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with timed(timings, "s3"):
+            s3_api.download_file_to(artifact_object_name, tmp_path, cache=False)
+        os.replace(tmp_path, local_path)
+        evict_artifacts()
+        return local_path
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            return None
+        raise
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_materialized_table(object_name: str, sheet_name: str, filename: str, etag: str, timings: dict = None) -> str | None:
+    """
+    Returns the local parquet path of a table, fetching the artifact from S3 when it is not in the local disk cache.
+    Returns None if the table has not been materialized yet.
+    """
+    sheet_key = _sheet_key(filename, sheet_name)
+    return _fetch_artifact(get_artifact_object_name(object_name, etag, sheet_key), get_local_artifact_path(object_name, etag, sheet_key), timings)
+
+
+def find_manifest(object_name: str, etag: str = None) -> dict | None:
+    """
+    Returns the manifest of an uploaded tabular file, or None if the file has not been materialized yet
+    """
+    etag = etag or s3_api.get_object_info(object_name)["etag"]
+    local_path = _fetch_artifact(get_manifest_object_name(object_name, etag), get_local_manifest_path(object_name, etag))
+    if local_path is None:
+        return None
+    with open(local_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_manifest(object_name: str, media_type: str = None) -> dict:
+    """
+    Returns the manifest of an uploaded tabular file, materializing the file if it never was
+    """
+    info = s3_api.get_object_info(object_name)
+    manifest = find_manifest(object_name, info["etag"])
+    if manifest is None:
+        return materialize_object(object_name, media_type, info["etag"])
+    return manifest
+
+
+def get_table_manifest(manifest: dict, sheet_name: str) -> dict:
+    sheet_key = _sheet_key(manifest["original_filename"], sheet_name)
+    for table in manifest["tables"]:
+        if table["sheet_key"] == sheet_key:
+            return table
+    raise Exception(f"sheet {sheet_name} not found in {manifest['original_filename']}")
+
+
+def materialize_tables(table_schemas: list[dict], timings: dict = None) -> dict:
+    """
+    Make sure every table of a tabular file source has a parquet artifact.
+    Returns { (object_name, sheet_name): local parquet path }, and adds the seconds spent per phase (s3, parse) to timings
+    """
+    results = {}
+    objects = {}
+    for table_schema in table_schemas:
+        object_name = table_schema["object_name"]
+        sheet_name = table_schema["sheet_name"]
+        if object_name not in objects:
+            with timed(timings, "s3"):
+                objects[object_name] = s3_api.get_object_info(object_name)
+        info = objects[object_name]
+        path = get_materialized_table(object_name, sheet_name, info["original_filename"], info["etag"], timings)
+        if path is None:
+            manifest = materialize_object(object_name, table_schema["media_type"], info["etag"], timings)
+            path = get_local_artifact_path(object_name, info["etag"], get_table_manifest(manifest, sheet_name)["sheet_key"])
+        results[(object_name, sheet_name)] = path
+    return results
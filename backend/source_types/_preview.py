@@ -0,0 +1,107 @@
+import logging
+import threading
+from collections import OrderedDict
+import duckdb
+import openpyxl
+import pandas as pd
+
+from config import config
+from ._materialize import find_manifest, get_table_manifest, get_materialized_table, json_safe_records, quote_literal, _sheet_key
+import s3_api
+
+logger = logging.getLogger()
+
+# Preview is clicked all the time in the source editor, so it never parses a whole file :
+# the sample rows of the manifest first, then the parquet artifact, and only then a row limited read of the original file.
+# Uploaded objects never change ( a new upload is a new object name ), so previews are cached by object name and table.
+_preview_cache = OrderedDict()  # (object_name, sheet_key) -> {"rows": [...], "complete": bool}, least recently used first
+_preview_cache_lock = threading.Lock()
+
+
+def _cache_get(key, limit: int):
+    with _preview_cache_lock:
+        cached = _preview_cache.get(key)
+        if cached is None or (len(cached["rows"]) < limit and not cached["complete"]):
+            return None
+        _preview_cache.move_to_end(key)
+        return cached["rows"][:limit]
+
+
+def _cache_put(key, rows: list, complete: bool):
+    with _preview_cache_lock:
+        cached = _preview_cache.get(key)
+        if cached is not None and (cached["complete"] or len(cached["rows"]) >= len(rows)):
+            return
+        _preview_cache[key] = {"rows": rows, "complete": complete}
+        _preview_cache.move_to_end(key)
+        while len(_preview_cache) > config.PREVIEW_CACHE_SIZE:
+            _preview_cache.popitem(last=False)
+
+
+def _unique_headers(values) -> list:
+    # the column names pandas gives to a header row : "Unnamed: n" for empty cells, "name.n" for duplicates
+    headers = []
+    for i, value in enumerate(values):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        base, n = name, 0
+        while name in headers:
+            n += 1
+            name = f"{base}.{n}"
+        headers.append(name)
+    return headers
+
+
+def _read_xlsx_rows(file_obj, sheet_name: str, limit: int) -> pd.DataFrame:
+    # read_only streams the sheet XML, only the first rows are ever parsed
+    workbook = openpyxl.load_workbook(file_obj, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet_name].iter_rows(max_row=limit + 1, values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return pd.DataFrame()
+        return pd.DataFrame([list(row) for row in rows], columns=_unique_headers(header))
+    finally:
+        workbook.close()
+
+
+def _read_original(object_name: str, media_type: str, file_type: str, sheet_name: str, limit: int) -> pd.DataFrame:
+    downloaded = s3_api.download_fileobj(object_name, media_type)
+    if file_type == 'csv':
+        return pd.read_csv(downloaded["file_obj"], nrows=limit)
+    elif file_type in ['xls', 'xlsx']: # remvoe xls later
+        return _read_xlsx_rows(downloaded["file_obj"], sheet_name, limit)
+    raise Exception(f"Invalid file type {file_type}")
+
+
+def preview_table(object_name: str, media_type: str, file_type: str, original_file: str, sheet_name: str, limit: int) -> list[dict]:
+    """
+    The first `limit` rows of a table of a tabular file, as JSON friendly dicts
+    """
+    key = (object_name, _sheet_key(original_file, sheet_name))
+    rows = _cache_get(key, limit)
+    if rows is not None:
+        return rows
+
+    info = s3_api.get_object_info(object_name)
+    manifest = find_manifest(object_name, info["etag"])
+    if manifest is not None:
+        table_manifest = get_table_manifest(manifest, sheet_name)
+        sample_rows = table_manifest["sample_rows"]
+        complete = len(sample_rows) >= table_manifest["shape"][0]
+        _cache_put(key, sample_rows, complete)
+        if limit <= len(sample_rows) or complete:
+            return sample_rows[:limit]
+
+    path = get_materialized_table(object_name, sheet_name, info["original_filename"], info["etag"])
+    if path is not None:
+        conn = duckdb.connect(":memory:")
+        try:
+            df = conn.execute(f"SELECT * FROM read_parquet({quote_literal(path)}) LIMIT {int(limit)}").df()
+        finally:
+            conn.close()
+    else:
+        logger.info(f"previewing {object_name} [{sheet_name}] from the original file, it is not materialized")
+        df = _read_original(object_name, media_type, file_type, sheet_name, limit)
+    rows = json_safe_records(df)
+    _cache_put(key, rows, len(rows) < limit)
+    return rows
@@ -1,10 +1,25 @@
 from enum import Enum
 import base64
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from datasketch import MinHash
 import Levenshtein as lev
 import rapidfuzz.fuzz as fuzz
 
+from config import config
+
+logger = logging.getLogger()
+
+# update_batch permutes a whole batch of hashes in one NumPy operation, a batch costs len(batch) * num_perm * 8 bytes
+_MINHASH_BATCH_SIZE = 8192
+_signature_pool = None
+
 class DetectApproach(Enum):
     NAME_BASED = "name_based"
     SIGNATURE_BASED = "signature_based"
@@ -12,12 +27,50 @@ class DetectApproach(Enum):
 
 
 def minhash_signature(values, num_perm=128):
+    # the signature is the min over the hashes of the values : hashing each distinct string once, in batches,
+    # gives the same hashvalues as updating the MinHash value by value.
+    # The values are deduped before str() as they always were : 1, 1.0 and True are one value, hashed as "1"
     m = MinHash(num_perm=num_perm)
-    for value in set(values):
-        m.update(str(value).encode('utf8'))
+    distinct = list({str(value) for value in set(values)})
+    for i in range(0, len(distinct), _MINHASH_BATCH_SIZE):
+        m.update_batch([value.encode('utf8') for value in distinct[i:i + _MINHASH_BATCH_SIZE]])
     return m
 
 
+@contextmanager
+def parallel_signatures():
+    """
+    Within the block, minhash_signatures runs across SIGNATURE_WORKERS processes, shut down when the block exits.
+    For the celery tasks only : the API and PondSQL servers calculate the signatures serially, they never start processes
+    """
+    global _signature_pool
+    workers = min(config.SIGNATURE_WORKERS or multiprocessing.cpu_count(), multiprocessing.cpu_count())
+    # celery prefork workers are daemonic processes, which can not have children
+    if workers <= 1 or multiprocessing.current_process().daemon or _signature_pool is not None:
+        yield
+        return
+    # spawned, not forked : forking a process that runs threads may deadlock on the locks the threads hold
+    _signature_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        yield
+    finally:
+        pool, _signature_pool = _signature_pool, None
+        pool.shutdown(cancel_futures=True)
+
+
+def minhash_signatures(columns: list, num_perm=128) -> list:
+    """
+    The minhash_signature of every list of values in columns, computed in parallel within parallel_signatures()
+    """
+    pool = _signature_pool if len(columns) > 1 else None
+    if pool is not None:
+        try:
+            return list(pool.map(minhash_signature, columns, [num_perm] * len(columns)))
+        except Exception as ex:
+            logger.warning(f"failed to calculate the signatures in parallel, falling back to serial: {ex}")
+    return [minhash_signature(values, num_perm) for values in columns]
+
+
 def encode_minhash(obj):
     """
     json.dumps(schema, indent=indent, default=encode_minhash)
@@ -63,7 +116,130 @@ def compare_column_name_type(table1_schema: dict, column1_schema:dict, table2_sc
 
 
 
-def calculate_relationships(table_schemas, approach: DetectApproach, signature_threshold = 0.8, name_type_threshold = 0.6):
+def _required_equal_hashvalues(num_perm: int, threshold: float):
+    # the least number of equal hashvalues for MinHash.jaccard ( equal / num_perm ) to reach the threshold, None if never
+    for k in range(num_perm + 1):
+        if np.float64(k) / np.float64(num_perm) >= threshold:
+            return k
+    return None
+
+
+def _signature_candidates(columns: list, signatures: dict, threshold: float) -> set:
+    """
+    The pairs of columns whose signatures may reach the threshold, by banded LSH over the hashvalues.
+    With num_perm - k + 1 bands, two signatures with at least k equal hashvalues differ on at most num_perm - k positions,
+    so at least one band is entirely equal ( pigeonhole ) : no pair reaching the threshold is missed.
+    """
+    buckets = {}
+    for index, signature in signatures.items():
+        num_perm = len(signature.hashvalues)
+        k = _required_equal_hashvalues(num_perm, threshold)
+        if k is None:
+            continue
+        if k == 0:
+            buckets.setdefault((num_perm, "all"), []).append(index)
+            continue
+        for band, positions in enumerate(np.array_split(np.arange(num_perm), num_perm - k + 1)):
+            buckets.setdefault((num_perm, band, signature.hashvalues[positions].tobytes()), []).append(index)
+    candidates = set()
+    for bucket in buckets.values():
+        for a in range(len(bucket)):
+            for b in range(a + 1, len(bucket)):
+                if columns[bucket[a]][0] != columns[bucket[b]][0]:
+                    candidates.add((bucket[a], bucket[b]))
+    return candidates
+
+
+def _name_type_candidates(columns: list, threshold: float) -> set:
+    """
+    The pairs of columns that may pass compare_column_name_type : the types must be equal ( unless threshold <= 0 ),
+    and lev.ratio(name1, name2) <= 2 * min(len1, len2) / (len1 + len2), which bounds the lengths of the full names.
+    """
+    if threshold <= 0:
+        return {(a, b) for a in range(len(columns)) for b in range(a + 1, len(columns)) if columns[a][0] != columns[b][0]}
+    groups = {}
+    for index, (table_index, column_index, table_schema, column_schema) in enumerate(columns):
+        full_name = f"{table_schema['table_name']}.{column_schema['column_name']}"
+        groups.setdefault(column_schema["type"], []).append((len(full_name), index))
+    candidates = set()
+    for group in groups.values():
+        group.sort()
+        lengths = [length for length, _ in group]
+        for position, (length, index) in enumerate(group):
+            # len2 >= len1 here : 2 * len1 / (len1 + len2) >= threshold  <=>  len2 <= len1 * (2 - threshold) / threshold
+            max_length = length * (2 - threshold) / threshold + 1e-9
+            end = bisect.bisect_right(lengths, max_length)
+            for _, other in group[position + 1:end]:
+                if columns[index][0] != columns[other][0]:
+                    candidates.add((min(index, other), max(index, other)))
+    return candidates
+
+
+def is_signature_fresh(table_schema: dict, fingerprint: str) -> bool:
+    """
+    Whether the signatures of a table were calculated from the data the fingerprint identifies
+    ( row count and modification dates of a database table, ETag and sheet of a file )
+    """
+    return fingerprint is not None and table_schema.get("_fingerprint") == fingerprint and \
+        all("_signature" in column_schema for column_schema in table_schema.get("columns", []))
+
+
+def detection_fingerprint(table_schema: dict) -> str:
+    # the data fingerprint plus the columns, a table whose detection fingerprint changed has its relationships detected again
+    columns = [(column_schema["column_name"], column_schema.get("type")) for column_schema in table_schema.get("columns", [])]
+    return hashlib.sha1(json.dumps([table_schema.get("_fingerprint"), columns], default=str).encode('utf8')).hexdigest()
+
+
+def get_changed_tables(table_schemas: list, detected_with: str, previous_detected_with: str) -> set:
+    """
+    The tables whose relationships must be detected again : all of them when the approach or thresholds changed,
+    otherwise the tables whose data or columns changed since the previous detection
+    """
+    if detected_with != previous_detected_with:
+        return {table_schema["table_name"] for table_schema in table_schemas}
+    return {table_schema["table_name"] for table_schema in table_schemas
+            if table_schema.get("_detected_fingerprint") != detection_fingerprint(table_schema)}
+
+
+def merge_relationships(table_schemas: list, relationships: list, changed_tables: set):
+    """
+    Merges detected relationships into the foreign_keys of their primary tables : the previously detected relationships
+    involving a changed ( or removed ) table are replaced, the ones designed in the database are kept, duplicates
+    ( same foreign_key_name ) are dropped.
+    """
+    detected_by = {approach.value for approach in DetectApproach}
+    table_names = {table_schema["table_name"] for table_schema in table_schemas}
+    grouped_relationships = {}
+    for relationship in relationships:
+        grouped_relationships.setdefault(relationship["primary_table"], []).append(relationship)
+    for table_schema in table_schemas:
+        kept = [foreign_key for foreign_key in table_schema.get("foreign_keys", [])
+                if foreign_key.get("by") not in detected_by or not (
+                    foreign_key["primary_table"] in changed_tables or foreign_key["foreign_table"] in changed_tables or
+                    foreign_key["primary_table"] not in table_names or foreign_key["foreign_table"] not in table_names)]
+        foreign_keys = []
+        names = set()
+        for foreign_key in kept + grouped_relationships.get(table_schema["table_name"], []):
+            if foreign_key["foreign_key_name"] in names:
+                continue
+            names.add(foreign_key["foreign_key_name"])
+            foreign_keys.append(foreign_key)
+        table_schema["foreign_keys"] = foreign_keys
+
+
+def strip_relationships(table_schemas: list, changed_tables: set):
+    # the detected relationships of the changed tables are detected again, they must not be taken as existing ones
+    merge_relationships(table_schemas, [], changed_tables)
+
+
+def calculate_relationships(table_schemas, approach: DetectApproach, signature_threshold = 0.8, name_type_threshold = 0.6, changed_tables: set = None):
+    """
+    Detects the relationships between the columns of different tables.
+    Instead of comparing every column with every column of the later tables, the candidate pairs are generated by
+    a name blocking index ( same type, compatible name lengths ) and / or a banded LSH index over the signatures,
+    both exact : only the candidates are verified with the thresholds, and the result is the one of the all-pairs comparison.
+    With changed_tables, only the pairs involving a changed table are compared ( incremental detection ).
+    """
 
     if approach in [DetectApproach.SIGNATURE_BASED, DetectApproach.NAME_AND_SIGNATURE_BASED]:
         # try to cache the signature so that we can speed up
@@ -75,11 +251,14 @@ def calculate_relationships(table_schemas, approach: DetectApproach, signature_t
                 _signature_cache[(table_name, column_name)] = decode_minhash(signature)
                 return _signature_cache[(table_name, column_name)]
 
-    # These are existing relationships
+    # These are existing relationships ( designed ones, the detected ones are what is being calculated )
+    detected_by = {approach.value for approach in DetectApproach}
     existing = {}
     for table in table_schemas:
         if "foreign_keys" in table:
             for foreign_key in table["foreign_keys"]:
+                if foreign_key.get("by") in detected_by:
+                    continue
                 primary_table = foreign_key["primary_table"]
                 foreign_table = foreign_key["foreign_table"]
                 existing[primary_table] = foreign_table
@@ -89,43 +268,53 @@ def calculate_relationships(table_schemas, approach: DetectApproach, signature_t
 
     # if we have shape, we can sort the tables, no shape, treat as 0,0
     table_schemas.sort(key=lambda x: x["shape"] if "shape" in x else [0, 0], reverse=True) # more data (shape), usually primary table
-    
-    for i, table1_schema in enumerate(table_schemas):
-        columns1 = table1_schema["columns"]
+
+    # (table index, column index, table schema, column schema), in the order of the all-pairs comparison
+    columns = [(i, k, table_schema, column_schema) for i, table_schema in enumerate(table_schemas) for k, column_schema in enumerate(table_schema["columns"])]
+
+    signatures = {}
+    if approach in [DetectApproach.SIGNATURE_BASED, DetectApproach.NAME_AND_SIGNATURE_BASED]:
+        for index, (_, _, table_schema, column_schema) in enumerate(columns):
+            if "_signature" in column_schema:
+                signatures[index] = _decode_signature(table_schema["table_name"], column_schema["column_name"], column_schema["_signature"])
+
+    if approach == DetectApproach.NAME_BASED:
+        candidates = _name_type_candidates(columns, name_type_threshold)
+    elif approach == DetectApproach.SIGNATURE_BASED:
+        candidates = _signature_candidates(columns, signatures, signature_threshold)
+    else:
+        candidates = _signature_candidates(columns, signatures, signature_threshold) & _name_type_candidates(columns, name_type_threshold)
+
+    for a, b in sorted(candidates):
+        _, _, table1_schema, column1_schema = columns[a]
+        _, _, table2_schema, column2_schema = columns[b]
         table1_name = table1_schema["table_name"]
-        for column1_schema in columns1:
-            column1_name = column1_schema["column_name"]
-            for j, table2_schema in enumerate(table_schemas):
-                if j <= i: # skip the same table or previous tables
-                    continue
-                columns2 = table2_schema["columns"]
-                table2_name = table2_schema["table_name"]
-                # relationship already existed, skip
-                if table1_name in existing and existing[table1_name] == table2_name:
-                    continue
-                for column2_schema in columns2:
-                    column2_name = column2_schema["column_name"]
-                    s1 = False
-                    s2 = False
-                    if approach in [DetectApproach.NAME_BASED, DetectApproach.NAME_AND_SIGNATURE_BASED]:
-                        s1 = compare_column_name_type(table1_schema, column1_schema, table2_schema, column2_schema, name_type_threshold)
-                    if approach in [DetectApproach.SIGNATURE_BASED, DetectApproach.NAME_AND_SIGNATURE_BASED]:
-                        if "_signature" in column1_schema and "_signature" in column2_schema:
-                            sig1 = _decode_signature(table1_name, column1_name, column1_schema["_signature"])
-                            sig2 = _decode_signature(table2_name, column2_name, column2_schema["_signature"])
-                            s2 = sig1.jaccard(sig2) >= signature_threshold
-                        else:
-                            s2 = False # No way to get the signature for the combination
-                    if (approach == DetectApproach.NAME_BASED and s1) or \
-                        (approach == DetectApproach.SIGNATURE_BASED and s2) or \
-                        (approach == DetectApproach.NAME_AND_SIGNATURE_BASED and s1 and s2):
-                            relationships.append({
-                                "foreign_key_name": f'{table1_name}.{column1_name} <-> {table2_name}.{column2_name}',
-                                "primary_table": table1_name,
-                                "primary_column": column1_name,
-                                "foreign_table": table2_name,
-                                "foreign_column": column2_name,
-                                "by": approach.value,
-                            })
+        table2_name = table2_schema["table_name"]
+        if changed_tables is not None and table1_name not in changed_tables and table2_name not in changed_tables:
+            continue
+        column1_name = column1_schema["column_name"]
+        column2_name = column2_schema["column_name"]
+        # relationship already existed, skip
+        if table1_name in existing and existing[table1_name] == table2_name:
+            continue
+        s1 = False
+        s2 = False
+        if approach in [DetectApproach.NAME_BASED, DetectApproach.NAME_AND_SIGNATURE_BASED]:
+            s1 = compare_column_name_type(table1_schema, column1_schema, table2_schema, column2_schema, name_type_threshold)
+        if approach in [DetectApproach.SIGNATURE_BASED, DetectApproach.NAME_AND_SIGNATURE_BASED]:
+            if a in signatures and b in signatures:
+                s2 = signatures[a].jaccard(signatures[b]) >= signature_threshold
+            else:
+                s2 = False # No way to get the signature for the combination
+        if (approach == DetectApproach.NAME_BASED and s1) or \
+            (approach == DetectApproach.SIGNATURE_BASED and s2) or \
+            (approach == DetectApproach.NAME_AND_SIGNATURE_BASED and s1 and s2):
+                relationships.append({
+                    "foreign_key_name": f'{table1_name}.{column1_name} <-> {table2_name}.{column2_name}',
+                    "primary_table": table1_name,
+                    "primary_column": column1_name,
+                    "foreign_table": table2_name,
+                    "foreign_column": column2_name,
+                    "by": approach.value,
+                })
     return relationships
-
@@ -1,5 +1,5 @@
 from util.module_discover import discover_modules, ModuleRegistry, ModuleContext
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, bindparam
 from sqlalchemy.sql import text as sql_text
 from sqlalchemy.engine import Engine
 from sqlalchemy.future import select
@@ -8,7 +8,9 @@ from bson import ObjectId
 from celery import Celery, shared_task, current_app, chain
 from celery.exceptions import MaxRetriesExceededError
 import time
+import threading
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import base64
 from uuid import UUID
@@ -26,7 +28,7 @@ from celery_app import worker
 from models.user import User
 from models.source import Source
 from database import get_pgdb, get_mgdb
-from source_types._relationships import DetectApproach, encode_minhash, minhash_signature
+from source_types._relationships import DetectApproach, encode_minhash, minhash_signature, is_signature_fresh
 from config import config
 from util.json_encoder import copy_without_control_keys
 from util.tokenizer import get_token_count
@@ -39,6 +41,31 @@ from ._statistics import run_statistics, task_statistics, statistics
 
 logger = logging.getLogger()
 
+# One pooled engine per connection string, shared by all the calls on the same database ( listing, preview, signatures ... ).
+# The engines not used for SQLSERVER_ENGINE_IDLE_TIMEOUT seconds are disposed, closing their pooled connections.
+_engines = {}  # connection string -> {"engine", "last_used"}
+_engines_lock = threading.Lock()
+
+
+def get_engine(connection_string: str) -> Engine:
+    now = time.monotonic()
+    with _engines_lock:
+        for key, entry in list(_engines.items()):
+            if key != connection_string and now - entry["last_used"] > config.SQLSERVER_ENGINE_IDLE_TIMEOUT:
+                del _engines[key]
+                entry["engine"].dispose()
+                logger.info('disposed an idle sqlserver engine')
+        entry = _engines.get(connection_string)
+        if entry is None:
+            engine = create_engine(connection_string, echo=config.DB_ECHO,
+                                   pool_size=max(config.SQLSERVER_POOL_SIZE, config.SIGNATURE_TABLE_CONCURRENCY),
+                                   max_overflow=config.SQLSERVER_POOL_SIZE, pool_pre_ping=True,
+                                   pool_recycle=config.SQLSERVER_ENGINE_IDLE_TIMEOUT)
+            entry = _engines[connection_string] = {"engine": engine, "last_used": now}
+        entry["last_used"] = now
+        return entry["engine"]
+
+
 def on_init(context: ModuleContext, **kwargs):
     context.get_logger().info('initializing sqlserver source type')
     # current_app.tasks.register(task_detect_relationships)
@@ -68,6 +95,7 @@ async def connection_info() -> dict:
         "autocommit": dict(required=False, title="Auto Commit", hint="Enable auto-commit transactions (True or False)", quote=False, default=None, allowed=["true", "false"]),
         "ssl": dict(required=False, title="SSL", hint="Enable SSL connection (yes or no)", quote=False, default=None, allowed=["yes", "no"]),
         "charset": dict(required=False, title="Charset", hint="e.g. UTF-8", quote=False, default=None),
+        "schemas": dict(required=False, title="Schemas", hint="Comma separated schemas to list the tables of, all when empty", quote=False, default=None, scope=True),
         # "TrustServerCertificate": dict(required=False, title="Trust Server Certificate", hint="Whether trust SQL Server Certificate", quote=False, default=config.TRUSTSERVERCERTIFICATE, allowed=["yes", "no"]),
   
     }
@@ -118,37 +146,25 @@ async def run_calculate_signature(source_id : int, approach: str):
 
 async def impl_calculate_signatures(connection_info, table_schemas):
     # Calculate Signature, SHAPE
+    # Only the tables whose data changed since their signatures were calculated ( see get_table_fingerprint ) are signed again,
+    # unless INCREMENTAL_DETECTION is off
+    # The tables are sampled on the server ( see calculate_table_signatures ), SIGNATURE_TABLE_CONCURRENCY tables at once
     connection_string = await build_connection_string(connection_info)
-    engine: Engine = create_engine(connection_string, echo=config.DB_ECHO)
-    with engine.connect() as connection:
-        for table_schema in table_schemas:
-            logger.info(f'calcuating signature for {table_schema['table_name']}')
-            # If a table already got all signatures, pass
-            # if not all(["_signature" in column_schema for column_schema in table_schema["columns"]]): 
-            # When this function called, means, recalculate all signatures
-            if True:
-                count = get_table_count(connection, table_schema)
-                max_rows_to_signature = config.MAX_ROWS_TO_SIGNATURE
-                to_limit = max_rows_to_signature if count > max_rows_to_signature else 0
-                data = get_table_data(connection, table_schema, to_limit)
-                if len(data) > 0:
-                    normalized_data = [
-                        {
-                            key.strip('"'): (
-                                str(value) if isinstance(value, UUID)  # Convert UUID to string
-                                else base64.b64encode(value).decode('utf-8') if isinstance(value, bytes)  # Convert bytes to Base64
-                                else value  # Keep other types as is
-                            )
-                            for key, value in row.items()
-                        }
-                        for row in data
-                    ]
-                    df = pd.DataFrame(normalized_data)
-                    table_schema["shape"] = list(df.shape)
-                    table_schema["shape"][0] = count # put the real count back in
-                    for column_schema in table_schema["columns"]:
-                        col = column_schema["column_name"]
-                        column_schema["_signature"] = encode_minhash(minhash_signature(df[col].values.tolist()))
+    concurrency = max(config.SIGNATURE_TABLE_CONCURRENCY, 1)
+    engine: Engine = get_engine(connection_string)
+
+    def _calculate(table_schema):
+        with engine.connect() as connection:
+            fingerprint = get_table_fingerprint(connection, table_schema)
+            if config.INCREMENTAL_DETECTION and is_signature_fresh(table_schema, fingerprint):
+                logger.info(f"signatures of {table_schema['table_name']} are up to date")
+                return
+            calculate_table_signatures(connection, table_schema)
+            table_schema["_fingerprint"] = fingerprint
+
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*[loop.run_in_executor(executor, _calculate, table_schema) for table_schema in table_schemas])
     return table_schemas
 
 
@@ -157,6 +173,8 @@ async def build_connection_string(input_config: dict) -> str:
     parts = {}
   
     for k, v in schema.items():
+        if v.get("scope", False):  # not a connection parameter, see list_entities
+            continue
         value = None
         value = v["default"]
         if k in input_config:
@@ -193,17 +211,40 @@ async def build_connection_string(input_config: dict) -> str:
 async def test_connectivity(connection_info: dict) -> bool:
     connection_string = await build_connection_string(connection_info)
     try:
-        engine = create_engine(connection_string)
-        engine.connect()
-        return True
+        with get_engine(connection_string).connect():
+            return True
     except Exception as e:
         raise
     
 
 
+def _scope(schema_column: str, table_column: str, schemas: list = None, tables: list = None) -> tuple[str, list, dict]:
+    """
+    The conditions ( joined by AND ), the expanding bind parameters and their values restricting a catalog query
+    to some schemas and / or tables ( schema.table )
+    """
+    conditions, bind_params, values = [], [], {}
+    if schemas:
+        conditions.append(f"{schema_column} IN :scope_schemas")
+        bind_params.append(bindparam("scope_schemas", expanding=True))
+        values["scope_schemas"] = list(schemas)
+    if tables:
+        conditions.append(f"CONCAT({schema_column}, '.', {table_column}) IN :scope_tables")
+        bind_params.append(bindparam("scope_tables", expanding=True))
+        values["scope_tables"] = list(tables)
+    return " AND ".join(conditions), bind_params, values
+
+
+def _execute_scoped(connection, sql: str, schema_column: str, table_column: str, schemas: list = None, tables: list = None):
+    # sql has a {where} ( WHERE ... ) or {and} ( an existing WHERE ... AND ... ) placeholder for the scope
+    conditions, bind_params, values = _scope(schema_column, table_column, schemas, tables)
+    sql = sql.format(where=f"WHERE {conditions}" if conditions else "", **{"and": f"AND {conditions}" if conditions else ""})
+    return connection.execute(sql_text(sql).bindparams(*bind_params), values).fetchall()
+
+
 # this will return tables and views
-def get_tables(connection):
-    sql = sql_text("""
+def get_tables(connection, schemas: list = None, tables: list = None):
+    sql = """
         SELECT 
             t.TABLE_SCHEMA, 
             t.TABLE_NAME, 
@@ -222,14 +263,12 @@ def get_tables(connection):
             AND ep.name = 'MS_Description'
         WHERE 
             t.TABLE_TYPE = 'BASE TABLE'
-    """)
-
-    cur = connection.execute(sql)
-    tables = cur.fetchall()
-    return tables
+            {and}
+    """
+    return _execute_scoped(connection, sql, "t.TABLE_SCHEMA", "t.TABLE_NAME", schemas, tables)
 
-def get_columns(connection):
-    sql = sql_text("""
+def get_columns(connection, schemas: list = None, tables: list = None):
+    sql = """
         SELECT 
             COLUMNS.TABLE_SCHEMA, 
             COLUMNS.TABLE_NAME, 
@@ -259,19 +298,17 @@ def get_columns(connection):
             AND sc.column_id = ep.minor_id
             AND ep.class = 1
             AND ep.name = 'MS_Description'
+        {where}
         ORDER BY
             COLUMNS.TABLE_SCHEMA,
             COLUMNS.TABLE_NAME,
             COLUMNS.ORDINAL_POSITION
-    """)
-
-    cur = connection.execute(sql)
-    columns = cur.fetchall()
-    return columns
+    """
+    return _execute_scoped(connection, sql, "COLUMNS.TABLE_SCHEMA", "COLUMNS.TABLE_NAME", schemas, tables)
 
 
-def get_primary_keys(connection):
-    sql = sql_text("""
+def get_primary_keys(connection, schemas: list = None, tables: list = None):
+    sql = """
         SELECT 
             KCU.TABLE_SCHEMA, 
             KCU.TABLE_NAME, 
@@ -293,14 +330,14 @@ def get_primary_keys(connection):
 						T.TABLE_CATALOG = TC.TABLE_CATALOG
 					AND T.TABLE_SCHEMA = TC.TABLE_SCHEMA
 					AND T.TABLE_NAME = TC.TABLE_NAME
-    """)
-    cur = connection.execute(sql)
-    primary_keys = cur.fetchall()
-    return primary_keys
+        {where}
+    """
+    return _execute_scoped(connection, sql, "KCU.TABLE_SCHEMA", "KCU.TABLE_NAME", schemas, tables)
 
 
-def get_foreign_keys(connection):
-    sql = sql_text("""
+def get_foreign_keys(connection, schemas: list = None, tables: list = None):
+    # scoped by the primary table, the table the foreign keys are listed with
+    sql = """
                 SELECT 
                     TFK.TABLE_SCHEMA AS FK_TABLE_SCHEMA,
                     TFK.TABLE_NAME AS FK_TABLE_NAME,
@@ -347,13 +384,28 @@ def get_foreign_keys(connection):
                                             TFK.TABLE_CATALOG = TCFK.TABLE_CATALOG
                                         AND TFK.TABLE_SCHEMA = TCFK.TABLE_SCHEMA
                                         AND TFK.TABLE_NAME = TCFK.TABLE_NAME
-    """)
-    cur = connection.execute(sql)
-    foreign_keys = cur.fetchall()
-    return foreign_keys
-
-
-async def list_entities(connection_info: dict) -> list[dict]:
+                {where}
+    """
+    return _execute_scoped(connection, sql, "TPK.TABLE_SCHEMA", "TPK.TABLE_NAME", schemas, tables)
+
+
+def extract_catalog(connection, schemas: list = None, tables: list = None) -> dict:
+    """
+    Reads the catalog ( optionally restricted to some schemas / schema.table ) and groups its rows by table in one pass.
+    Returns { "tables": [table rows], "columns" / "primary_keys" / "foreign_keys": { schema.table: [rows] } },
+    the foreign keys being grouped by their primary table.
+    """
+    catalog = {"tables": get_tables(connection, schemas, tables), "columns": {}, "primary_keys": {}, "foreign_keys": {}}
+    for column in get_columns(connection, schemas, tables):
+        catalog["columns"].setdefault(f'{column.TABLE_SCHEMA}.{column.TABLE_NAME}', []).append(column)
+    for pk in get_primary_keys(connection, schemas, tables):
+        catalog["primary_keys"].setdefault(f'{pk.TABLE_SCHEMA}.{pk.TABLE_NAME}', []).append(pk)
+    for fk in get_foreign_keys(connection, schemas, tables):
+        catalog["foreign_keys"].setdefault(f'{fk.PK_TABLE_SCHEMA}.{fk.PK_TABLE_NAME}', []).append(fk)
+    return catalog
+
+
+async def list_entities(connection_info: dict, tables: list = None) -> list[dict]:
     def _get_description(row, lang) -> list:
         description = []
         if row.DESCRIPTION and len(row.DESCRIPTION) > 0:
@@ -362,20 +414,18 @@ async def list_entities(connection_info: dict) -> list[dict]:
 
     try:
         connection_string = await build_connection_string(connection_info)
-        engine: Engine = create_engine(connection_string, echo=config.DB_ECHO)
+        schemas = [schema.strip() for schema in (connection_info.get("schemas") or "").split(",") if schema.strip()]
+        engine: Engine = get_engine(connection_string)
         with engine.connect() as connection:
-            tables = get_tables(connection)
-            columns = get_columns(connection)
-            primary_keys = get_primary_keys(connection)
-            foreign_keys = get_foreign_keys(connection)
+            catalog = await asyncio.get_running_loop().run_in_executor(None, extract_catalog, connection, schemas, tables)
         schema = []
         lang = config.DB_LANG
-        for table in tables:
+        for table in catalog["tables"]:
             table_full_name = f'{table.TABLE_SCHEMA}.{table.TABLE_NAME}'
             package = {"table_name" : table_full_name, "description" : _get_description(table, lang), "domains" : [], "tags" : ""}
             package["columns"] = [{"column_name" : column.COLUMN_NAME, "type": column.DATA_TYPE, "description" : _get_description(column, lang)  , "tags" : ""}
-                                    for column in columns if f'{column.TABLE_SCHEMA}.{column.TABLE_NAME}' == table_full_name]
-            package["primary_keys"] = [pk.COLUMN_NAME for pk in primary_keys if f'{pk.TABLE_SCHEMA}.{pk.TABLE_NAME}' == table_full_name]
+                                    for column in catalog["columns"].get(table_full_name, [])]
+            package["primary_keys"] = [pk.COLUMN_NAME for pk in catalog["primary_keys"].get(table_full_name, [])]
             # TODO: we need check if the foreign key data are set to primary table ? Or should be foreign table ?
             package["foreign_keys"] = [ {"foreign_key_name": f'{fk.PK_TABLE_SCHEMA}.{fk.PK_TABLE_NAME}.{fk.PK_COLUMN_NAME} <-> {fk.FK_TABLE_SCHEMA}.{fk.FK_TABLE_NAME}.{fk.FK_COLUMN_NAME}' , \
                                         "primary_table": f'{fk.PK_TABLE_SCHEMA}.{fk.PK_TABLE_NAME}' , \
@@ -383,7 +433,7 @@ async def list_entities(connection_info: dict) -> list[dict]:
                                         "foreign_table" : f'{fk.FK_TABLE_SCHEMA}.{fk.FK_TABLE_NAME}' , \
                                         "foreign_column" : fk.FK_COLUMN_NAME , \
                                         "by": "design" } 
-                                        for fk in foreign_keys if f'{fk.PK_TABLE_SCHEMA}.{fk.PK_TABLE_NAME}' == table_full_name]
+                                        for fk in catalog["foreign_keys"].get(table_full_name, [])]
             schema.append(package)
         return schema
     except Exception as e:
@@ -492,6 +542,109 @@ async def update_source(current_user: User, source_id: int, name: str, is_privat
     return db_source
     
 
+def quote_table_name(table_name: str) -> str:
+    # schema.table -> [schema].[table]
+    return '.'.join(f"[{part.replace(']', ']]')}]" for part in table_name.split('.', 1))
+
+
+def quote_column_name(column_name: str) -> str:
+    return f"[{column_name.replace(']', ']]')}]"
+
+
+def get_table_row_count(connection, table_schema: dict) -> int:
+    # the row count kept by SQL Server for the heap / clustered index, instead of a full COUNT(*) scan
+    sql = sql_text("""
+        SELECT SUM(p.rows) AS row_count
+        FROM sys.partitions p
+        WHERE p.object_id = OBJECT_ID(:table_name)
+            AND p.index_id IN (0, 1)
+    """)
+    row = connection.execute(sql, {"table_name": quote_table_name(table_schema["table_name"])}).fetchone()
+    if row is None or row.row_count is None:
+        return get_table_count(connection, table_schema)
+    return int(row.row_count)
+
+
+def get_table_fingerprint(connection, table_schema: dict) -> str:
+    """
+    Identifies the data of a table : its row count, the last change of its definition and the last write into it.
+    The last write comes from the index usage stats ( VIEW SERVER STATE permission, reset when the server restarts ),
+    without them only the row count and definition are compared.
+    """
+    sql = sql_text("""
+        SELECT
+            (SELECT SUM(p.rows) FROM sys.partitions p WHERE p.object_id = o.object_id AND p.index_id IN (0, 1)) AS row_count,
+            o.modify_date,
+            (SELECT MAX(s.last_user_update) FROM sys.dm_db_index_usage_stats s WHERE s.database_id = DB_ID() AND s.object_id = o.object_id) AS last_user_update
+        FROM sys.objects o
+        WHERE o.object_id = OBJECT_ID(:table_name)
+    """)
+    parameters = {"table_name": quote_table_name(table_schema["table_name"])}
+    try:
+        row = connection.execute(sql, parameters).fetchone()
+        last_user_update = row.last_user_update if row is not None else None
+    except Exception as ex:
+        logger.warning(f"no index usage stats for {table_schema['table_name']}: {ex}")
+        connection.rollback()
+        row = connection.execute(sql_text("""
+            SELECT
+                (SELECT SUM(p.rows) FROM sys.partitions p WHERE p.object_id = o.object_id AND p.index_id IN (0, 1)) AS row_count,
+                o.modify_date
+            FROM sys.objects o
+            WHERE o.object_id = OBJECT_ID(:table_name)
+        """), parameters).fetchone()
+        last_user_update = None
+    if row is None:
+        return None
+    return f"{row.row_count}|{row.modify_date}|{last_user_update}"
+
+
+# DISTINCT is not allowed on these types
+_NOT_COMPARABLE_TYPES = {"text", "ntext", "image", "xml", "geography", "geometry"}
+
+
+def get_column_sample(connection, table_schema: dict, column_schema: dict, row_count: int, limit: int) -> set:
+    """
+    The distinct values of a column, as the strings the signatures are calculated from, sampled on the server :
+    the distinct values of the TOP limit rows ( SIGNATURE_SAMPLING = top ), or of about limit rows read by TABLESAMPLE
+    ( SIGNATURE_SAMPLING = tablesample ) when the table has more than limit rows. Rows are streamed with fetchmany.
+    The rows are taken before DISTINCT : a DISTINCT TOP of a column with less than limit distinct values scans the whole table.
+    """
+    table = quote_table_name(table_schema["table_name"])
+    column = quote_column_name(column_schema["column_name"])
+    distinct = "" if str(column_schema.get("type", "")).lower() in _NOT_COMPARABLE_TYPES else "DISTINCT"
+    if config.SIGNATURE_SAMPLING == "tablesample" and row_count > limit:
+        sql = sql_text(f"SELECT {distinct} {column} FROM {table} TABLESAMPLE ({int(limit)} ROWS)")
+    else:
+        sql = sql_text(f"SELECT {distinct} {column} FROM (SELECT TOP ({int(limit)}) {column} FROM {table}) AS _sample")
+    values = set()
+    cur = connection.execution_options(stream_results=True).execute(sql)
+    try:
+        while rows := cur.fetchmany(config.SIGNATURE_FETCH_SIZE):
+            for row in rows:
+                value = row[0]
+                if isinstance(value, UUID):  # Convert UUID to string
+                    value = str(value)
+                elif isinstance(value, bytes):  # Convert bytes to Base64
+                    value = base64.b64encode(value).decode('utf-8')
+                values.add(str(value))
+    finally:
+        cur.close()
+    return values
+
+
+def calculate_table_signatures(connection, table_schema: dict) -> dict:
+    logger.info(f"calcuating signature for {table_schema['table_name']}")
+    count = get_table_row_count(connection, table_schema)
+    if count == 0:
+        return table_schema
+    table_schema["shape"] = [count, len(table_schema["columns"])]
+    for column_schema in table_schema["columns"]:
+        values = get_column_sample(connection, table_schema, column_schema, count, config.MAX_ROWS_TO_SIGNATURE)
+        column_schema["_signature"] = encode_minhash(minhash_signature(values))
+    return table_schema
+
+
 def get_table_count(connection, table_schema: dict):
     sql = sql_text(f"""
         SELECT COUNT(*) AS row_count
@@ -533,7 +686,7 @@ async def preview_data(source_id: int, entity_name: dict, limit: int = 50):
         connection_info = doc['connection']
         table_schema = doc['tables'][0]
         connection_string = await build_connection_string(connection_info)
-        engine: Engine = create_engine(connection_string, echo=config.DB_ECHO)
+        engine: Engine = get_engine(connection_string)
         with engine.connect() as connection:
             data = get_table_data(connection, table_schema, limit)
             if len(data) > 0:
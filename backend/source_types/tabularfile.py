@@ -12,6 +12,7 @@ import asyncio
 import pandas as pd
 import base64
 from uuid import UUID
+import uuid
 from itertools import groupby
 import networkx as nx
 from networkx.readwrite import json_graph
@@ -27,7 +28,7 @@ from celery_app import worker
 from models.user import User
 from models.source import Source
 from database import get_pgdb, get_mgdb
-from source_types._relationships import DetectApproach, encode_minhash, minhash_signature, calculate_relationships
+from source_types._relationships import DetectApproach, encode_minhash, minhash_signature, calculate_relationships, is_signature_fresh, parallel_signatures
 from config import config
 from util.json_encoder import copy_without_control_keys
 from util.tokenizer import get_token_count
@@ -36,6 +37,8 @@ from ._shared import update_source_status
 from ._detect_relationships import task_detect_relationships
 from ._embedding import embedding, task_embedding 
 from ._statistics import run_statistics, task_statistics, statistics
+from ._materialize import materialize_tables, get_manifest, get_table_manifest
+from ._preview import preview_table
 import s3_api
 
 
@@ -68,18 +71,9 @@ async def test_connectivity(connection_info: dict) -> bool:
     try:
         for info in fobjects:
             orinial_filename = info["original_filename"]
-            downloaded = s3_api.download_fileobj(info["object_name"], info["media_type"])
-            file_obj = downloaded["file_obj"]
-            media_type = downloaded["media_type"]
-            filename_safe = downloaded["filename_safe"].lower()  
-            if filename_safe.endswith(".csv"):
-                df = pd.read_csv(file_obj)
-                if df.empty:
-                    raise Exception(f"Empty CSV file : {orinial_filename}")
-            elif filename_safe.endswith(".xlsx"):
-                sheets = pd.read_excel(file_obj, sheet_name = None, engine='openpyxl')
-                if all([df.empty for df in sheets.values()]):
-                    raise Exception(f"Empty Excel file : {orinial_filename}")
+            manifest = get_manifest(info["object_name"], info["media_type"])  # parsed once at upload time
+            if all([0 in table["shape"] for table in manifest["tables"]]):  # DataFrame.empty
+                raise Exception(f"Empty {'CSV' if manifest['file_type'] == 'csv' else 'Excel'} file : {orinial_filename}")
         return True
     except Exception as e:
         raise
@@ -97,34 +91,31 @@ async def list_entities(connection_info: dict) -> list[dict]:
             orinial_filename = info["original_filename"]
             object_name = info["object_name"]
             media_type = info["media_type"]
-            downloaded = s3_api.download_fileobj(object_name, info["media_type"])
-            file_obj = downloaded["file_obj"]
-            media_type = downloaded["media_type"]
-            filename_safe = downloaded["filename_safe"].lower()  
-            if filename_safe.endswith(".csv"):
-                df = pd.read_csv(file_obj)
+            # shapes, data types (convert_dtypes) and signatures come from the manifest written when the file was parsed
+            manifest = get_manifest(object_name, info["media_type"])
+            media_type = manifest["media_type"]
+            filename_safe = urllib.parse.quote(manifest["original_filename"]).lower()
+            if manifest["file_type"] == "csv":
                 table_name = filename_safe
                 table_name_n = table_name
                 n = original_table_names.count(table_name)
                 if n > 0:
                     table_name_n = f"{table_name}_{n}"
                 original_table_names.append(table_name)
-                tables[table_name_n] = df
+                tables[table_name_n] = manifest["tables"][0]
                 table_name_mapping[table_name_n] = ('csv', orinial_filename, object_name, table_name, media_type)
-            elif filename_safe.endswith(".xlsx"):
-                sheets = pd.read_excel(file_obj, sheet_name=None, engine='openpyxl')
-                for sheet_name, sheet_df in sheets.items():
-                    table_name = sheet_name
+            elif manifest["file_type"] == "xlsx":
+                for table_manifest in manifest["tables"]:
+                    table_name = table_manifest["sheet_name"]
                     table_name_n = table_name
                     n = original_table_names.count(table_name)
                     if n > 0:
                         table_name_n = f"{table_name}_{n}"
                     original_table_names.append(table_name)
-                    tables[table_name_n] = sheet_df
+                    tables[table_name_n] = table_manifest
                     table_name_mapping[table_name_n] = ('xlsx', orinial_filename, object_name, table_name, media_type)
                     
-        for table_name, df in tables.items():
-            df = df.convert_dtypes() # try to detect data types
+        for table_name, table_manifest in tables.items():
             package = {
                     "table_name": table_name,
                     "file_type": table_name_mapping[table_name][0],
@@ -138,15 +129,15 @@ async def list_entities(connection_info: dict) -> list[dict]:
                     "shape": [0, 0],
                     "columns": []
             }
-            if not df.empty:
+            if 0 not in table_manifest["shape"]:
                 package.update({
-                    "shape": list(df.shape), # Need to change to list, since no tuple type in json. Tuple will cause jsondiff issue.
-                    "columns": [{"column_name": col, 
-                                "type": str(df[col].dtype), 
+                    "shape": list(table_manifest["shape"]), # Need to change to list, since no tuple type in json. Tuple will cause jsondiff issue.
+                    "columns": [{"column_name": column["column_name"], 
+                                "type": column["type"], 
                                 "description": [], 
                                 "tags" : "",
-                                "_signature": encode_minhash(minhash_signature(df[col].values.tolist())) } # Excel, always have signature !
-                            for col in df.columns]
+                                "_signature": column["_signature"] } # Excel, always have signature !
+                            for column in table_manifest["columns"]]
                 })
             schemas.append(package)
         relationships = calculate_relationships(schemas, DetectApproach.NAME_AND_SIGNATURE_BASED, config.SIGNATURE_THRESHOLD, config.NAME_TYPE_THRESHOLD)
@@ -208,6 +199,7 @@ async def create_source(current_user: User, name: str, is_private : bool, descri
             "connection_string" : await build_connection_string(connection_info),
             "dialect" : "duckdb_engine",
             "driver" : "duckdb",
+            "_version" : uuid.uuid4().hex,  # PondSQL keys its loaded databases and cached query results by this
     }
     
     
@@ -227,6 +219,7 @@ async def create_source(current_user: User, name: str, is_private : bool, descri
     
     await statistics(db_source.id)
     await embedding(db_source.id)
+    await materialize(db_source.id)
     
     return db_source
 
@@ -285,6 +278,7 @@ async def update_source(current_user: User, source_id: int, name: str, is_privat
                 "connection_string" : await build_connection_string(connection_info),
                 "dialect" : "duckdb_engine",
                 "driver" : "duckdb",
+                "_version" : uuid.uuid4().hex,
         }
         
         
@@ -301,10 +295,47 @@ async def update_source(current_user: User, source_id: int, name: str, is_privat
     
     await statistics(db_source.id)
     await embedding(db_source.id)
+    await materialize(db_source.id)
     
     return db_source
     
 
+async def materialize(source_id: int):
+    task = task_materialize.delay(source_id)
+    logger.info(f'celery task materialize {task.id} started for source {source_id}')
+    return task
+
+
+@shared_task(bind=True)
+def task_materialize(self, source_id: int):
+    loop = asyncio.get_event_loop()
+    try:
+        with parallel_signatures():
+            return loop.run_until_complete(run_task_materialize(source_id))
+    except Exception as ex:
+        logger.error(ex)
+        raise
+
+
+async def run_task_materialize(source_id: int):
+    try:
+        db_source = await update_source_status(source_id, {"materialize": {"status": "running"}})
+        doc_id = db_source.doc_id
+        if not doc_id:
+            raise Exception("Failed to fetch source data")
+        async for mgdb in get_mgdb():
+            schema_collection = mgdb[config.SCHEMA_COLLECTION_NAME]
+            doc = await schema_collection.find_one({"_id": ObjectId(doc_id)}, {"tables": 1})
+        if not doc:
+            raise Exception("Failed to fetch source doc")
+        materialize_tables(doc.get('tables', []))
+        await update_source_status(source_id, {"materialize": {"status": "done"}})
+    except Exception as ex:
+        await update_source_status(source_id, {"materialize": {"status": "failed", "error": str(ex)}})
+        logger.error(ex)
+        raise
+
+
 async def detect_relationships(source_id : int, approach: DetectApproach):
     approach = DetectApproach.NAME_AND_SIGNATURE_BASED  # FIXED
     task1 = task_calculate_signature.s(source_id, approach.value) 
@@ -317,7 +348,8 @@ async def detect_relationships(source_id : int, approach: DetectApproach):
 def task_calculate_signature(self, source_id : int, approach: str):
     loop = asyncio.get_event_loop()
     try:
-        return loop.run_until_complete(run_calculate_signature(source_id, approach))
+        with parallel_signatures():
+            return loop.run_until_complete(run_calculate_signature(source_id, approach))
     except Exception as ex:
         logger.error(ex)
         raise
@@ -349,34 +381,31 @@ async def run_calculate_signature(source_id : int, approach: str):
 async def impl_calculate_signatures(connection_info, table_schemas):
     # Calculate Signature, SHAPE
     
+    # The fingerprint of a sheet is the ETag of its file, the sheets of unchanged files keep their signatures
+    
     cache = {}
+    etags = {}
     
     for schema in table_schemas:
         table_name = schema["table_name"]
-        file_type = schema["file_type"]
-        original_file = schema["original_file"]
         object_name = schema["object_name"]
         sheet_name = schema["sheet_name"]
         media_type = schema["media_type"]
 
-        if object_name not in cache:
-            downloaded = s3_api.download_fileobj(object_name, media_type)
-            cache[object_name] = downloaded
-        else:
-            downloaded = cache[object_name]
-
-        file_obj = downloaded["file_obj"]
-        file_obj.seek(0)  # reset the file pointer to the beginning
-        media_type = downloaded["media_type"]
-        filename_safe = downloaded["filename_safe"].lower()  
+        if object_name not in etags:
+            etags[object_name] = s3_api.get_object_info(object_name)["etag"]
+        fingerprint = f"{etags[object_name]}|{sheet_name}"
+        if config.INCREMENTAL_DETECTION and is_signature_fresh(schema, fingerprint):
+            continue
 
-        if file_type == 'csv':
-            df = pd.read_csv(file_obj)
-        elif file_type in ['xls', 'xlsx']: # remvoe xls later
-            df = pd.read_excel(file_obj, sheet_name=sheet_name)
+        if object_name not in cache:
+            cache[object_name] = get_manifest(object_name, media_type)  # signatures are computed when the file is parsed
+        manifest = cache[object_name]
 
+        signatures = {column["column_name"]: column["_signature"] for column in get_table_manifest(manifest, sheet_name)["columns"]}
         for column in schema['columns']:
-            column["_signature"] = encode_minhash(minhash_signature(df[column["column_name"]].values.tolist()))
+            column["_signature"] = signatures[column["column_name"]]
+        schema["_fingerprint"] = f"{manifest['etag']}|{sheet_name}"
         
     return table_schemas
 
@@ -411,31 +440,6 @@ async def preview_data(source_id: int, entity_name: dict, limit: int = 50):
     sheet_name = table_schema["sheet_name"]
     media_type = table_schema["media_type"]
     
-    downloaded = s3_api.download_fileobj(object_name, media_type)
-    file_obj = downloaded["file_obj"]
-    if file_type == 'csv':
-            df = pd.read_csv(file_obj)
-    elif file_type in ['xls', 'xlsx']: # remvoe xls later
-        df = pd.read_excel(file_obj, sheet_name=sheet_name)
-        
-    df = df.head(limit)
-    data = df.to_dict(orient='records')
-    normalized_data = [
-        {
-            key.strip('"'): (
-                str(value) if isinstance(value, UUID)  # 转换 UUID 为字符串
-                else base64.b64encode(value).decode('utf-8') if isinstance(value, bytes)  # 转换 bytes 为 Base64
-                else value.isoformat() if isinstance(value, pd.Timestamp)  # 转换 datetime 为 ISO 格式字符串
-                else None if pd.isna(value)  # 将 NaN 或 None 转为 None（JSON 中的 null）
-                # else str(value) if isinstance(value, bool)  # 转换布尔值为字符串
-                # else None if isinstance(value, float) and (value == float('inf') or value == float('-inf'))  # 处理 inf
-                # else str(value) if isinstance(value, str) and value == ""  # 空字符串转为 None
-                # else str(value) if isinstance(value, int) and abs(value) > 2**53 - 1  # 处理大整数
-                else value  # 保留其他类型
-            )
-            for key, value in row.items()
-        }
-        for row in data
-    ]
-    return normalized_data
+    # row limited, never parses the whole file ( see source_types/_preview.py )
+    return await asyncio.get_running_loop().run_in_executor(None, preview_table, object_name, media_type, file_type, original_file, sheet_name, limit)
 
@@ -0,0 +1,10 @@
+import os
+import sys
+
+from dotenv import load_dotenv
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# config.py reads .env, the example values are enough for the tests that do not reach the services
+load_dotenv(os.path.join(BACKEND_DIR, ".env_example"))
@@ -0,0 +1,22 @@
+import duckdb
+import pandas as pd
+
+from source_types._materialize import write_csv_parquet
+
+
+def test_csv_columns_named_as_pandas(tmp_path):
+    # duplicated, blank and padded headers, a quoted delimiter, and NA strings in a numeric column
+    csv_path = tmp_path / "data.csv"
+    csv_path.write_text('a,a, b ,,c\n1,2,"x;y",4,5\nNA,x,"q""z",,null\n', encoding="utf-8")
+    expected = pd.read_csv(csv_path).convert_dtypes()
+
+    for type_mode in ("pandas", "duckdb"):
+        parquet_path = tmp_path / type_mode / "data.parquet"
+        write_csv_parquet(str(csv_path), str(parquet_path), type_mode)
+        columns = duckdb.sql(f"DESCRIBE SELECT * FROM read_parquet('{parquet_path}')").fetchall()
+        assert [name for name, *_ in columns] == list(expected.columns) == ["a", "a.1", " b ", "Unnamed: 3", "c"]
+
+    types = dict((name, column_type) for name, column_type, *_ in
+                 duckdb.sql(f"DESCRIBE SELECT * FROM read_parquet('{tmp_path / 'pandas' / 'data.parquet'}')").fetchall())
+    assert types["a"] == "BIGINT" and types["c"] == "BIGINT"
+    assert types[" b "] == "VARCHAR"
@@ -0,0 +1,14 @@
+from pondsql import normalize_query, result_cache_key
+
+
+def test_comment_does_not_swallow_the_next_line():
+    commented = "SELECT * FROM t -- c\nWHERE x > 5"
+    commented_out = "SELECT * FROM t -- c WHERE x > 5"
+    assert normalize_query(commented) == "SELECT * FROM t WHERE x > 5"
+    assert normalize_query(commented_out) == "SELECT * FROM t"
+    assert result_cache_key("s", 1, commented, 0, 10) != result_cache_key("s", 1, commented_out, 0, 10)
+
+
+def test_normalize_query_keeps_literals():
+    query = "SELECT  '--  a' ,\n \"x /* y */\" /* it's\n a comment */ FROM t;"
+    assert normalize_query(query) == "SELECT '--  a' , \"x /* y */\" FROM t"
@@ -0,0 +1,60 @@
+import bisect
+import hashlib
+
+
+class ConsistentHashRing:
+    """
+    Maps keys to nodes so that adding or removing a node only moves the keys owned by that node ( about 1/N of them ).
+    Every node is placed on the ring `replicas` times to even out the number of keys per node.
+    """
+
+    def __init__(self, nodes=None, replicas=128):
+        self.replicas = replicas
+        self._ring = []  # sorted point hashes
+        self._owners = {}  # point hash -> node
+        self._nodes = set()
+        for node in nodes or []:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf8')).digest()[:8], 'big')
+
+    @property
+    def nodes(self):
+        return sorted(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def add_node(self, node: str):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for i in range(self.replicas):
+            point = self._hash(f"{node}#{i}")
+            if point in self._owners:  # practically never happens, the first owner keeps the point
+                continue
+            self._owners[point] = node
+            bisect.insort(self._ring, point)
+
+    def remove_node(self, node: str):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        points = {point for point, owner in self._owners.items() if owner == node}
+        for point in points:
+            del self._owners[point]
+        self._ring = [point for point in self._ring if point not in points]
+
+    def get_node(self, key: str):
+        """
+        Returns the node owning the key, or None when the ring is empty
+        """
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._ring, self._hash(key)) % len(self._ring)
+        return self._owners[self._ring[index]]
@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import json
+import logging
+import struct
+import redis
+
+import dify
+from config import config
+
+logger = logging.getLogger()
+
+# Embeds many texts with the Dify embedding workflow :
+#   - EMBEDDING_BATCH_SIZE texts per workflow run when the workflow accepts a batch ( a JSON array in the `texts` input,
+#     one result per text in `outputs.result` ), one text per run in the `text` input otherwise ( the default, 1 )
+#   - EMBEDDING_CONCURRENCY runs at once, retried by the dify client ( DIFY_RETRIES ), a failed run fails the task
+#   - the embeddings are cached in redis by hash(model, text) ( EMBEDDING_CACHE ), only the texts never embedded by the
+#     model are sent to the workflow, so re-embedding a source after editing a description embeds that description only.
+#     The cache is written as the runs complete, so it is also the checkpoint of a failed run
+#   - without the cache, the embeddings are checkpointed in redis as they complete, so a failed run restarted with the
+#     same checkpoint_id only embeds the texts that were not done yet
+CHECKPOINT_KEY_PREFIX = "embedding:checkpoint"
+CACHE_KEY_PREFIX = "embedding:cache"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+def pack_vector(embedding: list[float]) -> bytes:
+    return struct.pack(f"{len(embedding)}f", *embedding)
+
+
+def unpack_vector(binary_vector: bytes) -> list[float]:
+    return list(struct.unpack(f"{len(binary_vector) // 4}f", binary_vector))
+
+
+def _checkpoint_key(checkpoint_id: str) -> str:
+    return f"{CHECKPOINT_KEY_PREFIX}:{checkpoint_id}"
+
+
+def model_hash() -> str:
+    # the workflow and its app decide the model, EMBEDDING_MODEL_ID is to be changed when the model of the app changes
+    model = f"{config.DIFY_WORKFLOW_ENDPOINT}|{config.DIFY_EMBEDDING_APP_KEY}|{config.EMBEDDING_MODEL_ID}"
+    return hashlib.sha256(model.encode('utf8')).hexdigest()[:16]
+
+
+def _cache_key(model: str, h: str) -> str:
+    return f"{CACHE_KEY_PREFIX}:{model}:{h}"
+
+
+def get_cached_embeddings(redis_client: redis.Redis, hashes: list[str]) -> dict:
+    model = model_hash()
+    hashes = list(hashes)
+    cached = {}
+    for i in range(0, len(hashes), 1000):
+        chunk = hashes[i:i + 1000]
+        for h, binary_vector in zip(chunk, redis_client.mget([_cache_key(model, h) for h in chunk])):
+            if binary_vector:
+                cached[h] = unpack_vector(binary_vector)
+    return cached
+
+
+def cache_embeddings(redis_client: redis.Redis, embeddings: dict):
+    model = model_hash()
+    pipeline = redis_client.pipeline(transaction=False)
+    for h, embedding in embeddings.items():
+        pipeline.set(_cache_key(model, h), pack_vector(embedding), ex=config.EMBEDDING_CACHE_TTL or None)
+    pipeline.execute()
+
+
+def _results_from_response(res: dict, count: int) -> list[dict]:
+    data = res.get('data', {})
+    status = data.get('status', '')
+    if status != 'succeeded':
+        raise Exception(f"dify api error {data.get('error', 'unkonwn error')}")
+    results = data['outputs']['result']
+    if len(results) < count:
+        raise Exception(f"dify api error {len(results)} embeddings returned for {count} texts")
+    return results[:count]
+
+
+async def _embed_batch(texts: list[str]) -> list[list[float]]:
+    if config.EMBEDDING_BATCH_SIZE > 1:
+        inputs = {"texts": json.dumps(texts, ensure_ascii=False)}
+    else:
+        inputs = {"text": texts[0]}
+    # one retry layer : acall_dify retries the transport errors, 429 and 5xx, and the embedding task retries itself
+    # from the cache / checkpoint
+    res = await dify.acall_dify(config.DIFY_WORKFLOW_ENDPOINT, config.DIFY_EMBEDDING_APP_KEY, inputs = inputs)
+    return [result['embedding'] for result in _results_from_response(res, len(texts))]
+
+
+async def embed_texts(texts: list[str], checkpoint_id: str = None, redis_client: redis.Redis = None) -> list[list[float]]:
+    """
+    Returns the embedding of every text, in the order of texts.
+    The checkpoint of checkpoint_id is removed once all the texts are embedded.
+    """
+    use_cache = config.EMBEDDING_CACHE
+    checkpoint_key = _checkpoint_key(checkpoint_id) if checkpoint_id and not use_cache else None
+    if (checkpoint_key or use_cache) and redis_client is None:
+        redis_client = redis.StrictRedis.from_url(config.REDIS_CONNECTION_STRING, decode_responses=False)
+
+    embeddings = {}  # text hash -> embedding
+    hashes = [text_hash(text) for text in texts]
+    if use_cache:
+        embeddings = get_cached_embeddings(redis_client, set(hashes))
+    if checkpoint_key:
+        for field, binary_vector in redis_client.hgetall(checkpoint_key).items():
+            embeddings[field.decode('utf8') if isinstance(field, bytes) else field] = unpack_vector(binary_vector)
+    todo = {}
+    for h, text in zip(hashes, texts):
+        if h not in embeddings and h not in todo:
+            todo[h] = text
+    if embeddings:
+        logger.info(f"embedding {checkpoint_id or ''}: {len(texts) - len(todo)}/{len(texts)} texts already embedded")
+
+    batch_size = max(config.EMBEDDING_BATCH_SIZE, 1)
+    items = list(todo.items())
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    semaphore = asyncio.Semaphore(config.EMBEDDING_CONCURRENCY)
+    done = 0
+
+    async def run(batch):
+        nonlocal done
+        async with semaphore:
+            vectors = await _embed_batch([text for _, text in batch])
+        for (h, _), embedding in zip(batch, vectors):
+            embeddings[h] = embedding
+        if use_cache:
+            cache_embeddings(redis_client, {h: embedding for (h, _), embedding in zip(batch, vectors)})
+        if checkpoint_key:
+            redis_client.hset(checkpoint_key, mapping={h: pack_vector(embedding) for (h, _), embedding in zip(batch, vectors)})
+            redis_client.expire(checkpoint_key, config.EMBEDDING_CHECKPOINT_TTL)
+        done += len(batch)
+        logger.info(f"{done}/{len(items)} texts embedded")
+
+    tasks = [asyncio.create_task(run(batch)) for batch in batches]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # the embeddings done so far stay in the cache / checkpoint for the next run
+        for task in tasks:
+            task.cancel()
+        raise
+
+    if checkpoint_key:
+        redis_client.delete(checkpoint_key)
+    return [embeddings[h] for h in hashes]
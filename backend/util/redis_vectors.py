@@ -0,0 +1,91 @@
+import logging
+import redis
+from redis.exceptions import ResponseError
+from redis.commands.search.query import Query
+
+from config import config
+
+logger = logging.getLogger()
+
+# Bulk writes of the embedding vectors ( hashes indexed by RediSearch ) :
+#   - one connection pool per process, shared by the embedding tasks and routers
+#   - vectors written REDIS_VECTOR_BATCH_SIZE at a time, one MULTI/EXEC round-trip per batch
+#   - replace_vectors swaps the vectors of a source / SOP : the new vectors overwrite the keys in place, then the keys of the
+#     previous embedding that are not in the new one are dropped, so a search never sees the source half-written or empty.
+#     The keys stay {index_name}:{id}, the consumers of the indexes address the vectors by those keys
+_pool = None
+
+
+def get_redis() -> redis.Redis:
+    global _pool
+    if _pool is None:
+        _pool = redis.ConnectionPool.from_url(config.REDIS_CONNECTION_STRING, decode_responses=False)
+    return redis.StrictRedis(connection_pool=_pool)
+
+
+def vector_key(index_name: str, id: str) -> str:
+    return f"{index_name}:{id}"
+
+
+def write_vectors(redis_client: redis.Redis, index_name: str, vectors: dict, batch_size: int = None) -> list:
+    """
+    vectors : id -> the mapping of the hash ( with the packed vector ). Returns the keys written.
+    """
+    batch_size = batch_size or config.REDIS_VECTOR_BATCH_SIZE
+    items = list(vectors.items())
+    keys = []
+    for i in range(0, len(items), batch_size):
+        pipeline = redis_client.pipeline(transaction=True)
+        for id, mapping in items[i:i + batch_size]:
+            key = vector_key(index_name, id)
+            # the hash is replaced, not merged with the fields of a previous version
+            pipeline.delete(key)
+            pipeline.hset(key, mapping=mapping)
+            keys.append(key)
+        pipeline.execute()
+    logger.info(f"{len(keys)} vectors written to {index_name}")
+    return keys
+
+
+def _is_unknown_index(ex: ResponseError) -> bool:
+    # "Unknown Index name" / "Unknown index name" / "no such index", depending on the RediSearch version
+    message = str(ex).lower()
+    return "unknown index" in message or "no such index" in message
+
+
+def find_vector_keys(redis_client: redis.Redis, index_name: str, tag_field: str, tag_value: str, page_size: int = 1000) -> set:
+    keys = set()
+    offset = 0
+    while True:
+        query = Query(f"@{tag_field}:{{{tag_value}}}").no_content().paging(offset, page_size)
+        try:
+            result = redis_client.ft(index_name).search(query)
+        except ResponseError as ex:
+            if _is_unknown_index(ex):  # nothing was ever embedded in the index ( e.g. deleting a SOP never embedded )
+                return keys
+            raise
+        for doc in result.docs:
+            keys.add(doc.id.decode('utf8') if isinstance(doc.id, bytes) else doc.id)
+        offset += page_size
+        if not result.docs or offset >= result.total:
+            break
+    return keys
+
+
+def delete_keys(redis_client: redis.Redis, keys, batch_size: int = None):
+    batch_size = batch_size or config.REDIS_VECTOR_BATCH_SIZE
+    keys = list(keys)
+    for i in range(0, len(keys), batch_size):
+        redis_client.delete(*keys[i:i + batch_size])
+
+
+def replace_vectors(redis_client: redis.Redis, index_name: str, vectors: dict, tag_field: str, tag_value: str, batch_size: int = None):
+    """
+    Replaces all the vectors tagged tag_field = tag_value ( e.g. source_doc_id ) by vectors
+    """
+    previous_keys = find_vector_keys(redis_client, index_name, tag_field, tag_value)
+    keys = write_vectors(redis_client, index_name, vectors, batch_size)
+    stale_keys = previous_keys - set(keys)
+    if stale_keys:
+        delete_keys(redis_client, stale_keys, batch_size)
+        logger.info(f"{len(stale_keys)} stale vectors of {tag_field}={tag_value} dropped from {index_name}")
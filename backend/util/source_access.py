@@ -0,0 +1,39 @@
+import redis
+
+# Access counts and pins of PondSQL sources, kept in redis so that they survive restarts and are shared by every PondSQL worker
+ACCESS_COUNTS_KEY = "pondsql:access_counts"  # sorted set, source_doc_id -> number of queries
+PINNED_SOURCES_KEY = "pondsql:pinned_sources"  # set of source_doc_id never evicted
+
+
+def add_access_counts(redis_client: redis.Redis, counts: dict):
+    if not counts:
+        return
+    pipeline = redis_client.pipeline(transaction=False)
+    for source_doc_id, count in counts.items():
+        pipeline.zincrby(ACCESS_COUNTS_KEY, count, source_doc_id)
+    pipeline.execute()
+
+
+def get_pinned_sources(redis_client: redis.Redis) -> set:
+    return {_decode(source_doc_id) for source_doc_id in redis_client.smembers(PINNED_SOURCES_KEY)}
+
+
+def pin_source(redis_client: redis.Redis, source_doc_id: str):
+    redis_client.sadd(PINNED_SOURCES_KEY, source_doc_id)
+
+
+def unpin_source(redis_client: redis.Redis, source_doc_id: str):
+    redis_client.srem(PINNED_SOURCES_KEY, source_doc_id)
+
+
+def get_hot_sources(redis_client: redis.Redis, top_k: int) -> list:
+    """
+    The sources to pre-warm : the pinned ones first, then the top_k most accessed ones
+    """
+    pinned = sorted(get_pinned_sources(redis_client))
+    top = [_decode(source_doc_id) for source_doc_id in redis_client.zrevrange(ACCESS_COUNTS_KEY, 0, top_k - 1)] if top_k > 0 else []
+    return pinned + [source_doc_id for source_doc_id in top if source_doc_id not in pinned]
+
+
+def _decode(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value